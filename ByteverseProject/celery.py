@@ -1,6 +1,7 @@
 import os
 from celery import Celery
 from celery.schedules import crontab
+from celery.signals import worker_process_init
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "ByteverseProject.settings")
 
@@ -9,3 +10,10 @@ app.config_from_object("django.conf:settings", namespace="CELERY")
 app.autodiscover_tasks()
 
 app.conf.beat_scheduler = 'django_celery_beat.schedulers:DatabaseScheduler'
+
+
+@worker_process_init.connect
+def warm_embedding_store(**kwargs):
+    """Load the embedding store in every pool process before it takes tasks (see api/embedding_store.py)."""
+    from api.embedding_store import warm_embedding_store
+    warm_embedding_store()
@@ -34,6 +34,60 @@ OPENAI_API_KEY = config('OPENAI_API_KEY', default='replace-this-with-your-openai
 CELERY_BROKER_URL = "redis://localhost:6379/0"
 CELERY_ACCEPT_CONTENT = ["json"]
 CELERY_TASK_SERIALIZER = "json"
+# Chords (the process_video pipeline) need a result backend
+CELERY_RESULT_BACKEND = "redis://localhost:6379/0"
+CELERY_RESULT_SERIALIZER = "json"
+CELERY_RESULT_EXPIRES = 60 * 60 * 24
+# Beat (celery -A ByteverseProject beat) also runs the engagement consumer every minute,
+# so events left pending by a failed or crashed run are retried, or dead-lettered, even
+# when no new event schedules a run (see api/engagement_queue.py, CLAIM_IDLE_MS)
+CELERY_BEAT_SCHEDULE = {
+    "consume-engagement-events": {"task": "api.tasks.consume_engagement_events", "schedule": 60.0},
+}
+
+# Shared cache (same Redis as the broker) so web and Celery processes see the same keys,
+# e.g. the embedding store change log
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": config('REDIS_CACHE_URL', default="redis://localhost:6379/1"),
+    }
+}
+
+# Engagement events (swipes, likes) are appended to a Redis stream and applied in batches
+# by the consume_engagement_events task. "local" keeps them in process (development only).
+ENGAGEMENT_QUEUE_BACKEND = config('ENGAGEMENT_QUEUE_BACKEND', default="redis")
+ENGAGEMENT_QUEUE_URL = config('ENGAGEMENT_QUEUE_URL', default="redis://localhost:6379/1")
+
+# Frames sent to the video summary: "interval" (every 10s) or "scene" (at scene changes)
+FRAME_SAMPLING_MODE = config('FRAME_SAMPLING_MODE', default="interval")
+# ...and how they are encoded for the vision model: "jpeg", "webp" or "png"
+FRAME_IMAGE_FORMAT = config('FRAME_IMAGE_FORMAT', default="jpeg")
+FRAME_IMAGE_QUALITY = config('FRAME_IMAGE_QUALITY', default=80, cast=int)
+FRAME_MAX_DIMENSION = config('FRAME_MAX_DIMENSION', default=768, cast=int)
+
+FFMPEG_BINARY = config('FFMPEG_BINARY', default="ffmpeg")
+
+# MP4 uploads are transcoded into an HLS bitrate ladder by the transcode_hls task (api/hls.py).
+# The renditions are encoded in parallel sharing HLS_THREAD_BUDGET encoder threads (0: all cores)
+HLS_TRANSCODE_ON_UPLOAD = config('HLS_TRANSCODE_ON_UPLOAD', default=True, cast=bool)
+HLS_THREAD_BUDGET = config('HLS_THREAD_BUDGET', default=0, cast=int)
+HLS_UPLOAD_CONCURRENCY = config('HLS_UPLOAD_CONCURRENCY', default=8, cast=int)
+
+# Every process shares one S3 client (api/storage.py); the pool should cover the
+# request threads plus S3_TRANSFER_CONCURRENCY
+S3_MAX_POOL_CONNECTIONS = config('S3_MAX_POOL_CONNECTIONS', default=32, cast=int)
+S3_MAX_RETRIES = config('S3_MAX_RETRIES', default=5, cast=int)
+
+# Uploaded videos are downloaded with concurrent ranged GETs (api/download.py); memory
+# use is bounded by S3_PART_SIZE * S3_MAX_BUFFERED_PARTS
+S3_TRANSFER_CONCURRENCY = config('S3_TRANSFER_CONCURRENCY', default=8, cast=int)
+S3_PART_SIZE = config('S3_PART_SIZE', default=8 * 1024 ** 2, cast=int)
+S3_MAX_BUFFERED_PARTS = config('S3_MAX_BUFFERED_PARTS', default=16, cast=int)
+
+# Local cache of transcriptions, summaries and embeddings keyed by their inputs (api/content_cache.py)
+CONTENT_CACHE_PATH = config('CONTENT_CACHE_PATH', default=str(BASE_DIR / "content_cache.sqlite3"))
+CONTENT_CACHE_MAX_BYTES = config('CONTENT_CACHE_MAX_BYTES', default=1024 ** 3, cast=int)
 
 # SECURITY WARNING: don't run with debug turned on in production!
 DEBUG = True
@@ -14,3 +14,7 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ByteverseProject.settings')
 
 application = get_wsgi_application()
+
+# Load the feed's embedding store now rather than in the first request
+from api.embedding_store import warm_embedding_store  # noqa: E402
+warm_embedding_store()
@@ -0,0 +1,171 @@
+"""
+Approximate nearest-neighbour index over video embeddings (IVF, pure numpy).
+
+Embeddings are clustered with spherical k-means into ~sqrt(n) inverted lists. A query
+only scores the videos in its `n_probe` closest lists, so retrieving the neighbours of
+an interest group costs O(sqrt(n)) dot products instead of O(n).
+
+The index only stores video ids. Vectors are read from the EmbeddingStore that owns
+the index, so there is a single copy of the embedding matrix per process.
+"""
+
+import time
+
+import numpy as np
+
+KMEANS_ITERATIONS = 10
+KMEANS_SAMPLE_SIZE = 20000
+DEFAULT_N_PROBE = 8
+COMPACT_TOMBSTONE_RATIO = 0.2  # compact inverted lists once 20% of entries are deleted
+REBUILD_GROWTH_RATIO = 2.0     # re-cluster once the index doubled since the last build
+
+
+def _normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def top_k(scores, k):
+    """Indices of the k largest scores, best first."""
+    if k >= len(scores):
+        return np.argsort(-scores)
+    top = np.argpartition(-scores, k)[:k]
+    return top[np.argsort(-scores[top])]
+
+
+class IVFIndex:
+    """
+    Inverted-file index keyed by video_id.
+
+    `add` assigns a video to its closest centroid, `remove` tombstones it and the
+    lists are compacted once enough entries are dead. `needs_rebuild` tells the owner
+    when the centroids no longer reflect the catalog.
+    """
+
+    def __init__(self, n_probe=DEFAULT_N_PROBE, seed=0):
+        self.n_probe = n_probe
+        self.seed = seed
+        self.centroids = None
+        self.lists = []          # list_number -> [video_id, ...]
+        self.assignment = {}     # video_id -> list_number
+        self.tombstones = set()
+        self.built_size = 0
+
+    def __len__(self):
+        return len(self.assignment)
+
+    @property
+    def built(self):
+        return self.centroids is not None
+
+    @property
+    def needs_rebuild(self):
+        return not self.built or len(self) > self.built_size * REBUILD_GROWTH_RATIO
+
+    def build(self, video_ids, embeddings):
+        """Cluster `embeddings` (rows aligned with `video_ids`) and fill the inverted lists."""
+        rng = np.random.default_rng(self.seed)
+        n = len(video_ids)
+        n_lists = max(int(np.sqrt(n)), 1)
+
+        sample = embeddings
+        if n > KMEANS_SAMPLE_SIZE:
+            sample = embeddings[rng.choice(n, KMEANS_SAMPLE_SIZE, replace=False)]
+
+        centroids = sample[rng.choice(len(sample), n_lists, replace=False)] if n else np.zeros((1, embeddings.shape[1]))
+        for _ in range(KMEANS_ITERATIONS):
+            labels = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample)
+            empty = ~np.isin(np.arange(len(centroids)), labels)
+            sums[empty] = centroids[empty]  # keep empty clusters where they were
+            centroids = _normalize(sums)
+
+        self.centroids = centroids.astype(embeddings.dtype)
+        self.lists = [[] for _ in range(len(centroids))]
+        self.assignment = {}
+        self.tombstones = set()
+        if n:
+            labels = np.argmax(embeddings @ self.centroids.T, axis=1)
+            for video_id, label in zip(video_ids.tolist(), labels.tolist()):
+                self.lists[label].append(video_id)
+                self.assignment[video_id] = label
+        self.built_size = max(n, 1)
+
+    def add(self, video_id, embedding):
+        """Insert (or re-assign) a single video."""
+        if not self.built:
+            return
+        if video_id in self.assignment:
+            self.lists[self.assignment.pop(video_id)].remove(video_id)
+        elif video_id in self.tombstones:
+            self._compact()
+        label = int(np.argmax(self.centroids @ embedding))
+        self.lists[label].append(video_id)
+        self.assignment[video_id] = label
+
+    def remove(self, video_id):
+        """Tombstone a video; it is skipped by search and dropped on the next compaction."""
+        if self.assignment.pop(video_id, None) is None:
+            return
+        self.tombstones.add(video_id)
+        if len(self.tombstones) > COMPACT_TOMBSTONE_RATIO * max(len(self), 1):
+            self._compact()
+
+    def _compact(self):
+        if not self.tombstones:
+            return
+        self.lists = [[video_id for video_id in ids if video_id not in self.tombstones] for ids in self.lists]
+        self.tombstones = set()
+
+    def probe(self, query, n_probe=None):
+        """Video ids in the `n_probe` lists closest to `query`."""
+        n_probe = min(n_probe or self.n_probe, len(self.lists))
+        closest = top_k(self.centroids @ query, n_probe)
+        return [video_id for label in closest for video_id in self.lists[label] if video_id not in self.tombstones]
+
+    def search(self, query, k, lookup, n_probe=None):
+        """
+        Return the ids of the (approximately) k nearest videos to `query`.
+        `lookup(video_ids)` must return the embedding rows of those ids.
+        """
+        candidate_ids = np.array(self.probe(query, n_probe), dtype=np.int64)
+        if len(candidate_ids) == 0:
+            return candidate_ids
+        scores = lookup(candidate_ids) @ query
+        return candidate_ids[top_k(scores, k)]
+
+
+def measure_recall(store, queries, k=100, n_probe=None):
+    """
+    Recall@k of the store's ANN index against an exact scan, plus the average time
+    per query of both, for the given query vectors.
+    """
+    with store.lock:
+        store.ensure_index()
+        embedded_rows = np.flatnonzero(store.has_embedding)
+        embeddings = store.embeddings[embedded_rows]
+        video_ids = store.video_ids[embedded_rows]
+        recalls = []
+        ann_time = exact_time = 0.0
+
+        for query in queries:
+            query = np.asarray(query, dtype=embeddings.dtype)
+
+            start = time.perf_counter()
+            exact = video_ids[top_k(embeddings @ query, k)]
+            exact_time += time.perf_counter() - start
+
+            start = time.perf_counter()
+            approximate = store.index.search(query, k, store.lookup, n_probe)
+            ann_time += time.perf_counter() - start
+
+            recalls.append(len(set(exact.tolist()) & set(approximate.tolist())) / max(len(exact), 1))
+
+    n = max(len(queries), 1)
+    return {
+        "recall": float(np.mean(recalls)) if recalls else 0.0,
+        "ann_ms": 1000 * ann_time / n,
+        "exact_ms": 1000 * exact_time / n,
+    }
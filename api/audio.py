@@ -0,0 +1,97 @@
+"""
+Audio extraction for transcription.
+
+ffmpeg demuxes only the audio stream and encodes it as low-bitrate mono MP3 straight
+into a pipe, so nothing is decoded except the audio and nothing is written to disk.
+Videos without an audio track are skipped, and long audio is cut into chunks that
+stay well below the transcription API's upload limit (25MB).
+
+probe_video() reads the stream info the same way for hls.py, which needs the size
+the video is displayed at.
+"""
+
+import re
+import subprocess
+
+from django.conf import settings
+
+AUDIO_SAMPLE_RATE = 16000     # what Whisper resamples to anyway
+AUDIO_BITRATE = "32k"         # ~240KB per minute of mono speech
+CHUNK_SECONDS = 20 * 60       # ~4.7MB per chunk
+
+_DURATION = re.compile(r"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)")
+_AUDIO_STREAM = re.compile(r"Stream #\S+.*: Audio:")
+_VIDEO_SIZE = re.compile(r": Video: .*?[ ,](\d{2,})x(\d{2,})\b")
+# Side data of current ffmpeg versions, the stream's rotate tag of older ones
+_ROTATION = re.compile(r"displaymatrix: rotation of (-?\d+(?:\.\d+)?) degrees|^\s*rotate\s*:\s*(-?\d+)", re.MULTILINE)
+
+
+def _ffmpeg():
+    return getattr(settings, "FFMPEG_BINARY", "ffmpeg")
+
+
+def probe_video(video_path):
+    """
+    {"has_audio", "duration" (seconds or None), "width", "height"} of the video, the size
+    as displayed, i.e. swapped when the first video stream is rotated by 90 or 270 degrees.
+    Width and height are None when there is no video stream.
+    """
+    # Without an output ffmpeg prints the stream info and exits with an error
+    info = subprocess.run(
+        [_ffmpeg(), "-hide_banner", "-nostdin", "-i", video_path],
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, errors="replace",
+    ).stderr
+    duration = _DURATION.search(info)
+    if duration:
+        hours, minutes, seconds = duration.groups()
+        duration = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+    width = height = None
+    # One block per stream, the first one with a size is the video stream
+    for stream in info.split("Stream #")[1:]:
+        size = _VIDEO_SIZE.search(stream)
+        if size:
+            width, height = int(size.group(1)), int(size.group(2))
+            rotation = _ROTATION.search(stream)
+            if rotation and round(float(rotation.group(1) or rotation.group(2))) % 180:
+                width, height = height, width
+            break
+    return {"has_audio": bool(_AUDIO_STREAM.search(info)), "duration": duration, "width": width, "height": height}
+
+
+def probe(video_path):
+    """(whether the video has an audio track, duration in seconds or None)."""
+    info = probe_video(video_path)
+    return info["has_audio"], info["duration"]
+
+
+def extract_audio(video_path, start=None, length=None):
+    """The audio track (or `length` seconds of it from `start`) as mono MP3 bytes."""
+    cmd = [_ffmpeg(), "-hide_banner", "-nostdin", "-v", "error"]
+    if start:
+        cmd += ["-ss", str(start)]   # before -i: seeks in the input instead of decoding up to it
+    cmd += ["-i", video_path]
+    if length:
+        cmd += ["-t", str(length)]
+    cmd += ["-vn", "-ac", "1", "-ar", str(AUDIO_SAMPLE_RATE), "-b:a", AUDIO_BITRATE, "-f", "mp3", "pipe:1"]
+    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+    return result.stdout
+
+
+def extract_audio_chunks(video_path, chunk_seconds=CHUNK_SECONDS):
+    """
+    Yield the audio track as MP3 chunks of at most chunk_seconds each. Yields nothing
+    when the video has no audio track.
+    """
+    has_audio, duration = probe(video_path)
+    if not has_audio:
+        return
+    if duration is None or duration <= chunk_seconds:
+        yield extract_audio(video_path)
+        return
+    start = 0
+    while start < duration:
+        chunk = extract_audio(video_path, start, chunk_seconds)
+        if chunk:
+            yield chunk
+        start += chunk_seconds
@@ -0,0 +1,212 @@
+"""
+Content-addressed cache for the results of external AI calls.
+
+Transcriptions, video summaries and embeddings are pure functions of their inputs
+(media bytes, prompt, model), so they are stored under a hash of exactly those
+inputs. Reprocessing a video, a re-upload of the same file or re-embedding the same
+text then costs no API call.
+
+The store is a local SQLite file shared by every process on the host (WAL mode),
+evicting the least recently used entries once it grows past max_bytes. It does not
+need Django, so scripts like save_embeddings.py can use it too.
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "content_cache.sqlite3")
+DEFAULT_MAX_BYTES = 1024 ** 3
+EVICT_TO_RATIO = 0.9  # evict down to 90% of max_bytes so not every insert evicts
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    namespace TEXT NOT NULL,
+    value BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used);
+CREATE TABLE IF NOT EXISTS stats (
+    namespace TEXT PRIMARY KEY,
+    hits INTEGER NOT NULL DEFAULT 0,
+    misses INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO meta (name, value) SELECT 'total_size', COALESCE(SUM(size), 0) FROM entries;
+"""
+
+
+def content_key(*parts):
+    """sha256 over the given str/bytes parts (length-prefixed, so parts cannot run into each other)."""
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode()
+        digest.update(len(part).to_bytes(8, "little"))
+        digest.update(part)
+    return digest.hexdigest()
+
+
+def file_digest(path, chunk_size=1024 * 1024):
+    """sha256 of a file's bytes, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ContentCache:
+    """SQLite key/value store with LRU eviction and per-namespace hit/miss counters."""
+
+    def __init__(self, path=DEFAULT_PATH, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = str(path)
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        with self._connection() as connection:
+            connection.executescript(_SCHEMA)
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def _count(self, connection, namespace, column, amount=1):
+        if amount:
+            connection.execute(
+                f"INSERT INTO stats (namespace, {column}) VALUES (?, ?) "
+                f"ON CONFLICT (namespace) DO UPDATE SET {column} = {column} + excluded.{column}",
+                (namespace, amount),
+            )
+
+    def _resize(self, connection, delta):
+        connection.execute("UPDATE meta SET value = value + ? WHERE name = 'total_size'", (delta,))
+
+    def get(self, namespace, key):
+        """The stored bytes, or None. Counts a hit or miss for `namespace`."""
+        return self.get_many(namespace, [key]).get(key)
+
+    def get_many(self, namespace, keys):
+        """{key: stored bytes} of the keys that are cached, in one transaction."""
+        found = {}
+        with self._connection() as connection:
+            for key in keys:
+                row = connection.execute("SELECT value FROM entries WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    found[key] = row[0]
+            connection.executemany("UPDATE entries SET last_used = ? WHERE key = ?", [(time.time(), key) for key in found])
+            self._count(connection, namespace, "hits", len(found))
+            self._count(connection, namespace, "misses", len(keys) - len(found))
+        return found
+
+    def set(self, namespace, key, value):
+        self.set_many(namespace, {key: value})
+
+    def set_many(self, namespace, items):
+        """Store {key: bytes} in one transaction."""
+        with self._connection() as connection:
+            for key, value in items.items():
+                old = connection.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+                connection.execute(
+                    "INSERT OR REPLACE INTO entries (key, namespace, value, size, last_used) VALUES (?, ?, ?, ?, ?)",
+                    (key, namespace, value, len(value), time.time()),
+                )
+                self._resize(connection, len(value) - (old[0] if old else 0))
+            self._evict(connection)
+
+    def _evict(self, connection):
+        (total,) = connection.execute("SELECT value FROM meta WHERE name = 'total_size'").fetchone()
+        if total <= self.max_bytes:
+            return
+        excess = total - self.max_bytes * EVICT_TO_RATIO
+        evicted = []
+        freed = 0
+        for key, size in connection.execute("SELECT key, size FROM entries ORDER BY last_used"):
+            evicted.append((key,))
+            freed += size
+            if freed >= excess:
+                break
+        connection.executemany("DELETE FROM entries WHERE key = ?", evicted)
+        self._resize(connection, -freed)
+
+    def get_or_compute(self, namespace, key, compute, encode, decode):
+        """decode(cached bytes), or compute(), store encode(result) and return it."""
+        value = self.get(namespace, key)
+        if value is not None:
+            return decode(value)
+        result = compute()
+        self.set(namespace, key, encode(result))
+        return result
+
+    # Typed helpers --------------------------------------------------------
+    def text(self, namespace, key, compute):
+        return self.get_or_compute(namespace, key, compute, str.encode, lambda value: bytes(value).decode())
+
+    def vector(self, namespace, key, compute):
+        return self.get_or_compute(
+            namespace, key, compute,
+            lambda vector: np.asarray(vector, dtype=np.float32).tobytes(),
+            lambda value: np.frombuffer(value, dtype=np.float32),
+        )
+
+    def stats(self):
+        """{namespace: {"hits", "misses", "hit_rate", "entries", "bytes"}}."""
+        with self._connection() as connection:
+            stats = {
+                namespace: {"hits": hits, "misses": misses, "entries": 0, "bytes": 0}
+                for namespace, hits, misses in connection.execute("SELECT namespace, hits, misses FROM stats")
+            }
+            for namespace, entries, size in connection.execute(
+                "SELECT namespace, COUNT(*), SUM(size) FROM entries GROUP BY namespace"
+            ):
+                stats.setdefault(namespace, {"hits": 0, "misses": 0})
+                stats[namespace].update(entries=entries, bytes=size)
+        for namespace_stats in stats.values():
+            lookups = namespace_stats["hits"] + namespace_stats["misses"]
+            namespace_stats["hit_rate"] = namespace_stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+    def reset_stats(self):
+        with self._connection() as connection:
+            connection.execute("DELETE FROM stats")
+
+    def clear(self):
+        with self._connection() as connection:
+            connection.execute("DELETE FROM entries")
+            connection.execute("UPDATE meta SET value = 0 WHERE name = 'total_size'")
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_content_cache():
+    """This process's ContentCache, configured from Django settings when available."""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                path = os.environ.get("CONTENT_CACHE_PATH", DEFAULT_PATH)
+                max_bytes = int(os.environ.get("CONTENT_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES))
+                try:
+                    from django.conf import settings
+                    if settings.configured:
+                        path = getattr(settings, "CONTENT_CACHE_PATH", path)
+                        max_bytes = getattr(settings, "CONTENT_CACHE_MAX_BYTES", max_bytes)
+                except ImportError:
+                    pass
+                _cache = ContentCache(path, max_bytes)
+    return _cache
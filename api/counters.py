@@ -0,0 +1,48 @@
+"""
+PostRecord engagement counters (views, likes, comments, total_watch_time).
+
+Counters are only ever changed with UPDATE ... SET column = column + n on the affected
+columns. A read-modify-write followed by video.save() loses concurrent updates and
+rewrites every column of the row, embedding included, for a single like.
+"""
+
+from django.db.models import Case, F, IntegerField, Value, When
+
+from .models import PostRecord
+
+COUNTER_FIELDS = ("views", "likes", "comments", "total_watch_time")
+
+
+def increment_counter(video_id, column, amount=1):
+    """Add `amount` to one counter of one video. Returns False if the video does not exist."""
+    if column not in COUNTER_FIELDS:
+        raise ValueError(f"{column} is not a counter")
+    return PostRecord.objects.filter(video_id=video_id).update(**{column: F(column) + amount}) > 0
+
+
+def increment_counters(deltas):
+    """
+    Add per-video counter deltas ({video_id: {"views": 1, ...}}) with a single UPDATE
+    of only the affected columns.
+    """
+    deltas = {video_id: delta for video_id, delta in deltas.items() if any(delta.values())}
+    if not deltas:
+        return
+    columns = {column for delta in deltas.values() for column in delta}
+    if not columns <= set(COUNTER_FIELDS):
+        raise ValueError(f"{', '.join(columns - set(COUNTER_FIELDS))} are not counters")
+    if len(deltas) == 1:
+        ((video_id, delta),) = deltas.items()
+        PostRecord.objects.filter(video_id=video_id).update(
+            **{column: F(column) + amount for column, amount in delta.items()}
+        )
+        return
+    updates = {
+        column: F(column) + Case(
+            *[When(video_id=video_id, then=Value(delta.get(column, 0))) for video_id, delta in deltas.items()],
+            default=Value(0),
+            output_field=IntegerField(),
+        )
+        for column in columns
+    }
+    PostRecord.objects.filter(video_id__in=deltas.keys()).update(**updates)
@@ -1,16 +1,164 @@
+import io
 import os
 import subprocess
 import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
 
 from django.conf import settings
-import boto3
 
-s3_client = boto3.client(
-    "s3",
-    aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-    aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
-)
+from .audio import AUDIO_BITRATE, AUDIO_SAMPLE_RATE, CHUNK_SECONDS, _ffmpeg
+from .storage import get_s3_client
+
+
+class S3RangeStream(io.RawIOBase):
+    """
+    Read-only, in-order stream of an S3 object fetched with concurrent ranged GETs.
+
+    Up to `concurrency` parts of `part_size` bytes are requested at once, and at most
+    `max_buffered_parts` parts are held in memory (in flight or fetched but not read
+    yet), so a slow reader pauses the download instead of buffering the whole object.
+    """
+
+    def __init__(self, bucket, key, client=None, part_size=None, concurrency=None, max_buffered_parts=None):
+        self.client = client or get_s3_client()
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size or settings.S3_PART_SIZE
+        concurrency = concurrency or settings.S3_TRANSFER_CONCURRENCY
+        self.max_buffered_parts = max(max_buffered_parts or settings.S3_MAX_BUFFERED_PARTS, concurrency)
+        self.size = self.client.head_object(Bucket=bucket, Key=key)["ContentLength"]
+        self._executor = ThreadPoolExecutor(concurrency, thread_name_prefix="s3-range")
+        self._parts = deque()      # futures of the next parts, in order
+        self._next_offset = 0      # first byte not requested yet
+        self._current = memoryview(b"")
+        self._fill()
+
+    def readable(self):
+        return True
+
+    def _fetch(self, start, end):
+        response = self.client.get_object(Bucket=self.bucket, Key=self.key, Range=f"bytes={start}-{end}")
+        return response["Body"].read()
+
+    def _fill(self):
+        while len(self._parts) < self.max_buffered_parts and self._next_offset < self.size:
+            end = min(self._next_offset + self.part_size, self.size) - 1
+            self._parts.append(self._executor.submit(self._fetch, self._next_offset, end))
+            self._next_offset = end + 1
+
+    def readinto(self, buffer):
+        if not self._current:
+            if not self._parts:
+                return 0
+            self._current = memoryview(self._parts.popleft().result())
+            self._fill()
+        n = min(len(buffer), len(self._current))
+        buffer[:n] = self._current[:n]
+        self._current = self._current[n:]
+        return n
+
+    def parts(self):
+        """Yield the object part by part (fewer copies than read())."""
+        if self._current:
+            yield bytes(self._current)
+            self._current = memoryview(b"")
+        while self._parts:
+            part = self._parts.popleft().result()
+            self._fill()
+            yield part
+
+    def close(self):
+        for future in self._parts:
+            future.cancel()
+        self._parts.clear()
+        self._executor.shutdown(wait=False)
+        super().close()
+
+
+def _faststart(head):
+    """Whether an MP4/MOV's index (moov box) comes before the media data, from its first bytes."""
+    offset = 0
+    while offset + 8 <= len(head):
+        size = int.from_bytes(head[offset:offset + 4], "big")
+        box = head[offset + 4:offset + 8]
+        if box == b"moov":
+            return True
+        if box == b"mdat":
+            return False
+        if size == 1 and offset + 16 <= len(head):
+            size = int.from_bytes(head[offset + 8:offset + 16], "big")
+        if size < 8:
+            return False
+        offset += size
+    return False
+
+
+def prefetched_audio_chunks(video_path):
+    """Audio chunks extracted while `video_path` was being downloaded (see stream_s3_object), in order."""
+    directory, name = os.path.split(video_path)
+    prefix = f"{name}.audio-"
+    chunks = sorted(entry for entry in os.listdir(directory or ".") if entry.startswith(prefix))
+    return [os.path.join(directory, entry) for entry in chunks]
+
+
+def _start_audio_extraction(video_path):
+    """ffmpeg reading the video from stdin and writing the audio as CHUNK_SECONDS MP3 segments next to it."""
+    return subprocess.Popen(
+        [_ffmpeg(), "-hide_banner", "-nostdin", "-v", "error", "-i", "pipe:0",
+         "-vn", "-ac", "1", "-ar", str(AUDIO_SAMPLE_RATE), "-b:a", AUDIO_BITRATE,
+         "-f", "segment", "-segment_time", str(CHUNK_SECONDS), f"{video_path}.audio-%03d.mp3"],
+        stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+
+
+def stream_s3_object(bucket, key, out_file, extract_audio=True, **stream_options):
+    """
+    Download an S3 object to out_file with concurrent ranged GETs.
+
+    When the video is "faststart" (index first, as exported by phones and ffmpeg
+    -movflags +faststart) and extract_audio is set, its bytes are also piped into
+    ffmpeg as they arrive, so the audio for transcription is ready together with the
+    file (see prefetched_audio_chunks). Otherwise audio is extracted later from the file.
+    """
+    stream = S3RangeStream(bucket, key, **stream_options)
+    ffmpeg = None
+    try:
+        with open(out_file, "wb") as f:
+            for i, part in enumerate(stream.parts()):
+                if i == 0 and extract_audio and _faststart(part):
+                    ffmpeg = _start_audio_extraction(out_file)
+                f.write(part)
+                if ffmpeg is not None:
+                    try:
+                        ffmpeg.stdin.write(part)
+                    except BrokenPipeError:
+                        ffmpeg = _discard_audio(ffmpeg, out_file)
+    except BaseException:
+        if ffmpeg is not None:
+            _discard_audio(ffmpeg, out_file)
+        raise
+    finally:
+        stream.close()
+
+    if ffmpeg is not None:
+        try:
+            ffmpeg.stdin.close()
+        except BrokenPipeError:
+            pass
+        if ffmpeg.wait() != 0:
+            # e.g. no audio track: transcription falls back to reading the file
+            _discard_audio(ffmpeg, out_file)
+    return out_file
+
+
+def _discard_audio(ffmpeg, video_path):
+    ffmpeg.kill()
+    ffmpeg.wait()
+    for chunk in prefetched_audio_chunks(video_path):
+        os.remove(chunk)
+    return None
 
 def tmp_path(suffix: str) -> str:
     """Return an absolute temp file path with the wanted suffix."""
@@ -19,7 +167,7 @@ def tmp_path(suffix: str) -> str:
 
 def download_asset(url: str) -> str | None:
     """
-    • If the URL is inside your S3 bucket → download via boto3.
+    • If the URL is inside your S3 bucket → download via ranged GETs (stream_s3_object).
     • If it ends in `.m3u8`               → use ffmpeg to pull the HLS stream.
     • Otherwise                           → give up (return None).
     Returns the *local* file path or None on failure.
@@ -27,7 +175,7 @@ def download_asset(url: str) -> str | None:
     if url.endswith(".m3u8"):
         out_file = tmp_path(".mp4")
         cmd = [
-            "ffmpeg",
+            _ffmpeg(),
             "-y",                # overwrite if exists
             "-i", url,           # input
             "-c", "copy",        # no re-encode → fast
@@ -46,9 +194,15 @@ def download_asset(url: str) -> str | None:
         key = url[len(prefix):]
         out_file = tmp_path(".mp4")
         try:
-            s3_client.download_file(bucket, key, out_file)
-            return out_file
+            return stream_s3_object(bucket, key, out_file)
         except Exception:
+            cleanup_download(out_file)
             return None
 
     return None
+
+def cleanup_download(video_path):
+    """Remove a downloaded video and any audio extracted while downloading it."""
+    for path in [video_path] + prefetched_audio_chunks(video_path):
+        if os.path.exists(path):
+            os.remove(path)
@@ -0,0 +1,414 @@
+"""
+Process-resident store of every video's embedding and ranking metadata.
+
+Ranking the feed used to load every PostRecord and turn its JSON embedding into a
+fresh numpy array per interest group. The store keeps one contiguous float32 matrix
+of all embeddings plus parallel arrays of the counters calculate_video_ranks needs,
+so a feed request is a single matrix product over the whole catalog.
+
+The store is refreshed incrementally:
+    • notify_video_changed(video_id) appends the id to a change log kept in the
+      shared cache (Redis). Every process replays the log on its next sync() and
+      re-reads only those rows (a row that no longer exists is dropped).
+    • Counters (views/likes/comments) are refreshed in bulk every
+      COUNTER_REFRESH_SECONDS, which also picks up rows created or deleted without
+      a notification (e.g. cascaded account deletes). sync() hands this to a
+      background thread and the table is read without holding the lock, so
+      requests neither wait for the scan nor block on it.
+
+warm_embedding_store() loads the store when a web or Celery worker starts (see
+wsgi.py and celery.py), so the first request does not pay for the full load.
+
+Once the catalog is large, candidates() narrows ranking down to the ANN neighbours of
+each interest group plus the newest and most engaging videos (see ann_index.py).
+"""
+
+import logging
+import threading
+import time
+
+import numpy as np
+from django.core.cache import cache
+from django.db import connection, connections
+
+from .ann_index import IVFIndex, top_k
+from .models import PostRecord
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_DIM = 1536        # text-embedding-3-small
+EMBEDDING_DTYPE = np.float32
+
+COUNTER_REFRESH_SECONDS = 60
+MAX_INCREMENTAL_CHANGES = 1000  # replaying more than this is slower than a reload
+
+ANN_MIN_CATALOG_SIZE = 5000  # below this an exact scan is cheap enough
+ANN_NEIGHBOURS = 200         # neighbours retrieved per interest group
+RECENT_SLICE = 200           # newest videos always considered
+POPULAR_SLICE = 200          # most engaging videos always considered
+
+CHANGE_LOG_VERSION_KEY = "embedding_store_version"
+CHANGE_LOG_ENTRY_KEY = "embedding_store_change_{}"
+CHANGE_LOG_TIMEOUT = 60 * 60 * 24
+
+_ROW_FIELDS = ('video_id', 'user_id', 'views', 'likes', 'comments', 'date_uploaded', 'embedding')
+_COUNTER_FIELDS = ('video_id', 'user_id', 'views', 'likes', 'comments')
+
+
+def notify_video_changed(video_id):
+    """Record that a video was created, re-embedded or deleted so every store re-reads it."""
+    try:
+        version = cache.incr(CHANGE_LOG_VERSION_KEY)
+    except ValueError:
+        cache.add(CHANGE_LOG_VERSION_KEY, 0, None)
+        version = cache.incr(CHANGE_LOG_VERSION_KEY)
+    cache.set(CHANGE_LOG_ENTRY_KEY.format(version), int(video_id), CHANGE_LOG_TIMEOUT)
+
+
+def notify_videos_changed(video_ids):
+    """notify_video_changed for many videos with one counter bump and one write."""
+    video_ids = [int(video_id) for video_id in video_ids]
+    if not video_ids:
+        return
+    try:
+        version = cache.incr(CHANGE_LOG_VERSION_KEY, len(video_ids))
+    except ValueError:
+        cache.add(CHANGE_LOG_VERSION_KEY, 0, None)
+        version = cache.incr(CHANGE_LOG_VERSION_KEY, len(video_ids))
+    first = version - len(video_ids) + 1
+    cache.set_many({CHANGE_LOG_ENTRY_KEY.format(first + i): video_id for i, video_id in enumerate(video_ids)}, CHANGE_LOG_TIMEOUT)
+
+
+def get_catalog_version():
+    """Current change log version, anything ranked at an older version may miss changes."""
+    return cache.get(CHANGE_LOG_VERSION_KEY) or 0
+
+
+def changed_video_ids(since_version, until_version):
+    """
+    Ids of the videos changed after `since_version` up to `until_version`, or None when
+    that part of the log is too long or no longer (or not yet) complete.
+    """
+    keys = [CHANGE_LOG_ENTRY_KEY.format(v) for v in range(since_version + 1, until_version + 1)]
+    if len(keys) > MAX_INCREMENTAL_CHANGES:
+        return None
+    changes = cache.get_many(keys)
+    if len(changes) < len(keys):
+        return None
+    return set(changes.values())
+
+
+class EmbeddingStore:
+    """
+    Contiguous arrays of every PostRecord's embedding and ranking metadata.
+
+    Row i of `embeddings` belongs to `video_ids[i]`. Rows are appended at the end and
+    removed by moving the last row into the hole, so neither operation copies the
+    matrix. Hold `lock` while reading the arrays.
+    """
+
+    def __init__(self, dim=EMBEDDING_DIM, dtype=EMBEDDING_DTYPE):
+        self.lock = threading.RLock()
+        self.dim = dim
+        self.dtype = dtype
+        self.loaded = False
+        self.version = 0
+        self._last_counter_refresh = 0.0
+        self._counter_refresh = None  # background thread, see sync()
+        self._touched = None  # ids upserted while a counter refresh reads the table
+        self._reset(0)
+
+    def _reset(self, capacity):
+        self.size = 0
+        self._rows = {}  # video_id -> row
+        self._embeddings = np.zeros((capacity, self.dim), dtype=self.dtype)
+        self._has_embedding = np.zeros(capacity, dtype=bool)
+        self._video_ids = np.zeros(capacity, dtype=np.int64)
+        self._user_ids = np.zeros(capacity, dtype=np.int64)
+        self._views = np.zeros(capacity, dtype=np.int64)
+        self._likes = np.zeros(capacity, dtype=np.int64)
+        self._comments = np.zeros(capacity, dtype=np.int64)
+        self._date_uploaded = np.zeros(capacity, dtype=np.float64)  # unix timestamp
+        self.index = IVFIndex()
+
+    # ------------------------------------------------------------------ #
+    # Read access (hold self.lock) -------------------------------------- #
+    # ------------------------------------------------------------------ #
+    @property
+    def embeddings(self):
+        return self._embeddings[:self.size]
+
+    @property
+    def has_embedding(self):
+        return self._has_embedding[:self.size]
+
+    @property
+    def video_ids(self):
+        return self._video_ids[:self.size]
+
+    @property
+    def user_ids(self):
+        return self._user_ids[:self.size]
+
+    @property
+    def views(self):
+        return self._views[:self.size]
+
+    @property
+    def likes(self):
+        return self._likes[:self.size]
+
+    @property
+    def comments(self):
+        return self._comments[:self.size]
+
+    @property
+    def date_uploaded(self):
+        return self._date_uploaded[:self.size]
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, video_id):
+        return video_id in self._rows
+
+    def rows_of(self, video_ids):
+        return np.fromiter((self._rows[video_id] for video_id in video_ids), dtype=np.int64, count=len(video_ids))
+
+    def lookup(self, video_ids):
+        """Embedding rows of the given video ids."""
+        return self._embeddings[self.rows_of(video_ids)]
+
+    # ------------------------------------------------------------------ #
+    # Candidate retrieval (hold self.lock) ------------------------------ #
+    # ------------------------------------------------------------------ #
+    def ensure_index(self):
+        """(Re)build the ANN index when it is missing or the catalog outgrew it."""
+        if self.index.needs_rebuild:
+            rows = np.flatnonzero(self.has_embedding)
+            self.index.build(self.video_ids[rows], self.embeddings[rows])
+
+    def retrieve(self, user_interests, neighbours=ANN_NEIGHBOURS):
+        """
+        Rows worth ranking for these interests: the ANN neighbours of every interest
+        group, the newest and most engaging videos, and videos not embedded yet.
+        """
+        self.ensure_index()
+        rows = [np.flatnonzero(~self.has_embedding)]
+
+        for interest_group in user_interests:
+            if len(interest_group["embedding"]) != self.dim:
+                continue
+            query = np.asarray(interest_group["embedding"], dtype=self.dtype)
+            rows.append(self.rows_of(self.index.search(query, neighbours, self.lookup)))
+
+        engagement_rates = np.divide(self.likes + self.comments, self.views,
+                                     out=np.zeros(self.size), where=self.views > 0)
+        rows.append(top_k(self.date_uploaded, RECENT_SLICE))
+        rows.append(top_k(engagement_rates, POPULAR_SLICE))
+
+        return np.unique(np.concatenate(rows))
+
+    def candidates(self, user_interests, exclude_ids=(), minimum=0):
+        """
+        The videos to rank for a user: the whole store while it is small, otherwise the
+        retrieved subset, falling back to the whole store when fewer than `minimum`
+        retrieved videos are outside `exclude_ids`.
+        """
+        if self.size < ANN_MIN_CATALOG_SIZE:
+            return self
+        rows = self.retrieve(user_interests)
+        if np.count_nonzero(~np.isin(self.video_ids[rows], list(exclude_ids))) < minimum:
+            return self
+        return Candidates(self, rows)
+
+    # ------------------------------------------------------------------ #
+    # Refresh ----------------------------------------------------------- #
+    # ------------------------------------------------------------------ #
+    def sync(self):
+        """Bring the store up to date with the change log, reloading from scratch if needed."""
+        with self.lock:
+            remote_version = get_catalog_version()
+
+            if not self.loaded or remote_version < self.version:
+                self.reload(remote_version)
+            elif remote_version > self.version:
+                changed = changed_video_ids(self.version, remote_version)
+                if changed is None:
+                    # Part of the log expired or was never written, start over
+                    self.reload(remote_version)
+                else:
+                    self.refresh_rows(changed)
+                    self.version = remote_version
+
+            # A forked process sees its parent's thread as stopped and starts its own
+            if (time.monotonic() - self._last_counter_refresh > COUNTER_REFRESH_SECONDS
+                    and not (self._counter_refresh and self._counter_refresh.is_alive())):
+                self._counter_refresh = threading.Thread(target=self._refresh_counters_in_background, daemon=True)
+                self._counter_refresh.start()
+
+    def reload(self, version=None):
+        """Load every PostRecord into freshly allocated arrays."""
+        with self.lock:
+            if version is None:
+                version = get_catalog_version()
+            self._reset(max(PostRecord.objects.count(), 1))
+            for row in PostRecord.objects.values_list(*_ROW_FIELDS).iterator(chunk_size=500):
+                self._upsert(*row)
+            self.version = version
+            self.loaded = True
+            self._last_counter_refresh = time.monotonic()
+
+    def refresh_rows(self, video_ids):
+        """Re-read the given videos, dropping the ones that no longer exist."""
+        with self.lock:
+            found = set()
+            for row in PostRecord.objects.filter(video_id__in=video_ids).values_list(*_ROW_FIELDS):
+                self._upsert(*row)
+                found.add(row[0])
+            for video_id in set(video_ids) - found:
+                self._remove(video_id)
+
+    def refresh_counters(self):
+        """
+        Refresh views/likes/comments of every row and reconcile created or deleted videos.
+        The table is read without the lock; rows upserted meanwhile are newer and kept.
+        """
+        with self.lock:
+            self._touched = set()
+        try:
+            counters = np.array(
+                list(PostRecord.objects.values_list(*_COUNTER_FIELDS).iterator(chunk_size=2000)), dtype=np.int64
+            ).reshape(-1, len(_COUNTER_FIELDS))
+            with self.lock:
+                touched = self._touched
+                seen = set(counters[:, 0].tolist())
+                rows = np.fromiter(
+                    (-1 if video_id in touched else self._rows.get(video_id, -1) for video_id in counters[:, 0].tolist()),
+                    dtype=np.int64, count=len(counters),
+                )
+                known = rows >= 0
+                rows = rows[known]
+                self._user_ids[rows] = counters[known, 1]
+                self._views[rows] = counters[known, 2]
+                self._likes[rows] = counters[known, 3]
+                self._comments[rows] = counters[known, 4]
+
+                for video_id in set(self._rows) - seen - touched:
+                    self._remove(video_id)
+                missing = [video_id for video_id in seen - touched if video_id not in self._rows]
+                self._last_counter_refresh = time.monotonic()
+        finally:
+            with self.lock:
+                self._touched = None
+        if missing:
+            self.refresh_rows(missing)
+
+    def _refresh_counters_in_background(self):
+        try:
+            self.refresh_counters()
+        except Exception:
+            logger.exception("[ERROR] Refreshing embedding store counters failed")
+            self._last_counter_refresh = time.monotonic()  # try again after the usual interval
+        finally:
+            connection.close()  # this thread's connection
+
+    # ------------------------------------------------------------------ #
+    # Row operations ---------------------------------------------------- #
+    # ------------------------------------------------------------------ #
+    def _grow(self):
+        capacity = max(2 * len(self._video_ids), 16)
+        for name in ('_embeddings', '_has_embedding', '_video_ids', '_user_ids',
+                     '_views', '_likes', '_comments', '_date_uploaded'):
+            old = getattr(self, name)
+            new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, name, new)
+
+    def _upsert(self, video_id, user_id, views, likes, comments, date_uploaded, embedding):
+        if self._touched is not None:
+            self._touched.add(video_id)
+        row = self._rows.get(video_id)
+        if row is None:
+            if self.size == len(self._video_ids):
+                self._grow()
+            row = self.size
+            self.size += 1
+            self._rows[video_id] = row
+
+        has_embedding = embedding is not None and len(embedding) == self.dim
+        self._embeddings[row] = embedding if has_embedding else 0
+        self._has_embedding[row] = has_embedding
+        self._video_ids[row] = video_id
+        self._user_ids[row] = user_id
+        self._views[row] = views
+        self._likes[row] = likes
+        self._comments[row] = comments
+        self._date_uploaded[row] = date_uploaded.timestamp()
+
+        if has_embedding:
+            self.index.add(video_id, self._embeddings[row])
+        else:
+            self.index.remove(video_id)
+
+    def _remove(self, video_id):
+        if self._touched is not None:
+            self._touched.add(video_id)
+        row = self._rows.pop(video_id, None)
+        if row is None:
+            return
+        self.index.remove(video_id)
+        last = self.size - 1
+        if row != last:
+            for array in (self._embeddings, self._has_embedding, self._video_ids, self._user_ids,
+                          self._views, self._likes, self._comments, self._date_uploaded):
+                array[row] = array[last]
+            self._rows[int(self._video_ids[row])] = row
+        self.size -= 1
+
+
+class Candidates:
+    """A subset of an EmbeddingStore's rows, copied out so it can be ranked on its own."""
+
+    def __init__(self, store, rows):
+        self.embeddings = store.embeddings[rows]
+        self.has_embedding = store.has_embedding[rows]
+        self.video_ids = store.video_ids[rows]
+        self.user_ids = store.user_ids[rows]
+        self.views = store.views[rows]
+        self.likes = store.likes[rows]
+        self.comments = store.comments[rows]
+        self.date_uploaded = store.date_uploaded[rows]
+
+    def __len__(self):
+        return len(self.video_ids)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_embedding_store():
+    """Return this process's EmbeddingStore, creating it on first use."""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = EmbeddingStore()
+    return _store
+
+
+def warm_embedding_store():
+    """Load this process's store ahead of the first request; failures are logged, not raised."""
+    start = time.perf_counter()
+    try:
+        store = get_embedding_store()
+        with store.lock:
+            store.sync()
+            if len(store) >= ANN_MIN_CATALOG_SIZE:
+                store.ensure_index()
+        logger.info(f"[INFO] Embedding store loaded: {len(store)} videos in {time.perf_counter() - start:.1f}s")
+    except Exception:
+        logger.exception("[ERROR] Warming the embedding store failed, the first request will load it")
+    finally:
+        connections.close_all()  # workers may fork after this, they must not share the connection
@@ -0,0 +1,194 @@
+"""
+Embedding service: batched, coalescing client for the OpenAI embeddings endpoint.
+
+embed(text) does not send its own request. Calls made within COALESCE_WINDOW of each
+other (from any thread) are queued and sent together as one batched request, up to
+the endpoint's input limits. embed_many(texts) is the bulk API for backfills: it
+splits the texts into full batches and sends up to max_concurrency of them at once.
+
+Both check the content cache first (see content_cache.py), so only texts that were
+never embedded with this model reach the API. On a rate-limit error every worker
+backs off until the cooldown (Retry-After, or exponential) has passed.
+
+Like content_cache.py this module does not need Django, so scripts can use it.
+"""
+
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import numpy as np
+
+from .content_cache import content_key, get_content_cache
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+MAX_BATCH_INPUTS = 2048         # inputs per request accepted by the endpoint
+MAX_BATCH_CHARS = 400_000       # keeps a request well below the ~300k token limit
+COALESCE_WINDOW = 0.02          # seconds embed() waits for more texts to batch with
+MAX_CONCURRENCY = 4             # batched requests in flight
+MAX_RETRIES = 6
+BACKOFF_BASE = 1.0              # seconds, doubled per retry unless the API says otherwise
+
+
+def _is_rate_limit(error):
+    return getattr(error, "status_code", None) == 429 or type(error).__name__ == "RateLimitError"
+
+
+def _retry_after(error, attempt):
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return BACKOFF_BASE * 2 ** attempt
+
+
+class EmbeddingClient:
+    """Coalescing, batching front of `client.embeddings.create` for one model."""
+
+    def __init__(self, client, model=EMBEDDING_MODEL, max_concurrency=MAX_CONCURRENCY,
+                 coalesce_window=COALESCE_WINDOW, cache=None):
+        self.client = client
+        self.model = model
+        self.coalesce_window = coalesce_window
+        self.cache = cache
+        self.requests = 0            # API round trips, including retries
+        self._pending = queue.Queue()
+        self._executor = ThreadPoolExecutor(max_concurrency, thread_name_prefix="embeddings")
+        self._cooldown_until = 0.0
+        self._lock = threading.Lock()
+        self._dispatcher = None
+
+    # ------------------------------------------------------------------ #
+    # Public API ---------------------------------------------------------- #
+    # ------------------------------------------------------------------ #
+    def embed(self, text):
+        """Embedding of one text; concurrent calls share a request."""
+        key = content_key(self.model, text)
+        if self.cache is not None:
+            value = self.cache.get("embedding", key)
+            if value is not None:
+                return np.frombuffer(value, dtype=np.float32)
+
+        future = Future()
+        self._ensure_dispatcher()
+        self._pending.put((text, future))
+        embedding = future.result()
+        if self.cache is not None:
+            self.cache.set("embedding", key, embedding.astype(np.float32).tobytes())
+        return embedding
+
+    def embed_many(self, texts):
+        """Embeddings of all texts as an (n, dim) array, in order, using as few requests as possible."""
+        texts = list(texts)
+        keys = [content_key(self.model, text) for text in texts]
+        results = {}
+        if self.cache is not None:
+            for key, value in self.cache.get_many("embedding", list(set(keys))).items():
+                results[key] = np.frombuffer(value, dtype=np.float32)
+
+        missing = list({key: text for key, text in zip(keys, texts) if key not in results}.items())
+        futures = [
+            (batch, self._executor.submit(self._request, [text for _, text in batch]))
+            for batch in self._batches(missing, text=lambda item: item[1])
+        ]
+        for batch, future in futures:
+            embedded = dict(zip([key for key, _ in batch], future.result()))
+            results.update(embedded)
+            if self.cache is not None:
+                self.cache.set_many("embedding", {key: embedding.astype(np.float32).tobytes() for key, embedding in embedded.items()})
+
+        if not texts:
+            return np.zeros((0, 0), dtype=np.float32)
+        return np.stack([results[key] for key in keys])
+
+    # ------------------------------------------------------------------ #
+    # Batching ------------------------------------------------------------ #
+    # ------------------------------------------------------------------ #
+    @staticmethod
+    def _batches(items, text=lambda item: item):
+        batch, chars = [], 0
+        for item in items:
+            length = len(text(item))
+            if batch and (len(batch) == MAX_BATCH_INPUTS or chars + length > MAX_BATCH_CHARS):
+                yield batch
+                batch, chars = [], 0
+            batch.append(item)
+            chars += length
+        if batch:
+            yield batch
+
+    def _ensure_dispatcher(self):
+        if self._dispatcher is None:
+            with self._lock:
+                if self._dispatcher is None:
+                    self._dispatcher = threading.Thread(target=self._dispatch, name="embedding-dispatcher", daemon=True)
+                    self._dispatcher.start()
+
+    def _dispatch(self):
+        """Collect queued embed() calls for COALESCE_WINDOW and send them as batches."""
+        while True:
+            items = [self._pending.get()]
+            deadline = time.monotonic() + self.coalesce_window
+            while len(items) < MAX_BATCH_INPUTS:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    items.append(self._pending.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            for batch in self._batches(items, text=lambda item: item[0]):
+                self._executor.submit(self._resolve, batch)
+
+    def _resolve(self, batch):
+        try:
+            embeddings = self._request([text for text, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for (_, future), embedding in zip(batch, embeddings):
+            future.set_result(embedding)
+
+    def _request(self, texts):
+        """One embeddings request, retried on rate limits."""
+        for attempt in range(MAX_RETRIES + 1):
+            wait = self._cooldown_until - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                with self._lock:
+                    self.requests += 1
+                response = self.client.embeddings.create(input=texts, model=self.model)
+                data = sorted(response.data, key=lambda item: item.index)
+                return [np.array(item.embedding) for item in data]
+            except Exception as e:
+                if not _is_rate_limit(e) or attempt == MAX_RETRIES:
+                    raise
+                # Every worker waits, not just the one that hit the limit
+                with self._lock:
+                    self._cooldown_until = max(self._cooldown_until, time.monotonic() + _retry_after(e, attempt))
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_embedding_client(model=EMBEDDING_MODEL):
+    """This process's EmbeddingClient for `model`, using the content cache."""
+    if model not in _clients:
+        with _clients_lock:
+            if model not in _clients:
+                from openai import OpenAI
+                api_key = os.environ.get("OPENAI_API_KEY")
+                try:
+                    from django.conf import settings
+                    if settings.configured:
+                        api_key = settings.OPENAI_API_KEY
+                except ImportError:
+                    pass
+                _clients[model] = EmbeddingClient(OpenAI(api_key=api_key), model, cache=get_content_cache())
+    return _clients[model]
@@ -0,0 +1,215 @@
+"""
+Batched engagement ingestion.
+
+A client used to report every watched video with its own request, each doing a
+ViewedPosts get_or_create, a full PostRecord save and a full rewrite of the UserData
+interest blob. apply_engagement_events() takes a batch of events of one user, applies
+every engagement to the interest groups in memory and persists everything in a single
+transaction: one bulk_create for the new views, one counter UPDATE (counters.py) for all
+touched videos and one UserData save.
+
+apply_like_events() does the same for likes of any number of users: only the last
+like/unlike of each user and video counts, and the like counters of all videos are
+adjusted by one UPDATE.
+
+Both record the ids of the events they apply (ProcessedEngagementEvent, unique per user
+and event id) in the transaction that applies them and skip ids already recorded, so
+an event is applied exactly once however often the queue delivers it or the client
+retries the request.
+"""
+
+import math
+from datetime import timedelta
+from functools import reduce
+from operator import or_
+
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .counters import increment_counters
+from .models import LikedPosts, PostRecord, ProcessedEngagementEvent, UserData, ViewedPosts
+from .rank_video import apply_engagement, calculate_engagement_score
+
+MAX_ENGAGEMENT_BATCH = 200
+MAX_WATCH_TIME = 24 * 60 * 60   # seconds, anything longer is a client bug
+MAX_EVENT_ID_LENGTH = 64
+PROCESSED_EVENT_RETENTION = timedelta(days=1)  # how long retried requests are recognised
+
+_TRUE = {"true", "1", "yes"}
+_FALSE = {"false", "0", "no", ""}
+
+
+def parse_flag(value, name):
+    """A boolean from JSON (true/false, 0/1) or form data ("true"/"false")."""
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, int) and value in (0, 1):
+        return bool(value)
+    if isinstance(value, str) and value.strip().lower() in _TRUE | _FALSE:
+        return value.strip().lower() in _TRUE
+    raise ValueError(f"{name} must be a boolean.")
+
+
+def parse_watch_time(value):
+    """Seconds watched as a float."""
+    if isinstance(value, bool):
+        raise ValueError("watch_time must be a number of seconds.")
+    try:
+        watch_time = float(value)
+    except (TypeError, ValueError):
+        raise ValueError("watch_time must be a number of seconds.")
+    if not math.isfinite(watch_time) or not 0 <= watch_time <= MAX_WATCH_TIME:
+        raise ValueError(f"watch_time must be between 0 and {MAX_WATCH_TIME} seconds.")
+    return watch_time
+
+
+def parse_event_id(value):
+    """A client-supplied event id as a string, or None to have one generated."""
+    if value is None:
+        return None
+    if not isinstance(value, (str, int)) or isinstance(value, bool) or not 0 < len(str(value)) <= MAX_EVENT_ID_LENGTH:
+        raise ValueError(f"event_id must be a string of at most {MAX_EVENT_ID_LENGTH} characters.")
+    return str(value)
+
+
+def parse_engagement_event(data):
+    """
+    Validate and normalize one engagement event (a dict shaped like the
+    update_posts_engagement body). Raises ValueError with a message for the client.
+    """
+    if not isinstance(data, dict):
+        raise ValueError("Every event must be an object.")
+    if data.get("video_id") is None:
+        raise ValueError("video_id is required.")
+    try:
+        video_id = int(data["video_id"])
+    except (TypeError, ValueError):
+        raise ValueError("video_id must be an integer.")
+    return {
+        "video_id": video_id,
+        "watch_time": parse_watch_time(data.get("watch_time", 0)),
+        "liked": parse_flag(data.get("liked", False), "liked"),
+        "commented": parse_flag(data.get("commented", False), "commented"),
+        "viewed_comments": parse_flag(data.get("viewed_comments", False), "viewed_comments"),
+        "event_id": parse_event_id(data.get("event_id")),
+    }
+
+
+def _record_processed(events):
+    """
+    Of events (with user_id and event_id), the ones not applied before, recording them as
+    applied. Call inside the transaction that applies them; duplicates within the list
+    count once.
+    """
+    new = {}
+    for event in events:
+        new.setdefault((event["user_id"], event["event_id"]), event)
+    if not new:
+        return []
+    pairs = reduce(or_, [Q(user_id=user_id, event_id=event_id) for user_id, event_id in new])
+    for key in ProcessedEngagementEvent.objects.filter(pairs).values_list('user_id', 'event_id'):
+        new.pop(key, None)
+    # Unique per (user, event_id): a concurrent apply of the same event fails its transaction
+    ProcessedEngagementEvent.objects.bulk_create(
+        [ProcessedEngagementEvent(user_id=user_id, event_id=event_id) for user_id, event_id in new]
+    )
+    return list(new.values())
+
+
+def prune_processed_events():
+    """Forget event ids older than PROCESSED_EVENT_RETENTION. Returns the number deleted."""
+    cutoff = timezone.now() - PROCESSED_EVENT_RETENTION
+    return ProcessedEngagementEvent.objects.filter(date_processed__lt=cutoff).delete()[0]
+
+
+def apply_engagement_events(user_id, events):
+    """
+    Apply a batch of one user's engagement events.
+    Returns (number of events applied, whether the user's interests changed materially,
+    number of events skipped as already applied). Events for videos that no longer
+    exist are skipped.
+    """
+    video_ids = {event["video_id"] for event in events}
+    videos = PostRecord.objects.only('video_id', 'length', 'embedding').in_bulk(video_ids)
+
+    with transaction.atomic():
+        # The row lock also serializes the processed-id check of this user's events
+        user_data = UserData.objects.select_for_update().get(user_id=user_id)
+        received = len(events)
+        events = _record_processed([{**event, "user_id": user_id} for event in events])
+        user_interests = user_data.user_preference_embeddings
+        viewed_ids = set(
+            ViewedPosts.objects.filter(user_id=user_id, video_id__in=videos.keys()).values_list('video_id', flat=True)
+        )
+
+        new_views = []
+        counter_deltas = {}
+        material_change = False
+        applied = 0
+
+        for event in events:
+            video = videos.get(event["video_id"])
+            if video is None:
+                continue
+            applied += 1
+            watch_time = event["watch_time"]
+
+            if video.video_id not in viewed_ids:
+                # This is the first time the user is viewing the video
+                viewed_ids.add(video.video_id)
+                new_views.append(ViewedPosts(user_id=user_id, video_id=video.video_id))
+                if watch_time > 1:
+                    delta = counter_deltas.setdefault(video.video_id, {"views": 0, "total_watch_time": 0})
+                    delta["views"] += 1
+                    delta["total_watch_time"] += watch_time
+
+            engagement = calculate_engagement_score(
+                video.length, watch_time, event["liked"], event["commented"], event["viewed_comments"]
+            )
+            # Videos that are not embedded yet say nothing about the user's interests
+            if len(video.embedding) > 0:
+                material_change |= apply_engagement(user_interests, video.embedding, engagement)
+
+        ViewedPosts.objects.bulk_create(new_views)
+        increment_counters(counter_deltas)
+        if applied:
+            user_data.user_preference_embeddings = user_interests
+            user_data.save(update_fields=['user_preference_embeddings'])
+
+    return applied, material_change, received - len(events)
+
+
+def apply_like_events(events):
+    """
+    Apply like events ({"user_id", "video_id", "liked", "event_id"}) of any users.
+    Returns (number of likes that changed state, number of events already applied).
+    """
+    existing_videos = set(
+        PostRecord.objects.filter(video_id__in={event["video_id"] for event in events}).values_list('video_id', flat=True)
+    )
+
+    with transaction.atomic():
+        new_events = _record_processed(events)
+        wanted = {}
+        for event in new_events:
+            if event["video_id"] in existing_videos:
+                wanted[(event["user_id"], event["video_id"])] = event["liked"]
+        if not wanted:
+            return 0, len(events) - len(new_events)
+
+        pairs = reduce(or_, [Q(user_id=user_id, video_id=video_id) for user_id, video_id in wanted])
+        liked_pairs = set(LikedPosts.objects.filter(pairs).values_list('user_id', 'video_id'))
+        likes = [key for key, liked in wanted.items() if liked and key not in liked_pairs]
+        unlikes = [key for key, liked in wanted.items() if not liked and key in liked_pairs]
+
+        LikedPosts.objects.bulk_create([LikedPosts(user_id=user_id, video_id=video_id) for user_id, video_id in likes])
+        if unlikes:
+            LikedPosts.objects.filter(reduce(or_, [Q(user_id=user_id, video_id=video_id) for user_id, video_id in unlikes])).delete()
+
+        counter_deltas = {}
+        for (_, video_id), delta in [(key, 1) for key in likes] + [(key, -1) for key in unlikes]:
+            counter_deltas.setdefault(video_id, {"likes": 0})["likes"] += delta
+        increment_counters(counter_deltas)
+
+    return len(likes) + len(unlikes), len(events) - len(new_events)
@@ -0,0 +1,242 @@
+"""
+Write-behind queue for engagement events.
+
+UpdatePostsEngagementView and LikePostView only append their event to a Redis stream
+and return, so a swipe costs one queue append instead of several writes. The
+consume_engagement_events Celery task reads the stream through a consumer group,
+micro-batches the events per user (interest updates, views, watch time) and per
+video (likes) and applies them with engagement.py.
+
+Delivery is at-least-once: entries are acknowledged only after they were applied and
+entries left pending by a crashed consumer are claimed again after CLAIM_IDLE_MS, by
+the next run: the one the next append schedules, or the one Celery beat starts every
+CLAIM_IDLE_MS (CELERY_BEAT_SCHEDULE) when traffic has stopped.
+Every event carries an event_id (sent by the client, so retried requests reuse it, or
+generated on append). engagement.py records the ids it applies, per user, in the same
+transaction as the engagement itself, so neither a redelivery nor a retried request is
+counted twice, and a consumer dying before its commit loses nothing.
+
+An entry that still fails after MAX_DELIVERIES deliveries is moved to the
+DEAD_LETTER_KEY stream (with the error) and acknowledged, so it cannot block the queue.
+
+Set ENGAGEMENT_QUEUE_BACKEND = "local" to keep the queue in process, which only works
+when the consumer runs in the same process (e.g. CELERY_TASK_ALWAYS_EAGER).
+"""
+
+import json
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+
+STREAM_KEY = "engagement_events"
+CONSUMER_GROUP = "engagement_consumers"
+STREAM_MAXLEN = 1_000_000       # safety cap, acknowledged entries are deleted right away
+READ_COUNT = 500                # events per micro-batch
+CLAIM_IDLE_MS = 60 * 1000       # pending this long means the consumer died
+MAX_DELIVERIES = 5              # failed deliveries before an entry is dead-lettered
+DEAD_LETTER_KEY = "engagement_events_dead"
+FLUSH_SCHEDULED_KEY = "engagement_flush_scheduled"
+FLUSH_DELAY = 2                 # seconds events are collected before a consumer runs
+
+QUEUE_STATS_KEY = "engagement_queue_stats_{}"
+QUEUE_COUNTERS = ("applied", "duplicates", "dead_lettered", "batches", "apply_ms")
+QUEUE_GAUGES = ("last_lag_seconds", "max_lag_seconds", "last_batch_size", "last_consumed_at")
+
+
+def make_event(kind, user_id, **fields):
+    """An engagement event as stored in the queue, `kind` is "watch" or "like"."""
+    event = {"type": kind, "user_id": int(user_id), **fields}
+    event["event_id"] = str(fields.get("event_id") or uuid.uuid4())
+    event["ts"] = time.time()
+    return event
+
+
+class RedisEngagementQueue:
+    """Engagement events in a Redis stream read through a consumer group."""
+
+    def __init__(self, url):
+        import redis
+        self.redis = redis.Redis.from_url(url)
+        self._group_ready = False
+
+    def _ensure_group(self):
+        if self._group_ready:
+            return
+        import redis
+        try:
+            self.redis.xgroup_create(STREAM_KEY, CONSUMER_GROUP, id="0", mkstream=True)
+        except redis.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+        self._group_ready = True
+
+    def append(self, events):
+        """
+        Append events in one round trip. Returns True when no consumer run is scheduled
+        yet, i.e. the caller should schedule one.
+        """
+        pipe = self.redis.pipeline(transaction=False)
+        for event in events:
+            pipe.xadd(STREAM_KEY, {"data": json.dumps(event)}, maxlen=STREAM_MAXLEN, approximate=True)
+        pipe.set(FLUSH_SCHEDULED_KEY, 1, nx=True, ex=FLUSH_DELAY + CLAIM_IDLE_MS // 1000)
+        return bool(pipe.execute()[-1])
+
+    def flush_started(self):
+        """Let the next append schedule another run; call when a consumer starts reading."""
+        self.redis.delete(FLUSH_SCHEDULED_KEY)
+
+    def read(self, consumer, count=READ_COUNT):
+        """Up to `count` (entry id, event) pairs: stale pending entries first, then new ones."""
+        self._ensure_group()
+        _, entries, *_ = self.redis.xautoclaim(STREAM_KEY, CONSUMER_GROUP, consumer, CLAIM_IDLE_MS, "0-0", count=count)
+        if len(entries) < count:
+            for _, new_entries in self.redis.xreadgroup(CONSUMER_GROUP, consumer, {STREAM_KEY: ">"}, count=count - len(entries)):
+                entries += new_entries
+        return [(entry_id, json.loads(fields[b"data"])) for entry_id, fields in entries if fields]
+
+    def ack(self, entry_ids):
+        if entry_ids:
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.xack(STREAM_KEY, CONSUMER_GROUP, *entry_ids)
+            pipe.xdel(STREAM_KEY, *entry_ids)
+            pipe.execute()
+
+    def deliveries(self, entry_ids):
+        """{entry id: times delivered} of pending entries."""
+        pipe = self.redis.pipeline(transaction=False)
+        for entry_id in entry_ids:
+            pipe.xpending_range(STREAM_KEY, CONSUMER_GROUP, min=entry_id, max=entry_id, count=1)
+        return {
+            entry_id: pending[0]["times_delivered"] if pending else 0
+            for entry_id, pending in zip(entry_ids, pipe.execute())
+        }
+
+    def dead_letter(self, entries, error):
+        """Move (entry id, event) pairs to the dead-letter stream and acknowledge them."""
+        if entries:
+            pipe = self.redis.pipeline(transaction=False)
+            for entry_id, event in entries:
+                pipe.xadd(DEAD_LETTER_KEY, {"data": json.dumps(event), "error": error}, maxlen=STREAM_MAXLEN, approximate=True)
+            pipe.execute()
+            self.ack([entry_id for entry_id, _ in entries])
+
+    def backlog(self):
+        """(entries in the stream, entries delivered but not acknowledged)."""
+        self._ensure_group()
+        return self.redis.xlen(STREAM_KEY), self.redis.xpending(STREAM_KEY, CONSUMER_GROUP)["pending"]
+
+
+class LocalEngagementQueue:
+    """In-process stand-in with the same interface, for development and eager Celery."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # entry id -> event
+        self.pending = {}             # entry id -> delivery time
+        self.delivered = {}           # entry id -> times delivered
+        self.dead = []                # (event, error)
+        self.flush_scheduled = False
+        self._next_id = 0
+
+    def append(self, events):
+        with self.lock:
+            for event in events:
+                self._next_id += 1
+                self.entries[self._next_id] = json.loads(json.dumps(event))
+            schedule, self.flush_scheduled = not self.flush_scheduled, True
+            return schedule
+
+    def flush_started(self):
+        with self.lock:
+            self.flush_scheduled = False
+
+    def read(self, consumer, count=READ_COUNT):
+        with self.lock:
+            now = time.monotonic()
+            batch = []
+            for entry_id, event in self.entries.items():
+                delivered = self.pending.get(entry_id)
+                if delivered is None or now - delivered > CLAIM_IDLE_MS / 1000:
+                    self.pending[entry_id] = now
+                    self.delivered[entry_id] = self.delivered.get(entry_id, 0) + 1
+                    batch.append((entry_id, event))
+                    if len(batch) == count:
+                        break
+            return batch
+
+    def ack(self, entry_ids):
+        with self.lock:
+            for entry_id in entry_ids:
+                self.entries.pop(entry_id, None)
+                self.pending.pop(entry_id, None)
+                self.delivered.pop(entry_id, None)
+
+    def deliveries(self, entry_ids):
+        with self.lock:
+            return {entry_id: self.delivered.get(entry_id, 0) for entry_id in entry_ids}
+
+    def dead_letter(self, entries, error):
+        with self.lock:
+            self.dead += [(event, error) for _, event in entries]
+        self.ack([entry_id for entry_id, _ in entries])
+
+    def backlog(self):
+        with self.lock:
+            return len(self.entries), len(self.pending)
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_engagement_queue():
+    """Return this process's engagement queue client, creating it on first use."""
+    global _queue
+    if _queue is None:
+        with _queue_lock:
+            if _queue is None:
+                if getattr(settings, "ENGAGEMENT_QUEUE_BACKEND", "redis") == "local":
+                    _queue = LocalEngagementQueue()
+                else:
+                    _queue = RedisEngagementQueue(settings.ENGAGEMENT_QUEUE_URL)
+    return _queue
+
+
+# ---------------------------------------------------------------------- #
+# Metrics ---------------------------------------------------------------- #
+# ---------------------------------------------------------------------- #
+def record_queue_stat(stat, amount=1):
+    key = QUEUE_STATS_KEY.format(stat)
+    try:
+        cache.incr(key, amount)
+    except ValueError:
+        cache.add(key, 0, None)
+        cache.incr(key, amount)
+
+
+def record_batch(batch_size, lag_seconds):
+    """Store the gauges of the batch just applied."""
+    max_lag = cache.get(QUEUE_STATS_KEY.format("max_lag_seconds")) or 0.0
+    cache.set_many({
+        QUEUE_STATS_KEY.format("last_lag_seconds"): lag_seconds,
+        QUEUE_STATS_KEY.format("max_lag_seconds"): max(max_lag, lag_seconds),
+        QUEUE_STATS_KEY.format("last_batch_size"): batch_size,
+        QUEUE_STATS_KEY.format("last_consumed_at"): time.time(),
+    }, None)
+
+
+def engagement_queue_stats():
+    """Throughput counters, consumer lag and the current backlog of the engagement queue."""
+    stats = cache.get_many([QUEUE_STATS_KEY.format(stat) for stat in QUEUE_COUNTERS + QUEUE_GAUGES])
+    stats = {stat: stats.get(QUEUE_STATS_KEY.format(stat)) or 0 for stat in QUEUE_COUNTERS + QUEUE_GAUGES}
+    stats["queued"], stats["pending"] = get_engagement_queue().backlog()
+    stats["avg_apply_ms"] = stats["apply_ms"] / stats["batches"] if stats["batches"] else 0.0
+    return stats
+
+
+def reset_engagement_queue_stats():
+    cache.delete_many([QUEUE_STATS_KEY.format(stat) for stat in QUEUE_COUNTERS + QUEUE_GAUGES])
@@ -0,0 +1,254 @@
+"""
+Feed ranking, the ranked-video cache and the per-user precomputed feed queues.
+
+rank_videos() is the ranking step of the feed (embedding store + calculate_video_ranks).
+
+get_ranked_videos() caches its result as compact RankedVideo tuples under the user's
+id and interest version. The interest version is bumped whenever the user's interests
+change materially, so a stale ranking is never read again. Catalog changes (uploads,
+new embeddings, deletes) are not invalidations: the cached ranking remembers the
+embedding store version it was built at and only the videos changed since are
+re-scored and merged in.
+
+The reported-video and blocked-user exclusion sets are cached as well and invalidated
+by ReportVideoView and BlockUserView, so a feed request does not recompute them.
+
+The materialize_feed Celery task keeps the best FEED_QUEUE_SIZE candidates of each
+active user in the shared cache (Redis), so GetFeedView only has to filter and sample
+from the queue. A stale queue is still served while a refresh is scheduled.
+"""
+
+import time
+from collections import namedtuple
+
+import numpy as np
+from django.core.cache import cache
+from django.db.models import Count
+
+from .embedding_store import Candidates, changed_video_ids, get_catalog_version, get_embedding_store
+from .models import BlockedUser, ReportedVideo
+from .rank_video import calculate_video_ranks
+
+RankedVideo = namedtuple("RankedVideo", ["video_id", "user_id", "rank_score", "interest_score"])
+
+INTEREST_VERSION_KEY = "interest_version_{}"
+
+RANKED_VIDEOS_KEY = "ranked_videos_{}_{}"  # user id, interest version
+RANKED_VIDEOS_TIMEOUT = 1800
+RANKING_STATS_KEY = "ranked_videos_stats_{}"
+RANKING_STATS = ("hits", "patches", "misses", "compute_ms")
+
+REPORTED_VIDEOS_KEY = "reported_video_ids"
+BLOCKED_USERS_KEY = "blocked_user_ids_{}"
+EXCLUSION_TIMEOUT = 60 * 60
+
+FEED_QUEUE_KEY = "feed_queue_{}"
+FEED_QUEUE_SIZE = 500
+FEED_QUEUE_LOW_WATERMARK = 50   # refresh once fewer candidates are left
+FEED_QUEUE_TIMEOUT = 60 * 60 * 24
+
+
+# ---------------------------------------------------------------------- #
+# Ranking ---------------------------------------------------------------- #
+# ---------------------------------------------------------------------- #
+def _ranked(videos, interest_scores, rank_scores, rows):
+    return [
+        RankedVideo(int(videos.video_ids[i]), int(videos.user_ids[i]), float(rank_scores[i]), float(interest_scores[i]) * 100)
+        for i in rows
+    ]
+
+
+def rank_videos(user_data, watched_video_ids, batch_size):
+    """
+    Rank the user's candidate videos, best first. Watched videos are left out unless
+    fewer than batch_size unwatched videos remain.
+    """
+    store = get_embedding_store()
+    with store.lock:
+        store.sync()
+        # Large catalogs only rank the ANN neighbours of the user's interests
+        videos = store.candidates(user_data.user_preference_embeddings, watched_video_ids, batch_size)
+        interest_scores, rank_scores = calculate_video_ranks(user_data, videos)
+        video_ids = videos.video_ids.copy()
+
+    unwatched = ~np.isin(video_ids, list(watched_video_ids))
+    #print(f"Found {unwatched.sum()} unwatched videos.")
+
+    if unwatched.sum() < batch_size:
+        #print ("Not enough unwatched videos")
+        unwatched[:] = True
+
+    order = np.flatnonzero(unwatched)
+    order = order[np.argsort(-rank_scores[order], kind="stable")]
+    return _ranked(videos, interest_scores, rank_scores, order)
+
+
+def rerank_changed_videos(user_data, ranked_videos, video_ids, watched_video_ids):
+    """Re-score only `video_ids` (added, re-embedded or deleted) and merge them into ranked_videos."""
+    store = get_embedding_store()
+    with store.lock:
+        store.sync()
+        present = [video_id for video_id in video_ids if video_id in store and video_id not in watched_video_ids]
+        videos = Candidates(store, store.rows_of(present))
+        interest_scores, rank_scores = calculate_video_ranks(user_data, videos)
+
+    merged = [video for video in ranked_videos if video.video_id not in video_ids]
+    merged += _ranked(videos, interest_scores, rank_scores, range(len(videos)))
+    merged.sort(key=lambda video: video.rank_score, reverse=True)
+    return merged
+
+
+# ---------------------------------------------------------------------- #
+# Ranked-video cache ----------------------------------------------------- #
+# ---------------------------------------------------------------------- #
+def get_interest_version(user_id):
+    return cache.get(INTEREST_VERSION_KEY.format(user_id)) or 0
+
+
+def bump_interest_version(user_id):
+    """Retire every cached ranking of the user; call when their interests changed materially."""
+    key = INTEREST_VERSION_KEY.format(user_id)
+    try:
+        return cache.incr(key)
+    except ValueError:
+        cache.add(key, 0, None)
+        return cache.incr(key)
+
+
+def _record(stat, amount=1):
+    key = RANKING_STATS_KEY.format(stat)
+    try:
+        cache.incr(key, amount)
+    except ValueError:
+        cache.add(key, 0, None)
+        cache.incr(key, amount)
+
+
+def ranking_cache_stats():
+    """Hit/patch/miss counts and time spent of get_ranked_videos since the counters were reset."""
+    stats = {stat: cache.get(RANKING_STATS_KEY.format(stat)) or 0 for stat in RANKING_STATS}
+    lookups = stats["hits"] + stats["patches"] + stats["misses"]
+    stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+    stats["avg_compute_ms"] = stats["compute_ms"] / lookups if lookups else 0.0
+    return stats
+
+
+def get_ranked_videos(user_data, watched_video_ids, batch_size):
+    """Cached rank_videos(), patched with the videos that changed since it was computed."""
+    start = time.perf_counter()
+    user_id = user_data.user_id
+    cache_key = RANKED_VIDEOS_KEY.format(user_id, get_interest_version(user_id))
+    catalog_version = get_catalog_version()
+
+    rankings = cache.get(cache_key)
+    if rankings is not None and rankings["catalog_version"] == catalog_version:
+        _record("hits")
+        return rankings["videos"]
+
+    changed = None
+    if rankings is not None:
+        changed = changed_video_ids(rankings["catalog_version"], catalog_version)
+
+    if changed is None:
+        ranked_videos = rank_videos(user_data, watched_video_ids, batch_size)
+        _record("misses")
+    else:
+        ranked_videos = rerank_changed_videos(user_data, rankings["videos"], changed, watched_video_ids)
+        _record("patches")
+
+    cache.set(cache_key, {"videos": ranked_videos, "catalog_version": catalog_version}, RANKED_VIDEOS_TIMEOUT)
+    _record("compute_ms", int(1000 * (time.perf_counter() - start)))
+    return ranked_videos
+
+
+def forget_ranked_video(user_id, video_id):
+    """Drop one video from the user's cached ranking and feed queue (e.g. after they reported it)."""
+    cache_key = RANKED_VIDEOS_KEY.format(user_id, get_interest_version(user_id))
+    rankings = cache.get(cache_key)
+    if rankings is not None:
+        rankings["videos"] = [video for video in rankings["videos"] if video.video_id != video_id]
+        cache.set(cache_key, rankings, RANKED_VIDEOS_TIMEOUT)
+
+    queue = get_feed_queue(user_id)
+    if queue is not None:
+        consume_feed_queue(user_id, queue, [video_id])
+
+
+# ---------------------------------------------------------------------- #
+# Exclusion sets --------------------------------------------------------- #
+# ---------------------------------------------------------------------- #
+def get_reported_video_ids():
+    """Ids of videos reported more than once, hidden from every feed."""
+    reported_ids = cache.get(REPORTED_VIDEOS_KEY)
+    if reported_ids is None:
+        reported_ids = set(
+            ReportedVideo.objects.values('video_id')
+            .annotate(num_reports=Count('id'))
+            .filter(num_reports__gt=1)
+            .values_list('video_id', flat=True)
+        )
+        cache.set(REPORTED_VIDEOS_KEY, reported_ids, EXCLUSION_TIMEOUT)
+    return reported_ids
+
+
+def invalidate_reported_video_ids():
+    cache.delete(REPORTED_VIDEOS_KEY)
+
+
+def get_blocked_user_ids(user_id):
+    """Ids of the users this user blocked or was blocked by."""
+    key = BLOCKED_USERS_KEY.format(user_id)
+    blocked_user_ids = cache.get(key)
+    if blocked_user_ids is None:
+        blocked_user_ids = set(
+            list(BlockedUser.objects.filter(blocker_id=user_id).values_list('blocked_id', flat=True)) +
+            list(BlockedUser.objects.filter(blocked_id=user_id).values_list('blocker_id', flat=True))
+        )
+        cache.set(key, blocked_user_ids, EXCLUSION_TIMEOUT)
+    return blocked_user_ids
+
+
+def invalidate_blocked_user_ids(*user_ids):
+    cache.delete_many([BLOCKED_USERS_KEY.format(user_id) for user_id in user_ids])
+
+
+# ---------------------------------------------------------------------- #
+# Feed queues ------------------------------------------------------------ #
+# ---------------------------------------------------------------------- #
+def get_feed_queue(user_id):
+    """The user's precomputed queue ({"videos", "catalog_version", "interest_version", "built_at"}) or None."""
+    return cache.get(FEED_QUEUE_KEY.format(user_id))
+
+
+def save_feed_queue(user_id, videos, catalog_version, interest_version):
+    queue = {
+        "videos": videos[:FEED_QUEUE_SIZE],
+        "catalog_version": catalog_version,
+        "interest_version": interest_version,
+        "built_at": time.time(),
+    }
+    cache.set(FEED_QUEUE_KEY.format(user_id), queue, FEED_QUEUE_TIMEOUT)
+    return queue
+
+
+def consume_feed_queue(user_id, queue, video_ids):
+    """Drop served (or no longer eligible) videos from the queue and store it again."""
+    video_ids = set(video_ids)
+    queue["videos"] = [video for video in queue["videos"] if video.video_id not in video_ids]
+    cache.set(FEED_QUEUE_KEY.format(user_id), queue, FEED_QUEUE_TIMEOUT)
+    return queue
+
+
+def forget_feed(user_id):
+    """Drop the user's feed queue and cached ranking, e.g. after their engagement was reset."""
+    cache.delete_many([FEED_QUEUE_KEY.format(user_id), RANKED_VIDEOS_KEY.format(user_id, get_interest_version(user_id))])
+    bump_interest_version(user_id)  # rankings being computed right now are stored under the retired version
+
+
+def feed_queue_is_stale(user_id, queue):
+    """True when the queue is running low, or videos or the user's interests changed since it was built."""
+    return (
+        len(queue["videos"]) < FEED_QUEUE_LOW_WATERMARK or
+        queue["catalog_version"] != get_catalog_version() or
+        queue["interest_version"] != get_interest_version(user_id)
+    )
@@ -0,0 +1,109 @@
+"""
+Model fields that store embeddings as packed binary instead of JSON arrays.
+
+A 1536 dimension embedding is ~33KB as a JSON array of Python floats and has to be
+parsed and converted to an ndarray on every read. Packed as float32 it is 6KB and
+np.frombuffer turns the column value into an array without copying it.
+
+Arrays returned from the database are read-only views of the column value, assign a
+new array (or list) to the attribute to change it.
+"""
+
+import base64
+import struct
+
+import numpy as np
+from django.db import models
+
+
+def empty_vector():
+    return np.zeros(0, dtype=np.float32)
+
+
+class VectorField(models.BinaryField):
+    """A 1-D vector stored as packed `dtype` values (float32 by default, float16 to halve the size)."""
+
+    description = "Packed vector"
+
+    def __init__(self, *args, dtype="float32", **kwargs):
+        self.dtype = np.dtype(dtype).newbyteorder("<")
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        if self.dtype != np.dtype("<f4"):
+            kwargs["dtype"] = self.dtype.name
+        return name, path, args, kwargs
+
+    def get_default(self):
+        # BinaryField compares the default against "", which numpy arrays refuse
+        if self.has_default():
+            return self.default() if callable(self.default) else self.default
+        return super().get_default()
+
+    def pack(self, value):
+        return np.ascontiguousarray(value, dtype=self.dtype).tobytes()
+
+    def unpack(self, value):
+        return np.frombuffer(value, dtype=self.dtype)
+
+    def get_prep_value(self, value):
+        if value is None or isinstance(value, (bytes, memoryview)):
+            return value
+        return self.pack(value)
+
+    def from_db_value(self, value, expression, connection):
+        if value is None:
+            return value
+        return self.unpack(value)
+
+    def to_python(self, value):
+        if value is None or isinstance(value, np.ndarray):
+            return value
+        if isinstance(value, str):  # serialized (dumpdata) form
+            return self.unpack(base64.b64decode(value))
+        if isinstance(value, (bytes, memoryview)):
+            return self.unpack(value)
+        return np.asarray(value, dtype=self.dtype)
+
+    def value_to_string(self, obj):
+        return base64.b64encode(self.get_prep_value(self.value_from_object(obj))).decode("ascii")
+
+
+_GROUP_COUNT = struct.Struct("<I")
+_GROUP_HEADER = struct.Struct("<Id")  # embedding length, weight
+
+
+class InterestGroupsField(VectorField):
+    """
+    A user's interest groups, i.e. a list of {"embedding": vector, "weight": float},
+    stored as: group count, then per group its length, weight and packed embedding.
+    """
+
+    description = "Packed interest groups"
+
+    def pack(self, value):
+        parts = [_GROUP_COUNT.pack(len(value))]
+        for group in value:
+            embedding = super().pack(group["embedding"])
+            parts.append(_GROUP_HEADER.pack(len(embedding) // self.dtype.itemsize, float(group["weight"])))
+            parts.append(embedding)
+        return b"".join(parts)
+
+    def unpack(self, value):
+        value = memoryview(value)
+        (count,) = _GROUP_COUNT.unpack_from(value, 0)
+        offset = _GROUP_COUNT.size
+        groups = []
+        for _ in range(count):
+            length, weight = _GROUP_HEADER.unpack_from(value, offset)
+            offset += _GROUP_HEADER.size
+            embedding = np.frombuffer(value, dtype=self.dtype, count=length, offset=offset)
+            offset += length * self.dtype.itemsize
+            groups.append({"embedding": embedding, "weight": weight})
+        return groups
+
+    def to_python(self, value):
+        if isinstance(value, list):
+            return value
+        return super().to_python(value)
@@ -0,0 +1,165 @@
+"""
+Frame sampling for video summaries.
+
+The summary only needs a handful of frames, so decoding every frame of the video
+(cap.read() on each one) wastes almost all of the work. sample_frames() only decodes
+the frames it keeps: it skips ahead with grab(), which does not convert the frame to
+BGR, or seeks when the next target is far away. Frames are downscaled so their longer
+side is at most max_dimension before anything else touches them.
+
+Two modes:
+    • "interval": one frame every `interval` seconds (the original behaviour).
+    • "scene":    the first frame plus the frames where the picture changes the most,
+                  found by comparing small colour histograms of frames sampled
+                  SCENE_SAMPLES_PER_SECOND times a second.
+
+Both return at most max_frames frames as RGB arrays together with their timestamps.
+
+encode_frames() turns the arrays into the data URLs sent to the vision model, in
+memory, as JPEG or WebP (PNG is several times larger for the same frame).
+"""
+
+import base64
+
+import cv2
+import numpy as np
+
+MAX_FRAMES = 12
+MAX_FRAME_DIMENSION = 768
+SEEK_MIN_GAP_SECONDS = 2      # seeking lands on a keyframe and decodes forward, only worth it for long gaps
+SCENE_SAMPLES_PER_SECOND = 2
+SCENE_THRESHOLD = 0.35        # histogram distance counted as a scene change
+SCENE_MIN_GAP_SECONDS = 1.0   # ignore changes closer than this to the previous kept frame
+
+IMAGE_FORMATS = {
+    # format: (extension, mime type, quality flag)
+    "jpeg": (".jpg", "image/jpeg", cv2.IMWRITE_JPEG_QUALITY),
+    "webp": (".webp", "image/webp", cv2.IMWRITE_WEBP_QUALITY),
+    "png": (".png", "image/png", None),
+}
+
+
+def _resize(frame, max_dimension):
+    height, width = frame.shape[:2]
+    scale = max_dimension / max(height, width)
+    if scale >= 1:
+        return frame
+    return cv2.resize(frame, (max(int(width * scale), 1), max(int(height * scale), 1)), interpolation=cv2.INTER_AREA)
+
+
+def _histogram(frame):
+    small = cv2.resize(frame, (64, 36), interpolation=cv2.INTER_AREA)
+    hsv = cv2.cvtColor(small, cv2.COLOR_BGR2HSV)
+    hist = cv2.calcHist([hsv], [0, 1], None, [16, 8], [0, 180, 0, 256])
+    return cv2.normalize(hist, hist).flatten()
+
+
+def _spread(items, count):
+    """At most `count` items, evenly spread over `items`."""
+    if len(items) <= count:
+        return list(items)
+    return [items[i] for i in np.linspace(0, len(items) - 1, count).round().astype(int)]
+
+
+class _Reader:
+    """Decodes only the requested frame indices (ascending) of a cv2.VideoCapture."""
+
+    def __init__(self, cap, fps):
+        self.cap = cap
+        self.position = 0  # index of the frame the next grab() returns
+        self.seek_gap = max(int(SEEK_MIN_GAP_SECONDS * fps), 1)
+
+    def read(self, index):
+        if index - self.position > self.seek_gap:
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, index)
+            self.position = index
+        while self.position < index:
+            if not self.cap.grab():
+                return None
+            self.position += 1
+        ok, frame = self.cap.read()
+        self.position += 1
+        return frame if ok else None
+
+
+def _interval_indices(frame_count, fps, interval):
+    step = max(int(interval * int(fps)), 1)
+    return list(range(0, frame_count, step))
+
+
+def _scene_indices(reader, frame_count, fps, max_frames):
+    stride = max(int(fps / SCENE_SAMPLES_PER_SECOND), 1)
+    min_gap = SCENE_MIN_GAP_SECONDS * fps
+    previous = None
+    changes = []  # (distance, frame index)
+    for index in range(0, frame_count, stride):
+        frame = reader.read(index)
+        if frame is None:
+            break
+        hist = _histogram(frame)
+        if previous is not None:
+            distance = cv2.compareHist(previous, hist, cv2.HISTCMP_BHATTACHARYYA)
+            if distance > SCENE_THRESHOLD:
+                changes.append((distance, index))
+        previous = hist
+
+    # The strongest changes win, keeping them apart by at least min_gap
+    kept = [0]
+    for _, index in sorted(changes, reverse=True):
+        if len(kept) == max_frames:
+            break
+        if all(abs(index - other) >= min_gap for other in kept):
+            kept.append(index)
+    return sorted(kept)
+
+
+def sample_frames(video_path, interval=10, mode="interval", max_frames=MAX_FRAMES, max_dimension=MAX_FRAME_DIMENSION):
+    """
+    Sample frames of a video. Returns (RGB frames as uint8 arrays, timestamps in seconds).
+    """
+    if mode not in ("interval", "scene"):
+        raise ValueError(f"Unknown sampling mode: {mode}")
+
+    cap = cv2.VideoCapture(video_path)
+    try:
+        fps = cap.get(cv2.CAP_PROP_FPS) or 1
+        frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+
+        if mode == "scene":
+            indices = _scene_indices(_Reader(cap, fps), frame_count, fps, max_frames)
+            cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+        else:
+            indices = _spread(_interval_indices(frame_count, fps, interval), max_frames)
+
+        reader = _Reader(cap, fps)
+        frames = []
+        timestamps = []
+        for index in indices:
+            frame = reader.read(index)
+            if frame is None:
+                break
+            frames.append(cv2.cvtColor(_resize(frame, max_dimension), cv2.COLOR_BGR2RGB))
+            timestamps.append(index / fps)
+        return frames, timestamps
+    finally:
+        cap.release()
+
+
+def encode_frames(frames, image_format="jpeg", quality=80, max_dimension=MAX_FRAME_DIMENSION):
+    """
+    Encode RGB frames as data URLs without touching the disk.
+    Returns (data URLs, total payload size in bytes).
+    """
+    if image_format not in IMAGE_FORMATS:
+        raise ValueError(f"Unknown image format: {image_format}")
+    extension, mime_type, quality_flag = IMAGE_FORMATS[image_format]
+    params = [quality_flag, int(quality)] if quality_flag is not None else []
+
+    urls = []
+    for frame in frames:
+        bgr = cv2.cvtColor(_resize(np.asarray(frame), max_dimension), cv2.COLOR_RGB2BGR)
+        ok, encoded = cv2.imencode(extension, bgr, params)
+        if not ok:
+            raise ValueError(f"Could not encode frame as {image_format}")
+        urls.append(f"data:{mime_type};base64,{base64.b64encode(encoded).decode('ascii')}")
+    return urls, sum(len(url) for url in urls)
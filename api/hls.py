@@ -0,0 +1,189 @@
+"""
+Server-side HLS adaptive bitrate ladder.
+
+An uploaded MP4 is transcoded into several renditions (one ffmpeg process each, run in
+parallel and sharing a thread budget) with aligned keyframes, so players can switch
+between them at any segment boundary. A master playlist lists the renditions with
+their bandwidth and resolution; the player starts on a low one and moves up as the
+connection allows, which shortens startup and saves mobile data.
+
+The output directory is uploaded with concurrent PUTs through the shared S3 client.
+"""
+
+import math
+import os
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+from .audio import probe_video
+from .storage import get_s3_client, list_keys
+
+# name, height, video bitrate (kbit/s), audio bitrate (kbit/s)
+DEFAULT_LADDER = (
+    ("1080p", 1080, 5000, 128),
+    ("720p", 720, 2800, 128),
+    ("480p", 480, 1400, 96),
+    ("360p", 360, 800, 64),
+)
+SEGMENT_SECONDS = 6
+MASTER_PLAYLIST = "master.m3u8"
+CONTENT_TYPES = {
+    ".m3u8": "application/x-mpegURL",
+    ".ts": "video/MP2T",
+}
+
+
+def _ffmpeg():
+    return getattr(settings, "FFMPEG_BINARY", "ffmpeg")
+
+
+def split_threads(thread_budget, weights):
+    """
+    Split thread_budget across jobs in proportion to their weights: at least one thread
+    each, and no more than thread_budget in total unless there are more jobs than that.
+    """
+    spare = max(thread_budget - len(weights), 0)
+    shares = [spare * weight / sum(weights) for weight in weights]
+    threads = [1 + int(share) for share in shares]
+    # The threads lost to rounding down go to the largest remainders
+    leftover = spare - sum(int(share) for share in shares)
+    for i in sorted(range(len(weights)), key=lambda i: shares[i] - int(shares[i]), reverse=True)[:leftover]:
+        threads[i] += 1
+    return threads
+
+
+def plan_ladder(width, height, ladder=DEFAULT_LADDER):
+    """
+    Renditions for a width x height source: the ladder steps that do not upscale (by the
+    short side, so portrait videos are treated like landscape ones), and at least the
+    lowest step. Returns dicts with the output width/height (even numbers, as x264 needs).
+    """
+    short_side, long_side = sorted((width, height))
+    steps = [step for step in ladder if step[1] <= short_side] or [min(ladder, key=lambda step: step[1])]
+    renditions = []
+    for name, size, video_kbps, audio_kbps in steps:
+        size = min(size, short_side)
+        scaled_long = int(math.ceil(long_side * size / short_side / 2) * 2)
+        size -= size % 2
+        out_width, out_height = (scaled_long, size) if width >= height else (size, scaled_long)
+        renditions.append({
+            "name": name, "width": out_width, "height": out_height,
+            "video_kbps": video_kbps, "audio_kbps": audio_kbps,
+        })
+    return renditions
+
+
+def _rendition_command(video_path, out_dir, rendition, threads, has_audio, segment_seconds):
+    name = rendition["name"]
+    # Fixed GOP of one segment and no scene-cut keyframes, so segments line up across renditions
+    gop = f"expr:gte(t,n_forced*{segment_seconds})"
+    cmd = [
+        _ffmpeg(), "-hide_banner", "-nostdin", "-v", "error", "-y", "-i", video_path,
+        "-map", "0:v:0",
+    ]
+    if has_audio:
+        cmd += ["-map", "0:a:0", "-c:a", "aac", "-b:a", f"{rendition['audio_kbps']}k", "-ac", "2"]
+    cmd += [
+        "-vf", f"scale={rendition['width']}:{rendition['height']}",
+        # 8-bit 4:2:0 is what every player decodes (phones often record 10-bit HDR)
+        "-c:v", "libx264", "-preset", "veryfast", "-profile:v", "main", "-pix_fmt", "yuv420p",
+        "-b:v", f"{rendition['video_kbps']}k",
+        "-maxrate", f"{int(rendition['video_kbps'] * 1.07)}k",
+        "-bufsize", f"{rendition['video_kbps'] * 2}k",
+        "-force_key_frames", gop, "-sc_threshold", "0",
+        "-threads", str(threads),
+        "-f", "hls", "-hls_time", str(segment_seconds), "-hls_playlist_type", "vod",
+        "-hls_segment_filename", os.path.join(out_dir, f"{name}_%04d.ts"),
+        os.path.join(out_dir, f"{name}.m3u8"),
+    ]
+    return cmd
+
+
+def master_playlist(renditions):
+    lines = ["#EXTM3U", "#EXT-X-VERSION:3"]
+    for rendition in renditions:
+        # Peak bandwidth: maxrate plus audio, with 10% for the transport stream overhead
+        bandwidth = int((rendition["video_kbps"] * 1.07 + rendition["audio_kbps"]) * 1000 * 1.1)
+        lines.append(
+            f"#EXT-X-STREAM-INF:BANDWIDTH={bandwidth},RESOLUTION={rendition['width']}x{rendition['height']}"
+        )
+        lines.append(f"{rendition['name']}.m3u8")
+    return "\n".join(lines) + "\n"
+
+
+def transcode_ladder(video_path, out_dir, thread_budget=None, ladder=DEFAULT_LADDER, segment_seconds=SEGMENT_SECONDS):
+    """
+    Transcode video_path into an HLS ladder in out_dir, all renditions at once.
+
+    thread_budget is the total number of encoder threads, split across the renditions
+    in proportion to their pixel count. Returns the renditions (see plan_ladder).
+    """
+    thread_budget = thread_budget or getattr(settings, "HLS_THREAD_BUDGET", None) or os.cpu_count() or 1
+    info = probe_video(video_path)
+    if info["width"] is None:
+        raise ValueError(f"{video_path} has no video stream")
+    has_audio = info["has_audio"]
+    renditions = plan_ladder(info["width"], info["height"], ladder=ladder)
+    threads = split_threads(thread_budget, [rendition["width"] * rendition["height"] for rendition in renditions])
+
+    def run(rendition, rendition_threads):
+        cmd = _rendition_command(video_path, out_dir, rendition, rendition_threads, has_audio, segment_seconds)
+        result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, errors="replace")
+        if result.returncode != 0:
+            raise RuntimeError(f"ffmpeg failed for {rendition['name']}: {result.stderr[-500:]}")
+
+    os.makedirs(out_dir, exist_ok=True)
+    # With a budget smaller than the ladder, renditions take turns with one thread each
+    with ThreadPoolExecutor(min(len(renditions), thread_budget)) as pool:
+        for future in [pool.submit(run, *args) for args in zip(renditions, threads)]:
+            future.result()
+
+    with open(os.path.join(out_dir, MASTER_PLAYLIST), "w") as f:
+        f.write(master_playlist(renditions))
+    return renditions
+
+
+def hls_prefix(file_path):
+    """
+    The folder of a video's HLS files, <user>/videos/<name>/, for a playlist in it or
+    for the <user>/videos/<name>.mp4 it was transcoded from. None for other layouts.
+    """
+    directory, name = os.path.split(file_path)
+    if not directory:
+        return None
+    if name.endswith(".m3u8"):
+        return f"{directory}/"
+    return f"{os.path.splitext(file_path)[0]}/"
+
+
+def video_keys(file_path, bucket, client=None):
+    """Every S3 key of a video: file_path, the MP4 a ladder was made from and the HLS files."""
+    keys = [file_path]
+    prefix = hls_prefix(file_path)
+    if prefix is not None:
+        keys.append(f"{prefix.rstrip('/')}.mp4")
+        keys += list_keys(bucket, prefix, client)
+    return keys
+
+
+def upload_directory(local_dir, bucket, prefix, concurrency=None):
+    """Upload every file in local_dir to bucket under prefix with concurrent PUTs; returns the keys."""
+    concurrency = concurrency or getattr(settings, "HLS_UPLOAD_CONCURRENCY", 8)
+    client = get_s3_client()
+
+    def upload(name):
+        key = f"{prefix}{name}"
+        content_type = CONTENT_TYPES.get(os.path.splitext(name)[1], "application/octet-stream")
+        client.upload_file(os.path.join(local_dir, name), bucket, key, ExtraArgs={"ContentType": content_type})
+        return key
+
+    # Playlists last, so a playlist never points at a segment that is not uploaded yet
+    names = sorted(os.listdir(local_dir), key=lambda name: (name.endswith(".m3u8"), name == MASTER_PLAYLIST, name))
+    segments = [name for name in names if not name.endswith(".m3u8")]
+    playlists = [name for name in names if name.endswith(".m3u8")]
+    with ThreadPoolExecutor(concurrency) as pool:
+        keys = list(pool.map(upload, segments))
+        keys += [upload(name) for name in playlists]
+    return keys
@@ -0,0 +1,61 @@
+from datetime import datetime, timezone
+
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from api.ann_index import measure_recall
+from api.embedding_store import EmbeddingStore, get_embedding_store
+from api.models import UserData
+
+
+class Command(BaseCommand):
+    help = "Measure recall@k and query latency of the ANN index against an exact scan."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--k", type=int, default=100, help="Neighbours retrieved per query.")
+        parser.add_argument("--n-probe", type=int, default=None, help="Inverted lists scanned per query.")
+        parser.add_argument("--queries", type=int, default=100, help="Number of queries to run.")
+        parser.add_argument("--synthetic", type=int, default=0,
+                            help="Benchmark a synthetic catalog of this many videos instead of the database.")
+
+    def handle(self, *args, **options):
+        rng = np.random.default_rng(0)
+
+        if options["synthetic"]:
+            store = self.synthetic_store(options["synthetic"], rng)
+        else:
+            store = get_embedding_store()
+            store.sync()
+
+        # Real interest groups make the most representative queries, pad with noisy videos
+        queries = [
+            group["embedding"]
+            for user_data in UserData.objects.all()[:options["queries"]]
+            for group in user_data.user_preference_embeddings
+            if len(group["embedding"]) == store.dim
+        ] if not options["synthetic"] else []
+        with store.lock:
+            embedded = store.embeddings[store.has_embedding]
+        while len(queries) < options["queries"] and len(embedded):
+            query = embedded[rng.integers(len(embedded))] + rng.normal(scale=0.02, size=store.dim)
+            queries.append(query / np.linalg.norm(query))
+        queries = queries[:options["queries"]]
+
+        result = measure_recall(store, queries, k=options["k"], n_probe=options["n_probe"])
+        self.stdout.write(
+            f"videos={len(embedded)} lists={len(store.index.lists)} queries={len(queries)} k={options['k']}\n"
+            f"recall@{options['k']}={result['recall']:.3f} "
+            f"ann={result['ann_ms']:.2f}ms exact={result['exact_ms']:.2f}ms"
+        )
+
+    def synthetic_store(self, size, rng, n_topics=200):
+        """Clustered unit vectors, roughly shaped like real topic embeddings."""
+        store = EmbeddingStore()
+        topics = rng.normal(size=(n_topics, store.dim))
+        now = datetime.now(timezone.utc)
+        with store.lock:
+            for video_id in range(size):
+                vector = topics[rng.integers(n_topics)] + rng.normal(scale=0.8, size=store.dim)
+                store._upsert(video_id, 0, 0, 0, 0, now, vector / np.linalg.norm(vector))
+            store.loaded = True
+        return store
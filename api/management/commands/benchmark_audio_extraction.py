@@ -0,0 +1,116 @@
+import multiprocessing
+import os
+import resource
+import subprocess
+import tempfile
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from api.audio import extract_audio_chunks
+from api.download import _start_audio_extraction, cleanup_download, prefetched_audio_chunks
+
+PART_SIZE = 8 * 1024 * 1024  # S3RangeStream's default part size
+
+
+def ffmpeg_pipe_audio(video_path):
+    """Extraction from the downloaded file (transcribe_audio's fallback)."""
+    return sum(len(chunk) for chunk in extract_audio_chunks(video_path))
+
+
+def download_pipe_audio(video_path):
+    """
+    Extraction while downloading, as stream_s3_object does it: the video is copied part
+    by part and every part is also piped into ffmpeg. Includes the time of the copy.
+    """
+    copy_path = f"{video_path}.download.mp4"
+    ffmpeg = _start_audio_extraction(copy_path)
+    try:
+        with open(video_path, "rb") as source, open(copy_path, "wb") as copy:
+            for part in iter(lambda: source.read(PART_SIZE), b""):
+                copy.write(part)
+                ffmpeg.stdin.write(part)
+        ffmpeg.stdin.close()
+        if ffmpeg.wait() != 0:
+            raise RuntimeError(f"ffmpeg exited with {ffmpeg.returncode}")
+        return sum(os.path.getsize(chunk) for chunk in prefetched_audio_chunks(copy_path))
+    finally:
+        ffmpeg.kill()
+        cleanup_download(copy_path)
+
+
+def file_copy(video_path):
+    """The download alone, to separate it from download_pipe_audio's extraction time."""
+    copy_path = f"{video_path}.download.mp4"
+    try:
+        with open(video_path, "rb") as source, open(copy_path, "wb") as copy:
+            for part in iter(lambda: source.read(PART_SIZE), b""):
+                copy.write(part)
+        return 0
+    finally:
+        os.remove(copy_path)
+
+
+EXTRACTORS = {
+    "copy only": file_copy,
+    "download pipe": download_pipe_audio,
+    "ffmpeg pipe": ffmpeg_pipe_audio,
+}
+
+
+def write_synthetic_video(path, seconds, width, height):
+    subprocess.run(
+        [settings.FFMPEG_BINARY, "-v", "error", "-y",
+         "-f", "lavfi", "-i", f"testsrc=size={width}x{height}:rate=30",
+         "-f", "lavfi", "-i", "sine=frequency=440:sample_rate=44100",
+         "-t", str(seconds), "-c:v", "libx264", "-preset", "ultrafast", "-c:a", "aac",
+         "-movflags", "+faststart", path],  # index first, like phone exports, so audio can be read while downloading
+        check=True,
+    )
+
+
+def _measure(name, path, results):
+    try:
+        start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.perf_counter()
+        size = EXTRACTORS[name](path)
+        elapsed = time.perf_counter() - start
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start_rss
+        child_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        results.put((elapsed, peak_rss / 1024, child_rss / 1024, size, None))
+    except Exception as e:
+        results.put((0, 0, 0, 0, repr(e)))
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare time and peak RSS of audio extraction while downloading (stream_s3_object) and "
+        "from the downloaded file (extract_audio_chunks) on synthetic videos."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--lengths", type=int, nargs="+", default=[30, 120, 600], help="Video lengths in seconds.")
+        parser.add_argument("--width", type=int, default=1280)
+        parser.add_argument("--height", type=int, default=720)
+
+    def handle(self, *args, **options):
+        # Fresh forked process per run; ffmpeg runs as a child of it, so its RSS is reported separately
+        context = multiprocessing.get_context("fork")
+        with tempfile.TemporaryDirectory() as directory:
+            for seconds in options["lengths"]:
+                path = os.path.join(directory, f"synthetic_{seconds}s.mp4")
+                write_synthetic_video(path, seconds, options["width"], options["height"])
+                for name in EXTRACTORS:
+                    results = context.Queue()
+                    process = context.Process(target=_measure, args=(name, path, results))
+                    process.start()
+                    elapsed, peak_mb, child_mb, size, error = results.get()
+                    process.join()
+                    if error:
+                        self.stdout.write(f"{seconds:>4}s video  {name:<13} failed: {error}")
+                        continue
+                    self.stdout.write(
+                        f"{seconds:>4}s video  {name:<13} {elapsed * 1000:8.1f}ms  "
+                        f"python +{peak_mb:6.1f}MB  ffmpeg {child_mb:6.1f}MB  audio {size // 1024}KB"
+                    )
@@ -0,0 +1,37 @@
+import json
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from api.embedding_store import EMBEDDING_DIM
+from api.fields import VectorField
+
+
+class Command(BaseCommand):
+    help = "Compare row size and deserialization time of JSON and packed binary embeddings."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=2000, help="Number of synthetic embeddings.")
+        parser.add_argument("--dim", type=int, default=EMBEDDING_DIM)
+
+    def handle(self, *args, **options):
+        rng = np.random.default_rng(0)
+        vectors = rng.normal(size=(options["rows"], options["dim"]))
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+
+        encoded = [json.dumps(vector.tolist()) for vector in vectors]
+        self.report("json", encoded, lambda value: np.array(json.loads(value)))
+
+        for dtype in ("float32", "float16"):
+            field = VectorField(dtype=dtype)
+            packed = [field.get_prep_value(vector) for vector in vectors]
+            self.report(dtype, packed, field.unpack)
+
+    def report(self, name, values, decode):
+        start = time.perf_counter()
+        for value in values:
+            decode(value)
+        elapsed = time.perf_counter() - start
+        size = sum(len(value) for value in values) / len(values)
+        self.stdout.write(f"{name:>8}: {size / 1024:7.1f}KB/row  {1e6 * elapsed / len(values):8.1f}us/row to decode")
@@ -0,0 +1,84 @@
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+
+import cv2
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from api.frame_sampler import sample_frames
+
+
+def full_decode_frames(video_path, frame_interval=10):
+    """The previous extract_frames: read() every frame, keep one every frame_interval seconds."""
+    cap = cv2.VideoCapture(video_path)
+    frames = []
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    for i in range(frame_count):
+        ret, frame = cap.read()
+        if not ret:
+            break
+        if i % (frame_interval * int(fps)) == 0:
+            frames.append(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+    cap.release()
+    return frames
+
+
+SAMPLERS = {
+    "full decode": full_decode_frames,
+    "seek interval": lambda path: sample_frames(path, mode="interval")[0],
+    "seek scene": lambda path: sample_frames(path, mode="scene")[0],
+}
+
+
+def write_synthetic_video(path, seconds, fps, width, height, scene_seconds=4):
+    """Moving noise with a new colour scheme every scene_seconds, so scene detection has work to do."""
+    rng = np.random.default_rng(seconds)
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"mp4v"), fps, (width, height))
+    base = rng.integers(0, 255, (height, width, 3), dtype=np.uint8)
+    for i in range(int(seconds * fps)):
+        if i % int(scene_seconds * fps) == 0:
+            tint = rng.integers(0, 255, 3, dtype=np.uint8)
+        frame = np.roll(base, i * 4, axis=1) // 2 + tint // 2
+        writer.write(frame)
+    writer.release()
+
+
+def _measure(name, path, results):
+    start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    frames = SAMPLERS[name](path)
+    elapsed = time.perf_counter() - start
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results.put((elapsed, (peak_rss - start_rss) / 1024, len(frames)))
+
+
+class Command(BaseCommand):
+    help = "Compare decode time and peak memory of the frame samplers on synthetic videos."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--lengths", type=int, nargs="+", default=[15, 60, 180], help="Video lengths in seconds.")
+        parser.add_argument("--fps", type=int, default=30)
+        parser.add_argument("--width", type=int, default=1280)
+        parser.add_argument("--height", type=int, default=720)
+
+    def handle(self, *args, **options):
+        # Each run happens in a fresh forked process so the peak RSS belongs to that run only
+        context = multiprocessing.get_context("fork")
+        with tempfile.TemporaryDirectory() as directory:
+            for seconds in options["lengths"]:
+                path = os.path.join(directory, f"synthetic_{seconds}s.mp4")
+                write_synthetic_video(path, seconds, options["fps"], options["width"], options["height"])
+                for name in SAMPLERS:
+                    results = context.Queue()
+                    process = context.Process(target=_measure, args=(name, path, results))
+                    process.start()
+                    elapsed, peak_mb, count = results.get()
+                    process.join()
+                    self.stdout.write(
+                        f"{seconds:>4}s video  {name:<14} {elapsed * 1000:8.1f}ms  "
+                        f"peak +{peak_mb:6.1f}MB  {count} frames"
+                    )
@@ -0,0 +1,50 @@
+import statistics
+import time
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from api import views
+from api.storage import create_s3_client
+
+
+class Command(BaseCommand):
+    help = (
+        "Time the presigned-upload endpoint (VideoUploadView) with a new S3 client per request, "
+        "as before, and with the shared client from storage.py. Presigning is local, so no AWS "
+        "calls are made."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=200)
+
+    def handle(self, *args, **options):
+        factory = APIRequestFactory()
+        user = get_user_model()(username="benchmark")
+        view = views.VideoUploadView.as_view()
+
+        def call():
+            request = factory.post("/", {"fileName": "clip.mp4", "fileType": "video/mp4"}, format="json")
+            force_authenticate(request, user=user)
+            response = view(request)
+            assert response.status_code == 200, response.content
+
+        variants = {
+            "client per request": mock.patch.object(views, "get_s3_client", create_s3_client),
+            "shared client": mock.patch.object(views, "get_s3_client", views.get_s3_client),
+        }
+        for name, patch in variants.items():
+            with patch:
+                call()  # warm up imports and the shared client
+                latencies = []
+                for _ in range(options["requests"]):
+                    start = time.perf_counter()
+                    call()
+                    latencies.append((time.perf_counter() - start) * 1000)
+            latencies.sort()
+            self.stdout.write(
+                f"{name:<20} median {statistics.median(latencies):7.2f}ms  "
+                f"p95 {latencies[int(len(latencies) * 0.95) - 1]:7.2f}ms"
+            )
@@ -0,0 +1,127 @@
+import logging
+import multiprocessing
+import os
+import resource
+import subprocess
+import tempfile
+import time
+
+import boto3
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from api.audio import extract_audio_chunks
+from api.content_cache import file_digest
+from api.download import cleanup_download, prefetched_audio_chunks, stream_s3_object
+
+BUCKET = "benchmark-videos"
+
+
+def write_synthetic_video(path, seconds, faststart):
+    cmd = [settings.FFMPEG_BINARY, "-v", "error", "-y",
+           "-f", "lavfi", "-i", "testsrc=size=1280x720:rate=30",
+           "-f", "lavfi", "-i", "sine=frequency=440:sample_rate=44100",
+           "-t", str(seconds), "-c:v", "libx264", "-preset", "ultrafast", "-b:v", "8M", "-c:a", "aac"]
+    if faststart:
+        cmd += ["-movflags", "+faststart"]
+    subprocess.run(cmd + [path], check=True)
+
+
+def _client(endpoint):
+    return boto3.client("s3", endpoint_url=endpoint, region_name="us-east-1",
+                        aws_access_key_id="testing", aws_secret_access_key="testing")
+
+
+def download_file(endpoint, key, out_file, options):
+    """The previous download_asset: boto3's managed download."""
+    _client(endpoint).download_file(BUCKET, key, out_file)
+
+
+def ranged_stream(endpoint, key, out_file, options):
+    stream_s3_object(BUCKET, key, out_file, client=_client(endpoint), **options)
+
+
+DOWNLOADERS = {
+    "download_file": download_file,
+    "ranged stream": ranged_stream,
+}
+
+
+def _measure(name, endpoint, key, out_file, options, results):
+    try:
+        start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.perf_counter()
+        DOWNLOADERS[name](endpoint, key, out_file, options)
+        if not prefetched_audio_chunks(out_file):
+            for _ in extract_audio_chunks(out_file):
+                pass
+        elapsed = time.perf_counter() - start
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start_rss
+        results.put((elapsed, peak_rss / 1024, None))
+    except Exception as e:
+        results.put((0, 0, repr(e)))
+
+
+class Command(BaseCommand):
+    help = (
+        "Download synthetic videos from a local S3 stand-in (moto) with boto3's download_file "
+        "and with the concurrent ranged-GET stream, check the bytes and report the time until "
+        "the file and its audio are ready, peak RSS and whether the audio was extracted during "
+        "the download."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--lengths", type=int, nargs="+", default=[30, 120], help="Video lengths in seconds.")
+        parser.add_argument("--concurrency", type=int, default=settings.S3_TRANSFER_CONCURRENCY)
+        parser.add_argument("--part-size", type=int, default=settings.S3_PART_SIZE, help="Bytes per ranged GET.")
+        parser.add_argument("--max-buffered-parts", type=int, default=settings.S3_MAX_BUFFERED_PARTS)
+
+    def handle(self, *args, **options):
+        try:
+            from moto.server import ThreadedMotoServer
+        except ImportError:
+            raise CommandError("This benchmark needs moto: pip install 'moto[server]'")
+
+        logging.getLogger("werkzeug").setLevel(logging.ERROR)
+        server = ThreadedMotoServer(ip_address="127.0.0.1", port=0)
+        server.start()
+        host, port = server.get_host_and_port()
+        endpoint = f"http://{host}:{port}"
+        stream_options = {
+            "concurrency": options["concurrency"],
+            "part_size": options["part_size"],
+            "max_buffered_parts": options["max_buffered_parts"],
+        }
+        context = multiprocessing.get_context("fork")
+        try:
+            _client(endpoint).create_bucket(Bucket=BUCKET)
+            with tempfile.TemporaryDirectory() as directory:
+                for seconds in options["lengths"]:
+                    for faststart in (False, True):
+                        source = os.path.join(directory, f"source_{seconds}s_{faststart}.mp4")
+                        write_synthetic_video(source, seconds, faststart)
+                        key = os.path.basename(source)
+                        _client(endpoint).upload_file(source, BUCKET, key)
+                        label = f"{seconds:>4}s {'faststart' if faststart else 'moov last'}"
+                        self.stdout.write(f"{label}: {os.path.getsize(source) / 1024 ** 2:.1f}MB")
+                        for name in DOWNLOADERS:
+                            out_file = os.path.join(directory, f"download_{name.replace(' ', '_')}.mp4")
+                            results = context.Queue()
+                            process = context.Process(
+                                target=_measure, args=(name, endpoint, key, out_file, stream_options, results)
+                            )
+                            process.start()
+                            elapsed, peak_mb, error = results.get()
+                            process.join()
+                            if error:
+                                raise CommandError(f"{name} failed: {error}")
+                            if file_digest(out_file) != file_digest(source):
+                                raise CommandError(f"{name} downloaded different bytes")
+                            audio = len(prefetched_audio_chunks(out_file))
+                            self.stdout.write(
+                                f"    {name:<14} {elapsed * 1000:8.1f}ms  python +{peak_mb:6.1f}MB  "
+                                f"audio prefetched: {'yes' if audio else 'no'}"
+                            )
+                            cleanup_download(out_file)
+        finally:
+            server.stop()
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from api.content_cache import get_content_cache
+
+
+class Command(BaseCommand):
+    help = "Show hit/miss counts and size of the transcription/summary/embedding content cache."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--reset", action="store_true", help="Reset the counters after printing them.")
+        parser.add_argument("--clear", action="store_true", help="Drop every cached entry.")
+
+    def handle(self, *args, **options):
+        cache = get_content_cache()
+        for namespace, stats in sorted(cache.stats().items()):
+            self.stdout.write(
+                f"{namespace:<14} hits={stats['hits']} misses={stats['misses']} hit_rate={stats['hit_rate']:.1%} "
+                f"entries={stats['entries']} size={(stats['bytes'] or 0) / 1024 ** 2:.1f}MB"
+            )
+        if options["reset"]:
+            cache.reset_stats()
+        if options["clear"]:
+            cache.clear()
@@ -0,0 +1,27 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from api.engagement_queue import engagement_queue_stats, reset_engagement_queue_stats
+
+
+class Command(BaseCommand):
+    help = "Show backlog, consumer lag and throughput of the engagement event queue."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--reset", action="store_true", help="Reset the counters after printing them.")
+
+    def handle(self, *args, **options):
+        stats = engagement_queue_stats()
+        since = time.time() - stats["last_consumed_at"] if stats["last_consumed_at"] else None
+        self.stdout.write(
+            f"queued={stats['queued']} pending={stats['pending']} "
+            f"lag={stats['last_lag_seconds']:.1f}s max_lag={stats['max_lag_seconds']:.1f}s "
+            f"last_consumed={'never' if since is None else f'{since:.0f}s ago'}"
+        )
+        self.stdout.write(
+            f"applied={stats['applied']} duplicates={stats['duplicates']} dead_lettered={stats['dead_lettered']} batches={stats['batches']} "
+            f"last_batch={stats['last_batch_size']} avg_apply={stats['avg_apply_ms']:.1f}ms"
+        )
+        if options["reset"]:
+            reset_engagement_queue_stats()
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from api.feed import RANKING_STATS, RANKING_STATS_KEY, ranking_cache_stats
+from django.core.cache import cache
+
+
+class Command(BaseCommand):
+    help = "Show hit rate and compute cost of the ranked-video cache."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--reset", action="store_true", help="Reset the counters after printing them.")
+
+    def handle(self, *args, **options):
+        stats = ranking_cache_stats()
+        self.stdout.write(
+            f"hits={stats['hits']} patches={stats['patches']} misses={stats['misses']} "
+            f"hit_rate={stats['hit_rate']:.1%} avg_compute={stats['avg_compute_ms']:.1f}ms"
+        )
+        if options["reset"]:
+            cache.delete_many([RANKING_STATS_KEY.format(stat) for stat in RANKING_STATS])
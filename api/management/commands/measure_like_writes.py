@@ -0,0 +1,63 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from api.counters import increment_counter
+from api.models import PostRecord
+
+
+def _param_size(value):
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return len(value)
+    if isinstance(value, str):
+        return len(value.encode())
+    return 8
+
+
+def _read_modify_write_like(video_id):
+    video = PostRecord.objects.get(video_id=video_id)
+    video.likes += 1
+    video.save()
+
+
+def _f_expression_like(video_id):
+    increment_counter(video_id, "likes")
+
+
+class Command(BaseCommand):
+    help = (
+        "Report the bytes sent to the database per like of one video, with the F() update "
+        "and, with --compare, the old read-modify-write + save(). Nothing is written: each "
+        "like runs in a rolled back transaction. The lost-update check is in api/tests.py."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--video-id", type=int, required=True)
+        parser.add_argument("--compare", action="store_true",
+                            help="Also measure the old read-modify-write + save() path.")
+
+    def handle(self, *args, **options):
+        video_id = options["video_id"]
+        if not PostRecord.objects.filter(video_id=video_id).exists():
+            raise CommandError(f"Video {video_id} does not exist")
+
+        paths = [("F() update", _f_expression_like)]
+        if options["compare"]:
+            paths.append(("read-modify-write", _read_modify_write_like))
+
+        for name, like in paths:
+            self.stdout.write(f"{name}: {self.bytes_per_like(like, video_id)} bytes/like")
+
+    def bytes_per_like(self, like, video_id):
+        """SQL text plus parameters sent for one like, measured inside a rolled back transaction."""
+        written = 0
+
+        def measure(execute, sql, params, many, context):
+            nonlocal written
+            written += len(sql.encode()) + sum(_param_size(param) for param in params or ())
+            return execute(sql, params, many, context)
+
+        with transaction.atomic():
+            with connection.execute_wrapper(measure):
+                like(video_id)
+            transaction.set_rollback(True)
+        return written
@@ -0,0 +1,75 @@
+import json
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from api.models import PostRecord, UserData
+
+
+class Command(BaseCommand):
+    help = (
+        "Convert the JSON embedding columns (PostRecord.embedding and "
+        "UserData.user_preference_embeddings) to the packed binary format in place. "
+        "Afterwards run `makemigrations api` and `migrate api --fake` so the migration "
+        "state matches the converted columns."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=500, help="Rows converted per query.")
+
+    def handle(self, *args, **options):
+        for model, field_name in ((PostRecord, "embedding"), (UserData, "user_preference_embeddings")):
+            self.convert(model, model._meta.get_field(field_name), options["chunk_size"])
+
+    def convert(self, model, field, chunk_size):
+        table = model._meta.db_table
+        pk = model._meta.pk.column
+        column = field.column
+        temp_column = f"{column}_packed"
+        qn = connection.ops.quote_name
+
+        with connection.cursor() as cursor:
+            description = {col.name: col for col in connection.introspection.get_table_description(cursor, table)}
+        if connection.introspection.get_field_type(description[column].type_code, description[column]) == "BinaryField":
+            self.stdout.write(f"{table}.{column} is already binary, skipping.")
+            return
+
+        converted = 0
+        json_bytes = packed_bytes = 0
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(f"ALTER TABLE {qn(table)} ADD COLUMN {qn(temp_column)} {field.db_type(connection)} NULL")
+
+            last_pk = None
+            while True:
+                # Keyset pagination keeps every chunk an index range scan
+                if last_pk is None:
+                    cursor.execute(f"SELECT {qn(pk)}, {qn(column)} FROM {qn(table)} ORDER BY {qn(pk)} LIMIT %s", [chunk_size])
+                else:
+                    cursor.execute(f"SELECT {qn(pk)}, {qn(column)} FROM {qn(table)} WHERE {qn(pk)} > %s ORDER BY {qn(pk)} LIMIT %s",
+                                   [last_pk, chunk_size])
+                rows = cursor.fetchall()
+                if not rows:
+                    break
+
+                updates = []
+                for row_pk, value in rows:
+                    if isinstance(value, str):
+                        json_bytes += len(value)
+                        value = json.loads(value)
+                    else:
+                        json_bytes += len(json.dumps(value or []))
+                    packed = field.pack(value or [])
+                    packed_bytes += len(packed)
+                    updates.append((connection.Database.Binary(packed), row_pk))
+
+                cursor.executemany(f"UPDATE {qn(table)} SET {qn(temp_column)} = %s WHERE {qn(pk)} = %s", updates)
+                converted += len(rows)
+                last_pk = rows[-1][0]
+
+            cursor.execute(f"ALTER TABLE {qn(table)} DROP COLUMN {qn(column)}")
+            cursor.execute(f"ALTER TABLE {qn(table)} RENAME COLUMN {qn(temp_column)} TO {qn(column)}")
+
+        self.stdout.write(
+            f"Converted {converted} rows of {table}.{column}: "
+            f"{json_bytes / 1e6:.1f}MB as JSON -> {packed_bytes / 1e6:.1f}MB packed."
+        )
@@ -0,0 +1,142 @@
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from openai import OpenAI
+
+from api.content_cache import get_content_cache
+from api.embedding_store import EMBEDDING_DIM, notify_videos_changed
+from api.embeddings import EMBEDDING_MODEL, EmbeddingClient
+from api.feed import bump_interest_version
+from api.models import PostRecord, UserData
+from api.tasks import video_embedding_text
+
+
+class Command(BaseCommand):
+    help = (
+        "Re-embed every processed video from its stored username, tags, description and "
+        "summary (no video analysis), e.g. after the embedding text or model changed. "
+        "Progress is checkpointed, so an interrupted run resumes where it stopped. "
+        "Videos are embedded with EMBEDDING_MODEL (api/embeddings.py), the model new uploads "
+        "and users' interests use: to switch models change it (and EMBEDDING_DIM) and deploy "
+        "first, then run this with --reset-interests."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=500, help="Rows read, embedded and written per chunk.")
+        parser.add_argument("--workers", type=int, default=4, help="Chunks embedded in parallel.")
+        parser.add_argument("--missing-only", action="store_true", help="Only embed videos without an embedding.")
+        parser.add_argument("--checkpoint", default="reembed_posts.checkpoint.json", help="Progress file.")
+        parser.add_argument("--restart", action="store_true", help="Ignore the checkpoint and start from the first video.")
+        parser.add_argument(
+            "--reset-interests", action="store_true",
+            help="Afterwards clear every user's interest groups, which are in the old model's space after a model switch.",
+        )
+
+    def handle(self, *args, **options):
+        client = EmbeddingClient(
+            OpenAI(api_key=settings.OPENAI_API_KEY), EMBEDDING_MODEL,
+            max_concurrency=options["workers"], cache=get_content_cache(),
+        )
+        # Vectors of another size would not fit the embedding store or the interest groups
+        dimension = len(client.embed("dimension check"))
+        if dimension != EMBEDDING_DIM:
+            raise CommandError(
+                f"{EMBEDDING_MODEL} returns {dimension}-dimensional embeddings, the store expects "
+                f"{EMBEDDING_DIM}; update EMBEDDING_DIM (api/embedding_store.py) together with the model."
+            )
+
+        checkpoint = self.load_checkpoint(options)
+        last_video_id = checkpoint["last_video_id"]
+        if last_video_id:
+            self.stdout.write(f"Resuming after video {last_video_id} ({checkpoint['rows']} rows done).")
+
+        rows = 0
+        start = time.perf_counter()
+        in_flight = deque()
+
+        with ThreadPoolExecutor(options["workers"]) as pool:
+            for chunk in self.chunks(last_video_id, options["chunk_size"], options["missing_only"]):
+                texts = [video_embedding_text(video, video.summary) for video in chunk]
+                in_flight.append((chunk, pool.submit(client.embed_many, texts)))
+                # Chunks are written in read order so the checkpoint only ever moves forward
+                while len(in_flight) >= options["workers"] or (in_flight and in_flight[0][1].done()):
+                    rows += self.write(*in_flight.popleft(), checkpoint, options)
+                    self.report(rows, start)
+            while in_flight:
+                rows += self.write(*in_flight.popleft(), checkpoint, options)
+                self.report(rows, start)
+
+        elapsed = time.perf_counter() - start
+        self.stdout.write(self.style.SUCCESS(
+            f"Re-embedded {rows} videos in {elapsed:.1f}s ({rows / elapsed if elapsed else 0:.1f} rows/sec, "
+            f"{client.requests} embedding requests)."
+        ))
+        if options["reset_interests"]:
+            self.reset_interests()
+        if os.path.exists(options["checkpoint"]):
+            os.remove(options["checkpoint"])
+
+    def chunks(self, last_video_id, chunk_size, missing_only):
+        """Processed videos after last_video_id, chunk_size at a time (keyset pagination)."""
+        videos = (
+            PostRecord.objects.filter(summary__isnull=False)
+            .select_related('user')
+            .only('video_id', 'user__username', 'tags', 'description', 'summary')
+            .order_by('video_id')
+        )
+        if missing_only:
+            videos = videos.filter(embedding=b"")
+        while True:
+            chunk = list(videos.filter(video_id__gt=last_video_id)[:chunk_size])
+            if not chunk:
+                return
+            yield chunk
+            last_video_id = chunk[-1].video_id
+
+    def write(self, chunk, future, checkpoint, options):
+        embeddings = future.result()
+        if any(len(embedding) != EMBEDDING_DIM for embedding in embeddings):
+            raise CommandError(f"Got an embedding that is not {EMBEDDING_DIM}-dimensional, stopping.")
+        for video, embedding in zip(chunk, embeddings):
+            video.embedding = embedding
+        PostRecord.objects.bulk_update(chunk, ['embedding'], batch_size=100)
+        notify_videos_changed([video.video_id for video in chunk])
+
+        checkpoint["last_video_id"] = chunk[-1].video_id
+        checkpoint["rows"] += len(chunk)
+        self.save_checkpoint(checkpoint, options)
+        return len(chunk)
+
+    def reset_interests(self):
+        """Clear every user's interest groups; they are rebuilt from new engagement."""
+        users = UserData.objects.update(user_preference_embeddings=[])
+        for user_id in UserData.objects.values_list('user_id', flat=True).iterator():
+            bump_interest_version(user_id)  # cached rankings and feed queues were built from the old interests
+        self.stdout.write(f"Cleared the interest groups of {users} users.")
+
+    def report(self, rows, start):
+        elapsed = time.perf_counter() - start
+        self.stdout.write(f"{rows} rows, {rows / elapsed if elapsed else 0:.1f} rows/sec")
+
+    def load_checkpoint(self, options):
+        fresh = {"last_video_id": 0, "rows": 0, "model": EMBEDDING_MODEL}
+        if options["restart"] or not os.path.exists(options["checkpoint"]):
+            return fresh
+        with open(options["checkpoint"]) as f:
+            checkpoint = json.load(f)
+        if checkpoint.get("model") != EMBEDDING_MODEL:
+            self.stdout.write(self.style.WARNING("Checkpoint is for another model, starting over."))
+            return fresh
+        return checkpoint
+
+    def save_checkpoint(self, checkpoint, options):
+        # Write and rename so a crash never leaves a half-written checkpoint
+        temp_path = options["checkpoint"] + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(checkpoint, f)
+        os.replace(temp_path, options["checkpoint"])
@@ -1,5 +1,6 @@
 from django.db import models
 from django.contrib.auth.models import UserManager, PermissionsMixin, AbstractBaseUser
+from .fields import VectorField, InterestGroupsField, empty_vector
 
 
 # Tables in RDS's Postgresql database
@@ -74,8 +75,8 @@ class User(AbstractBaseUser, PermissionsMixin):
 
 class UserData(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True)
-    #create array of floats
-    user_preference_embeddings = models.JSONField(default=list, blank=True)
+    # list of {"embedding": vector, "weight": float} interest groups, stored packed
+    user_preference_embeddings = InterestGroupsField(default=list, blank=True)
     
     def __str__(self):
         return self.user.username
@@ -90,6 +91,15 @@ class LikedPosts(models.Model):
     video = models.ForeignKey('PostRecord', on_delete=models.CASCADE)
     date = models.DateTimeField(auto_now_add=True)
 
+# Engagement events already applied, written in the same transaction (see engagement.py)
+class ProcessedEngagementEvent(models.Model):
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    event_id = models.CharField(max_length=64)                      # client-supplied or generated, unique per user
+    date_processed = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        unique_together = ('user', 'event_id')
+
 # Video metadata table
 class PostRecord(models.Model):
     video_id = models.AutoField(primary_key = True, unique=True)      # unique id number, can be used for hashing
@@ -111,7 +121,7 @@ class PostRecord(models.Model):
     thumbnail_link = models.CharField(max_length=500, null=True, blank=True)  # link to the thumbnail
     transcription = models.TextField(null=True, blank=True)                   # transcription of the video
     summary = models.TextField(null=True, blank=True)               # description of the video
-    embedding = models.JSONField(default=list, blank=True)                        # video embedding
+    embedding = VectorField(default=empty_vector, blank=True)                     # video embedding (packed float32)
 
 class CommentRecord(models.Model):
     comment_id = models.AutoField(primary_key = True, unique=True)    # unique id number, can be used for hashing
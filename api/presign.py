@@ -0,0 +1,150 @@
+"""
+Fast presigned PUT URLs for many objects at once.
+
+client.generate_presigned_url builds and signs a full botocore request per call and
+derives the SigV4 signing key every time (four HMACs), about 0.3ms per URL. An HLS
+upload needs one URL per segment, so HLSUploadView uses BatchPresigner instead: it
+derives the signing key once and signs each key with a single HMAC over the same
+canonical request botocore would build, producing byte-identical URLs (checked by PresignTests in api/tests.py).
+
+The endpoint (host, addressing style) and signing region are taken from one real
+presigned URL per client and bucket, so custom endpoints and path-style addressing
+come out the same as with boto3. Clients that do not presign with SigV4, or whose
+credentials botocore no longer keeps where _credentials() looks, fall back to
+generate_presigned_url.
+"""
+
+import datetime
+import hashlib
+import hmac
+import threading
+import weakref
+from urllib.parse import quote, urlsplit, unquote
+
+ALGORITHM = "AWS4-HMAC-SHA256"
+UNSIGNED_PAYLOAD = "UNSIGNED-PAYLOAD"
+_PROBE_KEY = "presign-probe"
+
+# client -> {bucket: endpoint}; weak, so a new client never inherits a collected one's entry
+_endpoints = weakref.WeakKeyDictionary()
+_endpoints_lock = threading.Lock()
+
+
+def _endpoint(client, bucket):
+    """(scheme, host, path prefix of the keys, signing region) of put_object URLs for bucket."""
+    with _endpoints_lock:
+        endpoint = _endpoints.get(client, {}).get(bucket)
+    if endpoint is None:
+        url = urlsplit(client.generate_presigned_url("put_object", Params={"Bucket": bucket, "Key": _PROBE_KEY}))
+        query = dict(part.split("=", 1) for part in url.query.split("&"))
+        # None when the client presigns with something other than SigV4 (legacy regions/configs)
+        region = unquote(query["X-Amz-Credential"]).split("/")[2] if query.get("X-Amz-Algorithm") == ALGORITHM else None
+        endpoint = (url.scheme, url.netloc, url.path[:-len(_PROBE_KEY)], region)
+        with _endpoints_lock:
+            _endpoints.setdefault(client, {})[bucket] = endpoint
+    return endpoint
+
+
+def _credentials(client):
+    """
+    The client's current frozen credentials. botocore keeps the (possibly refreshing)
+    credentials on the client's private request signer; None if it stops doing so.
+    """
+    credentials = getattr(getattr(client, "_request_signer", None), "_credentials", None)
+    if not hasattr(credentials, "get_frozen_credentials"):
+        return None
+    return credentials.get_frozen_credentials()
+
+
+def _percent_encode(value, safe="-_.~"):
+    return quote(str(value), safe=safe)
+
+
+def _sign(key, message):
+    return hmac.new(key, message.encode("utf-8"), hashlib.sha256).digest()
+
+
+class BatchPresigner:
+    """
+    Presigns PUT URLs for keys of one bucket with a single timestamp and signing key.
+
+        presigner = BatchPresigner(get_s3_client(), bucket, expires_in=3600)
+        urls = {key: presigner.put_url(key, content_type) for key in keys}
+    """
+
+    def __init__(self, client, bucket, expires_in=3600, now=None):
+        self.scheme, self.host, self.path_prefix, region = _endpoint(client, bucket)
+        self._client, self._bucket, self._expires_in = client, bucket, expires_in
+        credentials = _credentials(client) if region is not None else None
+        self.fast = credentials is not None
+        if not self.fast:
+            return
+        now = now or datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        self.timestamp = now.strftime("%Y%m%dT%H%M%SZ")
+        date = now.strftime("%Y%m%d")
+        self.scope = f"{date}/{region}/s3/aws4_request"
+
+        signing_key = _sign(f"AWS4{credentials.secret_key}".encode("utf-8"), date)
+        for part in (region, "s3", "aws4_request"):
+            signing_key = _sign(signing_key, part)
+        self._hmac = hmac.new(signing_key, digestmod=hashlib.sha256)
+
+        self._auth_params = [
+            ("X-Amz-Algorithm", ALGORITHM),
+            ("X-Amz-Credential", f"{credentials.access_key}/{self.scope}"),
+            ("X-Amz-Date", self.timestamp),
+            ("X-Amz-Expires", expires_in),
+        ]
+        self._token = credentials.token
+        self._string_to_sign_prefix = f"{ALGORITHM}\n{self.timestamp}\n{self.scope}\n".encode("utf-8")
+        self._templates = {}
+
+    def _template(self, content_type):
+        """Everything but the path of the query string and canonical request, per content type."""
+        if content_type not in self._templates:
+            headers = [("host", self.host)]
+            if content_type is not None:
+                headers.insert(0, ("content-type", " ".join(content_type.split())))
+            signed_headers = ";".join(name for name, _ in headers)
+
+            params = self._auth_params + [("X-Amz-SignedHeaders", signed_headers)]
+            if self._token is not None:
+                params.append(("X-Amz-Security-Token", self._token))
+            encoded = [(name, _percent_encode(value)) for name, value in params]
+            query = "&".join(f"{name}={value}" for name, value in encoded)
+            canonical_rest = "\n".join([
+                "&".join(f"{name}={value}" for name, value in sorted(encoded)),
+                "".join(f"{name}:{value}\n" for name, value in headers),
+                signed_headers,
+                UNSIGNED_PAYLOAD,
+            ])
+            self._templates[content_type] = (query, canonical_rest)
+        return self._templates[content_type]
+
+    def put_url(self, key, content_type=None):
+        """Presigned PUT URL for key, as client.generate_presigned_url('put_object', ...) returns it."""
+        if not self.fast:
+            params = {"Bucket": self._bucket, "Key": key}
+            if content_type is not None:
+                params["ContentType"] = content_type
+            return self._client.generate_presigned_url("put_object", Params=params, ExpiresIn=self._expires_in)
+
+        query, canonical_rest = self._template(content_type)
+        path = self.path_prefix + _percent_encode(key, safe="/~")
+        canonical_request = f"PUT\n{path}\n{canonical_rest}".encode("utf-8")
+        signature = self._hmac.copy()
+        signature.update(self._string_to_sign_prefix + hashlib.sha256(canonical_request).hexdigest().encode())
+        return f"{self.scheme}://{self.host}{path}?{query}&X-Amz-Signature={signature.hexdigest()}"
+
+def presigned_post_for_prefix(client, bucket, prefix, expires_in=3600):
+    """
+    One POST policy allowing uploads of any key under prefix (the alternative to a URL
+    per file). The form's `key` is prefix + "${filename}"; S3 substitutes the uploaded
+    file's name. Content-Type is a form field the uploader sets per file.
+    """
+    return client.generate_presigned_post(
+        Bucket=bucket,
+        Key=f"{prefix}${{filename}}",
+        Conditions=[["starts-with", "$Content-Type", ""]],
+        ExpiresIn=expires_in,
+    )
@@ -12,9 +12,33 @@ def compare_embeddings(embedding1, embedding2):
 LEARNING_RATE = 0.1
 MATCH_THRESHOLD = 0.55
 
+# How much an interest group has to move before the user's feed is worth re-ranking
+MATERIAL_DRIFT = 0.01           # cosine distance between old and new interest embedding
+MATERIAL_WEIGHT_CHANGE = 0.05
+
 def update_user_data(video, user_data, engagement):
-    video_embedding = video.embedding
+    """
+    Move the user's interests towards the video by the engagement amount and save them.
+    Returns True when the interests changed materially (new or merged interest group,
+    or a noticeable drift), i.e. when a precomputed feed should be re-ranked.
+    """
     user_current_embeddings = user_data.user_preference_embeddings
+    material_change = apply_engagement(user_current_embeddings, video.embedding, engagement)
+
+    user_data.user_preference_embeddings = user_current_embeddings
+    user_data.save()
+
+    # save weights and embeddings to npy file with datetime
+    #np.save(f'user_snapshots/{user_data.user_id}_{datetime.now().strftime("%Y%m%d_%H%M%S")}.npy', user_current_embeddings)
+
+    return material_change
+
+def apply_engagement(user_current_embeddings, video_embedding, engagement):
+    """
+    In-memory part of update_user_data: updates the list of interest groups in place
+    and returns whether it changed materially. Lets callers apply several engagements
+    before saving once.
+    """
 
     # Find most similar embedding in user_current_embeddings or make new one
     max_interest_score = 0
@@ -38,10 +62,7 @@ def update_user_data(video, user_data, engagement):
         new_user_embedding = video_embedding
         weight = engagement
         user_current_embeddings.append({"embedding": new_user_embedding, "weight": weight})
-        user_data.user_preference_embeddings = user_current_embeddings
-        user_data.save()
-        #np.save(f'user_snapshots/{user_data.user_id}_{datetime.now().strftime("%Y%m%d_%H%M%S")}.npy', user_current_embeddings)
-        return
+        return True
 
     #print("Best interest index: ", best_interest_index)
     #print("Interest score: ", max_interest_score)    
@@ -61,6 +82,9 @@ def update_user_data(video, user_data, engagement):
     delta_weight = 0.5 * calculate_delta(matching_interest_weight, engagement)
     new_user_weight = min(max(matching_interest_weight + delta_weight, 0), 1)  # Clamp to [0, 1]
     
+    drift = 1 - compare_embeddings(matching_interest_embedding / np.linalg.norm(matching_interest_embedding), new_user_embedding)
+    material_change = drift > MATERIAL_DRIFT or abs(new_user_weight - matching_interest_weight) > MATERIAL_WEIGHT_CHANGE
+
     # merge interests if they are similar with the new one
     for index, interest_group in enumerate(user_current_embeddings):
         if index == best_interest_index or len(interest_group["embedding"]) == 0:
@@ -71,15 +95,12 @@ def update_user_data(video, user_data, engagement):
             new_user_embedding = (new_user_embedding + interest_group["embedding"]) / 2
             new_user_embedding = new_user_embedding / np.linalg.norm(new_user_embedding) #normalize
             user_current_embeddings.pop(index)
+            material_change = True
             break
 
     user_current_embeddings[best_interest_index] = {"embedding": new_user_embedding.tolist(), "weight": new_user_weight}
-    
-    user_data.user_preference_embeddings = user_current_embeddings
-    user_data.save()
 
-    # save weights and embeddings to npy file with datetime
-    #np.save(f'user_snapshots/{user_data.user_id}_{datetime.now().strftime("%Y%m%d_%H%M%S")}.npy', user_current_embeddings)
+    return material_change
 
 def get_days_since_upload(video):
     return (video.date_uploaded - datetime.now(timezone.utc)).days
@@ -114,6 +135,34 @@ def score_interest(user_interests, other, threshold=0.25):
 
     return interest_score
 
+def score_interests(user_interests, embeddings, threshold=0.25):
+    """Vectorized score_interest: scores every row of `embeddings` with one matrix product."""
+    embeddings = np.asarray(embeddings)
+    interest_groups = [group for group in user_interests if len(group["embedding"]) > 0]
+    if len(interest_groups) == 0 or len(embeddings) == 0:
+        return np.zeros(len(embeddings))
+
+    interest_embeddings = np.array([group["embedding"] for group in interest_groups], dtype=embeddings.dtype)
+    interest_weights = np.array([group["weight"] for group in interest_groups], dtype=np.float64)
+
+    similarity = embeddings @ interest_embeddings.T             # (videos, interests)
+    weighted = similarity * interest_weights
+    similar = similarity > threshold
+    num_similar = similar.sum(axis=1)
+    summed_score = np.where(similar, weighted, 0).sum(axis=1)
+    best_score = np.maximum(weighted.max(axis=1), 0)
+
+    # Same rules as score_interest: reward several similar interests, fall back to the best one
+    multiple = num_similar > 1
+    interest_scores = np.where(num_similar == 0, best_score, summed_score)
+    interest_scores[multiple] = np.minimum(summed_score[multiple] / (num_similar[multiple] / 2.0), 1)
+
+    return interest_scores
+
+INTEREST_WEIGHT = 0.6
+RECENTNESS_WEIGHT = 0.2
+ENGAGEMENT_WEIGHT = 0.2
+
 def calculate_video_rank(user_data, video):
     user_interests = user_data.user_preference_embeddings
 
@@ -125,11 +174,28 @@ def calculate_video_rank(user_data, video):
     recentness_score = max(10 - get_days_since_upload(video), 0) / 10 # percentage out of 10 days since upload
     engagement_rate = 0 if video.views <= 0 else (video.likes + video.comments) / video.views # percentage of views that engaged with video
 
-    interest_weight = 0.6
-    recentness_weight = 0.2
-    engagement_weight = 0.2
+    return (interest_score, interest_score * INTEREST_WEIGHT + recentness_score * RECENTNESS_WEIGHT + engagement_rate * ENGAGEMENT_WEIGHT)
+
+def calculate_video_ranks(user_data, videos):
+    """
+    Vectorized calculate_video_rank over an EmbeddingStore (or anything exposing the same arrays).
+    Returns (interest_scores, rank_scores) arrays aligned with videos.video_ids.
+    """
+    interest_scores = score_interests(user_data.user_preference_embeddings, videos.embeddings, MATCH_THRESHOLD)
+
+    # timedelta.days floors, so np.floor keeps the same day boundaries as get_days_since_upload
+    days_since_upload = np.floor((videos.date_uploaded - datetime.now(timezone.utc).timestamp()) / 86400)
+    recentness_scores = np.maximum(10 - days_since_upload, 0) / 10
+    engagement_rates = np.divide(videos.likes + videos.comments, videos.views,
+                                 out=np.zeros(len(videos.views)), where=videos.views > 0)
 
-    return (interest_score, interest_score * interest_weight + recentness_score * recentness_weight + engagement_rate * engagement_weight)
+    rank_scores = interest_scores * INTEREST_WEIGHT + recentness_scores * RECENTNESS_WEIGHT + engagement_rates * ENGAGEMENT_WEIGHT
+
+    # Videos that have not been embedded yet are ranked like calculate_video_rank does
+    interest_scores = np.where(videos.has_embedding, interest_scores, 0)
+    rank_scores = np.where(videos.has_embedding, rank_scores, 1)
+
+    return interest_scores, rank_scores
 
 def calculate_engagement_score(video_duration, watch_time, liked, commented, viewed_comments):
     if video_duration <= 0:
@@ -172,10 +238,7 @@ def output_user_preferences(user_data):
 
     user_interests = user_data.user_preference_embeddings
 
-    scores = [0] * len(cat_embeddings)
-
-    for i, cat_embedding in enumerate(cat_embeddings):
-        scores[i] = score_interest(user_interests, cat_embedding)
+    scores = score_interests(user_interests, cat_embeddings).tolist()
 
     #print (f"Scores: {scores}")
 
@@ -1,16 +1,16 @@
 import numpy as np
-import openai
 import os
+import sys
 
-client = openai.Client(api_key=os.getenv("OPENAI_API_KEY"))
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from api.content_cache import get_content_cache
+from api.embeddings import get_embedding_client
 
 def generate_video_embedding(video_description):
     return generate_embedding(video_description)
 
 def generate_embedding(text):
-    embedding = client.embeddings.create(input=[text], model="text-embedding-3-small").data[0].embedding
-    print("Got embedding")
-    return np.array(embedding)
+    return get_embedding_client().embed(text)
 
 def compare_embeddings(embedding1, embedding2):
     return np.dot(embedding1, embedding2)
@@ -23,20 +23,14 @@ output_file = 'data/catagory_embeddings.npy'
 with open(input_file, 'r') as f:
     video_categories = [line.strip() for line in f.readlines()]  # Read and clean each line
 
-# Prepare storage for categories and embeddings
-categories = []
-embeddings = []
-
-# Process each category
-for category in video_categories:
-    # Generate embedding for the category
-    embedding = generate_embedding(category)
-    
-    # Store the category and its embedding
-    categories.append(category)
-    embeddings.append(embedding)
+# Embed all categories with as few batched requests as possible; categories embedded
+# by an earlier run come from the content cache
+categories = video_categories
+embeddings = get_embedding_client().embed_many(categories)
+print(f"Embedded {len(categories)} categories with {get_embedding_client().requests} requests")
 
 # Save categories and embeddings in a .npy file
 np.save(output_file, {'categories': categories, 'embeddings': np.array(embeddings)})
 
 print(f"Embeddings for video categories have been stored in '{output_file}'")
+print(f"Content cache: {get_content_cache().stats().get('embedding')}")
@@ -0,0 +1,103 @@
+"""
+Shared S3 client.
+
+Creating a boto3 client resolves credentials, loads the service model and builds an
+endpoint, which costs tens of milliseconds, and every client has its own connection
+pool. get_s3_client() creates one client per process on first use and hands it to
+every view, task and script (boto3 clients are thread-safe), with the pool size and
+retry policy from settings.
+
+Celery's prefork workers fork after the app is imported and a client's pooled
+connections must not be shared across processes, so a forked child builds its own.
+
+Like content_cache.py this module does not need Django; without it the client uses
+boto3's default credential chain and the S3_* environment variables.
+"""
+
+import os
+import threading
+
+import boto3
+from botocore.config import Config
+
+DEFAULT_MAX_POOL_CONNECTIONS = 32
+DEFAULT_MAX_RETRIES = 5
+RETRY_MODE = "adaptive"   # standard retries plus client-side rate limiting on throttling errors
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def _options():
+    options = {
+        "aws_access_key_id": os.environ.get("AWS_ACCESS_KEY_ID"),
+        "aws_secret_access_key": os.environ.get("AWS_SECRET_ACCESS_KEY"),
+        "region_name": os.environ.get("AWS_REGION"),
+        "max_pool_connections": int(os.environ.get("S3_MAX_POOL_CONNECTIONS", DEFAULT_MAX_POOL_CONNECTIONS)),
+        "max_retries": int(os.environ.get("S3_MAX_RETRIES", DEFAULT_MAX_RETRIES)),
+    }
+    try:
+        from django.conf import settings
+        if settings.configured:
+            options.update(
+                aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
+                aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
+                region_name=settings.AWS_REGION,
+                max_pool_connections=getattr(settings, "S3_MAX_POOL_CONNECTIONS", options["max_pool_connections"]),
+                max_retries=getattr(settings, "S3_MAX_RETRIES", options["max_retries"]),
+            )
+    except ImportError:
+        pass
+    return options
+
+
+def create_s3_client(max_pool_connections=None, max_retries=None, **client_options):
+    """A new S3 client with the pool and retry settings (use get_s3_client unless you need a separate one)."""
+    options = _options()
+    config = Config(
+        max_pool_connections=max_pool_connections or options["max_pool_connections"],
+        retries={"max_attempts": max_retries if max_retries is not None else options["max_retries"], "mode": RETRY_MODE},
+    )
+    session = boto3.session.Session(
+        aws_access_key_id=options["aws_access_key_id"],
+        aws_secret_access_key=options["aws_secret_access_key"],
+        region_name=options["region_name"],
+    )
+    return session.client("s3", config=config, **client_options)
+
+
+def get_s3_client():
+    """This process's shared S3 client."""
+    pid = os.getpid()
+    if pid not in _clients:
+        with _clients_lock:
+            if pid not in _clients:
+                _clients.clear()  # clients inherited from the parent process
+                _clients[pid] = create_s3_client()
+    return _clients[pid]
+
+
+def list_objects(bucket, prefix, client=None):
+    """Every object under prefix as list_objects_v2 describes it (Key, Size, ...)."""
+    paginator = (client or get_s3_client()).get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        yield from page.get("Contents", [])
+
+
+def list_keys(bucket, prefix, client=None):
+    """Every key under prefix (paginated list_objects_v2)."""
+    for obj in list_objects(bucket, prefix, client):
+        yield obj["Key"]
+
+
+def delete_keys(bucket, keys, client=None):
+    """Delete keys with DeleteObjects, 1000 per call; returns {key: error} of the ones S3 refused."""
+    client = client or get_s3_client()
+    keys = list(dict.fromkeys(keys))
+    errors = {}
+    for i in range(0, len(keys), 1000):
+        response = client.delete_objects(
+            Bucket=bucket, Delete={"Objects": [{"Key": key} for key in keys[i:i + 1000]], "Quiet": True}
+        )
+        errors.update({error["Key"]: error.get("Message", error.get("Code")) for error in response.get("Errors", [])})
+    return errors
@@ -1,22 +1,31 @@
 import os
 import json
-import cv2
-import boto3
+import time
+import shutil
 import tempfile
-from celery import shared_task
-from moviepy import VideoFileClip
-from PIL import Image
-import base64
+from celery import shared_task, chain, chord
 from django.core.files.storage import default_storage
+from django.core.cache import cache
+from django.db.models import Count
+from django.utils import timezone
 from django.conf import settings
 from openai import OpenAI
 
-import numpy as np
-from .models import PostRecord, ViewedPosts, LikedPosts, CommentRecord
+from .models import PostRecord, ViewedPosts, LikedPosts, CommentRecord, UserData
 import logging
 logger = logging.getLogger(__name__)
 
-from .download import download_asset   # new helper
+from .storage import delete_keys, get_s3_client
+from .download import download_asset, cleanup_download, prefetched_audio_chunks, stream_s3_object   # new helper
+from .hls import transcode_ladder, upload_directory, MASTER_PLAYLIST
+from .frame_sampler import sample_frames, encode_frames
+from .audio import extract_audio_chunks, AUDIO_SAMPLE_RATE, AUDIO_BITRATE, CHUNK_SECONDS
+from .content_cache import get_content_cache, content_key, file_digest
+from .embeddings import get_embedding_client
+from .embedding_store import notify_video_changed, get_catalog_version
+from .feed import get_ranked_videos, save_feed_queue, bump_interest_version, get_interest_version
+from .engagement import apply_engagement_events, apply_like_events, prune_processed_events
+from .engagement_queue import get_engagement_queue, record_queue_stat, record_batch, FLUSH_DELAY, MAX_DELIVERIES, READ_COUNT
 
 
 #settings.configure()
@@ -24,65 +33,225 @@ from .download import download_asset   # new helper
 
 client = OpenAI(api_key=settings.OPENAI_API_KEY)
 
-# Initialize S3 Client
-s3_client = boto3.client("s3", aws_access_key_id=settings.AWS_ACCESS_KEY_ID, aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY)
+# S3 client: get_s3_client() (shared per process, see storage.py)
 #AWS_ACCESS_KEY_ID = config('AWS_ACCESS_KEY_ID')
 #AWS_SECRET_ACCESS_KEY = config('AWS_SECRET_ACCESS_KEY')
 #AWS_BUCKET = config('AWS_BUCKET')
 #s3_client = boto3.client("s3", aws_access_key_id=AWS_ACCESS_KEY_ID, aws_secret_access_key=AWS_SECRET_ACCESS_KEY)
 
+SUMMARY_MODEL = "gpt-4o-mini"
+TRANSCRIPTION_MODEL = "whisper-1"
+
 def generate_embedding(text):
-    embedding = client.embeddings.create(input=[text], model="text-embedding-3-small").data[0].embedding
-    return np.array(embedding)
+    # Cached and batched with concurrent calls, see embeddings.py
+    return get_embedding_client().embed(text)
+
+def video_embedding_text(video_record, summary):
+    """The text a video is embedded from (also used by the reembed_posts command)."""
+    username = video_record.user.username
+    tags = video_record.tags
+    tag_string = ""
+    for tag in tags:
+        tag_string += f"\\T {tag} "
+    caption = video_record.description
+    return f"@{username} {tag_string} Caption: {caption}\n Video Summary: {summary}"
+
+# Every pipeline stage retries with exponential backoff (1s, 2s, 4s, ... capped at 5 min)
+STAGE_RETRY = dict(
+    autoretry_for=(Exception,),
+    dont_autoretry_for=(PostRecord.DoesNotExist,),
+    retry_backoff=True,
+    retry_backoff_max=300,
+    retry_jitter=True,
+    max_retries=5,
+)
 
 @shared_task
 def process_video(video_id, task_id):
-    """Processes video from an S3 URL and extracts captions & transcription."""
+    """
+    Processes video from an S3 URL and extracts captions & transcription.
+
+    Runs as a pipeline of retried stages, each checkpointing its result on the
+    PostRecord so a re-run skips the finished ones:
+
+        download -> [transcribe | extract frames] -> summarize -> embed
+    """
     # check if the video_id is valid
     if not PostRecord.objects.filter(video_id=video_id).exists():
         return {"status": "failed", "message": "Video record not found"}
-    video_record = PostRecord.objects.get(video_id=video_id)
-    video_s3_url = video_record.link
-    temp_file = download_asset(video_s3_url)
+
+    # The chord that reads the file is built once the download stage knows its path
+    pipeline = chain(
+        download_video_stage.s(video_id),
+        analyze_video_stage.s(video_id, task_id),
+    )
+    pipeline.apply_async()
+    return {"status": "started", "task_id": task_id}
+
+def analysis_pipeline(temp_file, video_id, task_id):
+    """
+    [transcribe | extract frames] -> summarize -> embed on the downloaded temp_file.
+
+    The one cleanup errback sits on the chord: the result backend calls it when
+    summarize_stage fails for good, or when a header stage did, but only once every
+    header stage has returned, so it never deletes the file under the other one.
+    """
+    # embed_stage is linked rather than chained: a chain would fold it into the chord
+    # body, and the backend only calls the errbacks of the body signature itself
+    summarize = summarize_stage.s(video_id)
+    summarize.link(embed_stage.s(video_id, task_id))
+    return chord(
+        [transcribe_stage.s(temp_file, video_id), extract_frames_stage.s(temp_file, video_id)],
+        summarize,
+    ).on_error(cleanup_stage.s(temp_file))
+
+@shared_task
+def analyze_video_stage(temp_file, video_id, task_id):
+    try:
+        analysis_pipeline(temp_file, video_id, task_id).apply_async()
+    except Exception:
+        # Not started, or run in place by eager Celery, whose chords skip the errback
+        # when a header stage fails: nothing else will delete the file
+        if temp_file:
+            cleanup(temp_file)
+        raise
+
+def _download(video_id):
+    video_record = PostRecord.objects.only('link').get(video_id=video_id)
+    temp_file = download_asset(video_record.link)
     if not temp_file:
-        return {"status": "failed", "message": "Video download failed"}
+        raise IOError(f"Video download failed: {video_record.link}")
+    return temp_file
 
+def _with_local_video(video_id, temp_file, stage):
+    """
+    Run stage(path) on the downloaded video. Workers that do not have the download
+    stage's file (another host, or the file is gone) fetch their own temporary copy.
+    """
+    if temp_file and os.path.exists(temp_file):
+        return stage(temp_file)
+    own_file = _download(video_id)
+    try:
+        return stage(own_file)
+    finally:
+        cleanup(own_file)
+
+@shared_task(**STAGE_RETRY)
+def download_video_stage(video_id):
+    video_record = PostRecord.objects.only('summary').get(video_id=video_id)
+    if video_record.summary is not None:
+        return None  # everything that needs the file is done
+    temp_file = _download(video_id)
     logger.info(f"[INFO] Processing video: {temp_file}")
+    return temp_file
 
-    # Extract frames and captions
-    transcript = transcribe_audio(temp_file)
-    frames, timestamps = extract_frames(temp_file)
-    summary = describe_video_with_gpt4(frames, transcript=transcript)
+@shared_task(**STAGE_RETRY)
+def transcribe_stage(temp_file, video_id):
+    video_record = PostRecord.objects.only('transcription', 'summary').get(video_id=video_id)
+    if video_record.transcription is not None or video_record.summary is not None:
+        return video_record.transcription
+    transcript = _with_local_video(video_id, temp_file, transcribe_audio)
+    PostRecord.objects.filter(video_id=video_id).update(transcription=transcript)
+    return transcript
+
+@shared_task(**STAGE_RETRY)
+def extract_frames_stage(temp_file, video_id):
+    """Sampled frames as image data URLs, passed on to summarize_stage with the file to clean up."""
+    if PostRecord.objects.only('summary').get(video_id=video_id).summary is not None:
+        return {"frames": [], "temp_file": temp_file}
+    frames, timestamps = _with_local_video(video_id, temp_file, extract_frames)
+    urls, payload_size = encode_frames(
+        frames, settings.FRAME_IMAGE_FORMAT, settings.FRAME_IMAGE_QUALITY, settings.FRAME_MAX_DIMENSION
+    )
+    logger.info(f"[INFO] Encoded {len(urls)} frames of video {video_id}: {payload_size / 1024:.0f}KB")
+    return {"frames": urls, "temp_file": temp_file}
+
+@shared_task(**STAGE_RETRY)
+def summarize_stage(results, video_id):
+    transcript, frames = results
+    video_record = PostRecord.objects.only('summary').get(video_id=video_id)
+    if video_record.summary is None:
+        video_record.summary = describe_video_with_gpt4(frames["frames"], transcript=transcript)
+        PostRecord.objects.filter(video_id=video_id).update(summary=video_record.summary)
+    # Both stages that read the video are done
+    if frames["temp_file"]:
+        cleanup(frames["temp_file"])
+    return video_record.summary
 
-    username = video_record.user.username
-    tags = video_record.tags
-    tag_string = ""
-    for tag in tags:
-        tag_string += f"\\T {tag} "
-    caption = video_record.description
-    video_embedding_text = \
-        f"@{username} {tag_string} Caption: {caption}\n Video Summary: {summary}"
-    embedding = generate_embedding(video_embedding_text)
+@shared_task
+def cleanup_stage(request, exc, traceback, temp_file):
+    """Errback of the analysis chord: delete the downloaded file once the chord has failed for good."""
+    logger.error(f"[ERROR] Processing stage {request.task} failed for good: {exc!r}")
+    if temp_file:
+        cleanup(temp_file)
 
-    video_record.transcription = transcript
-    video_record.summary = summary
-    video_record.embedding = embedding.tolist()
-    video_record.save()
+@shared_task(**STAGE_RETRY)
+def embed_stage(summary, video_id, task_id):
+    video_record = PostRecord.objects.select_related('user').only(
+        'user__username', 'tags', 'description', 'transcription', 'embedding'
+    ).get(video_id=video_id)
 
-    logger.info(f"[INFO] Video processing completed: {temp_file}")
+    if len(video_record.embedding) == 0:
+        video_record.embedding = generate_embedding(video_embedding_text(video_record, summary))
+        video_record.save(update_fields=['embedding'])
+        notify_video_changed(video_id)
 
-    cleanup(temp_file)
+    logger.info(f"[INFO] Video processing completed: {video_id}")
 
     result = {
         "status": "success",
         "summary": summary,
-        "transcript": transcript,
-        "embedding": embedding.tolist(),
+        "transcript": video_record.transcription,
+        "embedding": video_record.embedding.tolist(),
         "task_id": task_id,
     }
 
     return result
 
+CLOUDFRONT_URL = "https://d2siyp5dx1ck05.cloudfront.net"
+
+@shared_task(**STAGE_RETRY)
+def transcode_hls(video_id):
+    """
+    Replace an uploaded MP4 with an HLS bitrate ladder (see hls.py): transcode, upload
+    the renditions next to the MP4 and point the PostRecord at the master playlist.
+    """
+    video_record = PostRecord.objects.select_related('user').only(
+        'file_path', 'user__username'
+    ).get(video_id=video_id)
+    source_path = video_record.file_path
+    if not source_path.endswith(".mp4"):
+        return {"status": "skipped", "file_path": source_path}
+
+    # Same layout as client-side HLS uploads: <user>/videos/<name>/<files>
+    prefix = f"{os.path.splitext(source_path)[0]}/"
+    work_dir = tempfile.mkdtemp(prefix="hls_")
+    start = time.perf_counter()
+    try:
+        local_path = os.path.join(work_dir, "source.mp4")
+        stream_s3_object(settings.AWS_BUCKET, source_path, local_path, extract_audio=False)
+        out_dir = os.path.join(work_dir, "hls")
+        renditions = transcode_ladder(local_path, out_dir)
+        keys = upload_directory(out_dir, settings.AWS_BUCKET, prefix)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    playlist_path = f"{prefix}{MASTER_PLAYLIST}"
+    # Both columns in one UPDATE, and only if the record still points at the MP4 we transcoded
+    switched = PostRecord.objects.filter(video_id=video_id, file_path=source_path).update(
+        file_path=playlist_path, link=f"{CLOUDFRONT_URL}/{playlist_path}",
+    )
+    if switched:
+        notify_video_changed(video_id)
+    elif not PostRecord.objects.filter(video_id=video_id, file_path__startswith=prefix).exists():
+        # Deleted or replaced while transcoding (a duplicate run would have switched to these same keys)
+        delete_keys(settings.AWS_BUCKET, keys)
+    logger.info(
+        f"[INFO] HLS ladder for video {video_id}: {', '.join(r['name'] for r in renditions)} "
+        f"in {time.perf_counter() - start:.1f}s"
+    )
+    return {"status": "success" if switched else "stale", "file_path": playlist_path, "renditions": renditions}
+
 def download_video_from_s3(video_s3_url):
     """Downloads video from S3 and saves it locally."""
     bucket_name = settings.AWS_BUCKET
@@ -94,54 +263,40 @@ def download_video_from_s3(video_s3_url):
     logger.info(temp_file)
     logger.info(key)
     try:
-        s3_client.download_file(bucket_name, key, temp_file)
+        get_s3_client().download_file(bucket_name, key, temp_file)
         return temp_file
     except Exception as e:
         logger.info(f"[ERROR] Failed to download video: {e}")
         return None
 
 def extract_frames(video_path, frame_interval=10):
-    """Extracts frames from a video at a given interval."""
-    cap = cv2.VideoCapture(video_path)
-    frames = []
-    timestamps = []
-    fps = cap.get(cv2.CAP_PROP_FPS)
-    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-
-    for i in range(frame_count):
-        ret, frame = cap.read()
-        if not ret:
-            break
-        if i % (frame_interval * int(fps)) == 0:
-            frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            image = Image.fromarray(frame_rgb)
-            frames.append(image)
-            timestamps.append(i / fps)
-
-    cap.release()
-    return frames, timestamps
-
-# 3. Ask GPT-4V to describe the video from multiple frames
+    """Extracts frames (RGB arrays) from a video at a given interval, or at scene changes."""
+    return sample_frames(
+        video_path, interval=frame_interval, mode=settings.FRAME_SAMPLING_MODE, max_dimension=settings.FRAME_MAX_DIMENSION
+    )
+
+# 3. Ask GPT-4V to describe the video from multiple frames (as data URLs, see encode_frames)
 def describe_video_with_gpt4(frames, transcript=None, prompt=None):
+    prompt = prompt or "Please summarize what’s happening in this video based on the frames."
+    key = content_key(SUMMARY_MODEL, prompt, transcript or "", *frames)
+    return get_content_cache().text("summary", key, lambda: _describe_video(frames, transcript, prompt))
+
+def _describe_video(frames, transcript, prompt):
     input_content = [
-        {"type": "input_text", "text": prompt or "Please summarize what’s happening in this video based on the frames."}
+        {"type": "input_text", "text": prompt}
     ]
 
     if transcript:
         input_content.append({"type": "input_text", "text": f"The audio transcript is: {transcript}"})
 
-    for img in frames:
-        with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as f:
-            img.save(f.name)
-            with open(f.name, "rb") as image_file:
-                b64_image = base64.b64encode(image_file.read()).decode("utf-8")
-            input_content.append({
-                "type": "input_image",
-                "image_url": f"data:image/png;base64,{b64_image}"
-            })
+    for image_url in frames:
+        input_content.append({
+            "type": "input_image",
+            "image_url": image_url
+        })
 
     response = client.responses.create(
-        model="gpt-4o-mini",
+        model=SUMMARY_MODEL,
         input=[
             {
                 "role": "user",
@@ -159,46 +314,221 @@ def get_temp_file_path(extension):
     return temp_file
 
 def transcribe_audio(video_path):
-    """Extracts and transcribes audio using Whisper."""
-    video = VideoFileClip(video_path)
-    audio_path = get_temp_file_path(".mp3")
-    video.audio.write_audiofile(audio_path)
-
-    logger.info("[INFO] Uploading audio to OpenAI Whisper...")
-    with open(audio_path, "rb") as f:
-        transcript = client.audio.transcriptions.create(model="whisper-1", file=f)
-
-    cleanup(audio_path)
-
-    video.close()
-    
-    return transcript.text
+    """Extracts and transcribes audio using Whisper. Videos without audio get an empty transcript."""
+    # Keyed by the video bytes, so re-uploads of the same file are not transcribed again
+    key = content_key(TRANSCRIPTION_MODEL, file_digest(video_path), str(AUDIO_SAMPLE_RATE), AUDIO_BITRATE, str(CHUNK_SECONDS))
+    return get_content_cache().text("transcription", key, lambda: _transcribe(video_path))
+
+def _prefetched_audio(video_path):
+    for path in prefetched_audio_chunks(video_path):
+        with open(path, "rb") as f:
+            yield f.read()
+
+def _transcribe(video_path):
+    texts = []
+    # Audio extracted during the download when the video allowed it, see download.py
+    chunks = _prefetched_audio(video_path) if prefetched_audio_chunks(video_path) else extract_audio_chunks(video_path)
+    for i, chunk in enumerate(chunks):
+        logger.info(f"[INFO] Uploading audio chunk {i} ({len(chunk) // 1024}KB) to OpenAI Whisper...")
+        transcript = client.audio.transcriptions.create(model=TRANSCRIPTION_MODEL, file=(f"audio_{i}.mp3", chunk))
+        texts.append(transcript.text)
+
+    return " ".join(texts)
 
 def cleanup(video_path):
     if os.path.exists(video_path):
-        os.remove(video_path)  # Delete file after processing
+        cleanup_download(video_path)  # Delete file (and prefetched audio) after processing
         logger.info(f"[INFO] Deleted temp file: {video_path}")
 
-@shared_task
-def update_post_records():
-    """Ensures consistency by updating each PostRecord's views, likes, and comments based on actual records in the database."""
-
-    logger.info("[INFO] Preforming consistency check on PostRecords...")
-    
-    posts = PostRecord.objects.all()
-
-    for post in posts:
-        # Update views based on ViewedPosts
-        post.views = ViewedPosts.objects.filter(video=post).count()
-
-        # Update likes based on LikedPosts
-        post.likes = LikedPosts.objects.filter(video=post).count()
+POST_RECORDS_WATERMARK_KEY = "update_post_records_watermark"
+RECONCILE_BATCH_SIZE = 1000
+# PostRecord counter, table it counts, date column of that table
+COUNTER_SOURCES = (
+    ("views", ViewedPosts, "date"),
+    ("likes", LikedPosts, "date"),
+    ("comments", CommentRecord, "date_uploaded"),
+)
+
+def count_per_video(model, video_ids=None):
+    """{video_id: number of rows} of `model` with one grouped query."""
+    rows = model.objects.all() if video_ids is None else model.objects.filter(video_id__in=video_ids)
+    return dict(rows.order_by().values('video_id').annotate(n=Count('pk')).values_list('video_id', 'n'))
+
+def touched_video_ids(since):
+    """Videos uploaded, viewed, liked or commented on since `since`."""
+    video_ids = set(PostRecord.objects.filter(date_uploaded__gte=since).values_list('video_id', flat=True))
+    for _, model, date_field in COUNTER_SOURCES:
+        video_ids.update(model.objects.filter(**{f"{date_field}__gte": since}).values_list('video_id', flat=True).distinct())
+    return sorted(video_ids)
 
-        # Update comments based on CommentRecord
-        post.comments = CommentRecord.objects.filter(video=post).count()
-
-        # Save the updated post record
-        post.save()
+@shared_task
+def update_post_records(incremental=False):
+    """
+    Ensures consistency by setting each PostRecord's views, likes, and comments to the
+    number of matching records in the database. Counts come from one grouped query per
+    table and only drifted rows are written. With incremental=True only the posts
+    touched since the previous run are checked (removed likes/comments are only picked
+    up by a full run).
+    """
+
+    start = time.perf_counter()
+    run_started = timezone.now()
+    watermark = cache.get(POST_RECORDS_WATERMARK_KEY) if incremental else None
+    mode = "incremental" if watermark is not None else "full"
+    logger.info(f"[INFO] Preforming {mode} consistency check on PostRecords...")
+
+    if watermark is not None:
+        video_ids = touched_video_ids(watermark)
+        batches = [video_ids[i:i + RECONCILE_BATCH_SIZE] for i in range(0, len(video_ids), RECONCILE_BATCH_SIZE)]
+    else:
+        batches = [None]  # everything at once
+
+    columns = [column for column, _, _ in COUNTER_SOURCES]
+    checked = corrected = 0
+    for video_ids in batches:
+        counts = {column: count_per_video(model, video_ids) for column, model, _ in COUNTER_SOURCES}
+        posts = PostRecord.objects.values_list('video_id', *columns)
+        if video_ids is not None:
+            posts = posts.filter(video_id__in=video_ids)
+
+        drifted = []
+        for video_id, *current in posts.iterator(chunk_size=2000):
+            checked += 1
+            actual = [counts[column].get(video_id, 0) for column in columns]
+            if actual != current:
+                drifted.append(PostRecord(video_id=video_id, **dict(zip(columns, actual))))
+
+        PostRecord.objects.bulk_update(drifted, columns, batch_size=500)
+        corrected += len(drifted)
+
+    cache.set(POST_RECORDS_WATERMARK_KEY, run_started, None)
+    elapsed = time.perf_counter() - start
+    logger.info(f"[INFO] Post records updated successfully: corrected {corrected} of {checked} in {elapsed:.2f}s.")
+    return {"status": "success", "mode": mode, "checked": checked, "corrected": corrected, "seconds": elapsed}
+
+
+
+FEED_REFRESH_LOCK_KEY = "feed_refresh_scheduled_{}"
+FEED_BATCH_SIZE = 20  # largest batch GetFeedView serves
+
+def schedule_feed_refresh(user_id):
+    """Queue a materialize_feed run for the user unless one is already pending."""
+    if cache.add(FEED_REFRESH_LOCK_KEY.format(user_id), 1, 60):
+        materialize_feed.delay(user_id)
+
+def on_interests_changed(user_id):
+    """Call when update_user_data reports a material change: retire cached rankings and re-rank."""
+    bump_interest_version(user_id)
+    schedule_feed_refresh(user_id)
 
-    logger.info("[INFO] Post records updated successfully.")
+@shared_task
+def materialize_feed(user_id):
+    """Rank the user's feed in the background and store the result as their feed queue."""
+    try:
+        user_data = UserData.objects.get(user_id=user_id)
+        watched_video_ids = set(ViewedPosts.objects.filter(user_id=user_id).values_list('video_id', flat=True))
+
+        # Read the versions first so changes made while ranking mark the queue stale
+        catalog_version = get_catalog_version()
+        interest_version = get_interest_version(user_id)
+        ranked_videos = get_ranked_videos(user_data, watched_video_ids, FEED_BATCH_SIZE)
+        save_feed_queue(user_id, ranked_videos, catalog_version, interest_version)
+    except UserData.DoesNotExist:
+        pass
+    finally:
+        cache.delete(FEED_REFRESH_LOCK_KEY.format(user_id))
+
+
+ENGAGEMENT_MAX_BATCHES = 20  # batches per consumer run before handing over to a new run
+PRUNE_PROCESSED_EVENTS_KEY = "engagement_prune_processed"
+PRUNE_PROCESSED_EVENTS_INTERVAL = 60 * 60
+
+def enqueue_engagement(events):
+    """Append engagement events to the queue and make sure a consumer run is scheduled."""
+    if get_engagement_queue().append(events):
+        consume_engagement_events.apply_async(countdown=FLUSH_DELAY)
+
+def _apply_user_events(user_id, user_events):
+    """(events applied, duplicates); raises when the events cannot be applied."""
+    applied, material_change, duplicates = apply_engagement_events(user_id, user_events)
+    if material_change:
+        on_interests_changed(user_id)
+    return applied, duplicates
+
+def apply_engagement_batch(events):
+    """
+    Apply a micro-batch of queued events: watch events grouped per user, likes all at
+    once. A group that fails is retried event by event, so one bad event does not hold
+    back the others. Returns (applied, duplicates, {(user_id, event_id): error} of the
+    events that failed).
+    """
+    groups = {}
+    for event in events:
+        groups.setdefault(None if event["type"] == "like" else event["user_id"], []).append(event)
+
+    def apply(user_id, group):
+        if user_id is None:
+            return apply_like_events(group)
+        return _apply_user_events(user_id, group)
+
+    applied = duplicates = 0
+    failed = {}
+    for user_id, group in groups.items():
+        chunks = [group]
+        while chunks:
+            chunk = chunks.pop(0)
+            try:
+                chunk_applied, chunk_duplicates = apply(user_id, chunk)
+            except UserData.DoesNotExist:
+                break  # account deleted since
+            except Exception as e:
+                if len(chunk) > 1:
+                    chunks = [[event] for event in chunk]
+                    continue
+                logger.exception(f"[ERROR] Applying engagement event {chunk[0]['event_id']} failed")
+                failed[(chunk[0]["user_id"], chunk[0]["event_id"])] = f"{type(e).__name__}: {e}"
+                continue
+            applied += chunk_applied
+            duplicates += chunk_duplicates
+    return applied, duplicates, failed
 
+@shared_task
+def consume_engagement_events():
+    """Drain the engagement queue in micro-batches of READ_COUNT events."""
+    queue = get_engagement_queue()
+    queue.flush_started()
+    consumer = f"{os.uname().nodename}-{os.getpid()}"
+    if cache.add(PRUNE_PROCESSED_EVENTS_KEY, 1, PRUNE_PROCESSED_EVENTS_INTERVAL):
+        prune_processed_events()
+
+    for _ in range(ENGAGEMENT_MAX_BATCHES):
+        entries = queue.read(consumer)
+        if not entries:
+            return
+
+        start = time.perf_counter()
+        # Already applied events (redeliveries, retried requests) are skipped by engagement.py
+        applied, duplicates, failed = apply_engagement_batch([event for _, event in entries])
+        failed_entries = [(entry_id, event) for entry_id, event in entries if (event["user_id"], event["event_id"]) in failed]
+        queue.ack([entry_id for entry_id, event in entries if (event["user_id"], event["event_id"]) not in failed])
+
+        # Failed entries stay pending so they are claimed again, up to MAX_DELIVERIES times
+        deliveries = queue.deliveries([entry_id for entry_id, _ in failed_entries])
+        dead = [(entry_id, event) for entry_id, event in failed_entries if deliveries[entry_id] >= MAX_DELIVERIES]
+        for entry_id, event in dead:
+            error = failed[(event["user_id"], event["event_id"])]
+            logger.error(f"[ERROR] Dead-lettering engagement event {event['event_id']}: {error}")
+            queue.dead_letter([(entry_id, event)], error)
+
+        record_queue_stat("batches")
+        record_queue_stat("applied", applied)
+        record_queue_stat("duplicates", duplicates)
+        record_queue_stat("dead_lettered", len(dead))
+        record_queue_stat("apply_ms", int(1000 * (time.perf_counter() - start)))
+        record_batch(len(entries), time.time() - min(event["ts"] for _, event in entries))
+
+        if len(entries) < READ_COUNT:
+            return
+
+    # Still backlogged, continue in a fresh run
+    consume_engagement_events.delay()
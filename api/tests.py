@@ -0,0 +1,994 @@
+import gc
+import io
+import math
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from unittest import mock
+
+import boto3
+import numpy as np
+from botocore.config import Config
+from botocore.credentials import Credentials
+from botocore.exceptions import ClientError
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from rest_framework.test import APIClient
+
+from ByteverseProject import celery_app
+
+from . import audio, content_cache, download, embedding_store, engagement_queue, presign, rank_video, storage, tasks, views
+from .counters import increment_counter, increment_counters
+from .embeddings import MAX_BATCH_INPUTS, EmbeddingClient
+from .engagement import parse_engagement_event
+from .engagement_queue import LocalEngagementQueue, MAX_DELIVERIES
+from .feed import FEED_QUEUE_KEY, RANKED_VIDEOS_KEY, get_interest_version, save_feed_queue
+from .hls import MASTER_PLAYLIST, split_threads
+from .management.commands import reembed_posts
+from .models import LikedPosts, PostRecord, ProcessedEngagementEvent, User, UserData, ViewedPosts
+from .presign import BatchPresigner
+from .tasks import consume_engagement_events
+
+
+def random_embedding(rng, dim=1536):
+    v = rng.normal(size=dim)
+    return (v / np.linalg.norm(v)).tolist()
+
+
+def create_posts(user, count, rng, **fields):
+    return [
+        PostRecord.objects.create(user=user, file_path=f"videos/{i}.mp4", thumbnail_path=f"thumbnails/{i}.jpg",
+                                  file_size=1, length=10, width=720, height=1280, description="",
+                                  embedding=random_embedding(rng), **fields)
+        for i in range(count)
+    ]
+
+
+try:
+    from moto import mock_aws
+except ImportError:
+    mock_aws = None
+
+
+@unittest.skipIf(mock_aws is None, "moto is not installed")
+@override_settings(AWS_BUCKET="popoff-test", AWS_REGION="us-east-2")
+class S3TestCase(TestCase):
+    """Runs against an in-memory S3 (moto) with an empty settings.AWS_BUCKET."""
+
+    def setUp(self):
+        super().setUp()
+        mock = mock_aws()
+        mock.start()
+        self.addCleanup(mock.stop)
+        storage._clients.clear()  # clients created outside the mock
+        self.addCleanup(storage._clients.clear)
+        self.s3 = storage.get_s3_client()
+        self.s3.create_bucket(Bucket=settings.AWS_BUCKET,
+                              CreateBucketConfiguration={"LocationConstraint": settings.AWS_REGION})
+
+    def put(self, *keys):
+        for key in keys:
+            self.s3.put_object(Bucket=settings.AWS_BUCKET, Key=key, Body=b"data")
+
+    def keys(self):
+        return set(storage.list_keys(settings.AWS_BUCKET, ""))
+
+
+@override_settings(CELERY_TASK_ALWAYS_EAGER=True, ENGAGEMENT_QUEUE_BACKEND="local")
+class EngagementTests(TestCase):
+    def setUp(self):
+        self.queue = LocalEngagementQueue()
+        patcher = mock.patch.object(engagement_queue, "_queue", self.queue)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        rng = np.random.default_rng(0)
+        self.user = User.objects.create_user("viewer", "viewer@example.com", "password")
+        self.other = User.objects.create_user("creator", "creator@example.com", "password")
+        UserData.objects.create(user=self.user)
+        UserData.objects.create(user=self.other)
+        self.posts = create_posts(self.other, 5, rng)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def watch(self, **event):
+        return self.client.post('/api/post/update_posts_engagement/', event, format='json')
+
+    def test_invalid_events_are_rejected(self):
+        video_id = self.posts[0].pk
+        for event in [
+            {'video_id': video_id, 'watch_time': 'abc'},
+            {'video_id': video_id, 'watch_time': 'inf'},
+            {'video_id': video_id, 'watch_time': -1},
+            {'video_id': video_id, 'liked': 'maybe'},
+            {'video_id': video_id, 'event_id': 'x' * 100},
+            {'video_id': 'abc'},
+        ]:
+            response = self.watch(**event)
+            self.assertEqual(response.status_code, 400, event)
+        response = self.client.post('/api/post/update_posts_engagement_batch/',
+                                    {'events': [{'video_id': video_id}, {'video_id': video_id, 'commented': []}]},
+                                    format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.queue.backlog(), (0, 0))
+
+    def test_retried_event_is_applied_once(self):
+        post = self.posts[0]
+        for _ in range(2):
+            self.assertEqual(self.watch(video_id=post.pk, watch_time=5, event_id='e1').status_code, 200)
+        post.refresh_from_db()
+        self.assertEqual((post.views, post.total_watch_time), (1, 5))
+
+        # Event ids are per user, another user's e1 is a different event
+        self.client.force_authenticate(self.other)
+        self.watch(video_id=post.pk, watch_time=5, event_id='e1')
+        post.refresh_from_db()
+        self.assertEqual(post.views, 2)
+        self.assertEqual(ProcessedEngagementEvent.objects.filter(event_id='e1').count(), 2)
+
+    def test_retried_like_is_applied_once(self):
+        post = self.posts[0]
+        for like in ['true', 'false']:
+            self.client.post('/api/post/like/', {'video_id': post.pk, 'like': like, 'event_id': 'l1'}, format='json')
+        post.refresh_from_db()
+        self.assertEqual(post.likes, 1)
+        self.assertTrue(LikedPosts.objects.filter(user=self.user, video=post).exists())
+
+    def test_poison_event_is_dead_lettered(self):
+        bad_video = self.posts[1].pk
+        apply = tasks.apply_engagement_events
+
+        def failing_apply(user_id, events):
+            if any(event["video_id"] == bad_video for event in events):
+                raise RuntimeError("cannot apply")
+            return apply(user_id, events)
+
+        with mock.patch.object(tasks, "apply_engagement_events", failing_apply), \
+                mock.patch.object(engagement_queue, "CLAIM_IDLE_MS", -1):
+            self.client.post('/api/post/update_posts_engagement_batch/', {'events': [
+                {'video_id': self.posts[0].pk, 'watch_time': 3},
+                {'video_id': bad_video, 'watch_time': 3},
+                {'video_id': self.posts[2].pk, 'watch_time': 3},
+            ]}, format='json')
+            # The other events of the user are applied, the bad one stays pending...
+            self.assertEqual(ViewedPosts.objects.filter(user=self.user).count(), 2)
+            self.assertEqual(self.queue.backlog(), (1, 1))
+            # ...until it was delivered MAX_DELIVERIES times
+            for _ in range(MAX_DELIVERIES - 1):
+                consume_engagement_events()
+
+        self.assertEqual(self.queue.backlog(), (0, 0))
+        self.assertEqual(len(self.queue.dead), 1)
+        self.assertEqual(self.queue.dead[0][0]["video_id"], bad_video)
+        self.assertEqual(ViewedPosts.objects.filter(user=self.user).count(), 2)
+
+    def test_beat_picks_up_events_of_a_crashed_run(self):
+        post = self.posts[0]
+        self.queue.append([engagement_queue.make_event(
+            "watch", self.user.user_id, **parse_engagement_event({"video_id": post.pk, "watch_time": 4}))])
+        self.queue.read("crashed-consumer")  # delivered, never acknowledged, and no new event follows
+
+        entry = settings.CELERY_BEAT_SCHEDULE["consume-engagement-events"]
+        self.assertLessEqual(entry["schedule"], engagement_queue.CLAIM_IDLE_MS / 1000)
+        with mock.patch.object(engagement_queue, "CLAIM_IDLE_MS", -1):
+            celery_app.tasks[entry["task"]].apply()
+        post.refresh_from_db()
+        self.assertEqual((post.views, post.total_watch_time), (1, 4))
+        self.assertEqual(self.queue.backlog(), (0, 0))
+
+    def test_reset_engagement_forgets_feed(self):
+        user_id = self.user.user_id
+        version = get_interest_version(user_id)
+        save_feed_queue(user_id, [], 0, version)
+        cache.set(RANKED_VIDEOS_KEY.format(user_id, version), [])
+
+        response = self.client.post('/api/user/reset_user_engagement/')
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(cache.get(FEED_QUEUE_KEY.format(user_id)))
+        self.assertIsNone(cache.get(RANKED_VIDEOS_KEY.format(user_id, version)))
+        self.assertGreater(get_interest_version(user_id), version)
+
+
+class CounterConcurrencyTests(TransactionTestCase):
+    """Counter updates from many threads at once must all be counted."""
+
+    THREADS = 8
+    INCREMENTS = 50
+
+    def setUp(self):
+        creator = User.objects.create_user("creator", "creator@example.com", "password")
+        self.posts = create_posts(creator, 2, np.random.default_rng(0))
+
+    def run_threads(self, work):
+        errors = []
+
+        def worker():
+            try:
+                for _ in range(self.INCREMENTS):
+                    work()
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker) for _ in range(self.THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def test_increment_counter_loses_no_updates(self):
+        video_id = self.posts[0].pk
+        self.run_threads(lambda: increment_counter(video_id, "likes"))
+        self.assertEqual(PostRecord.objects.get(pk=video_id).likes, self.THREADS * self.INCREMENTS)
+
+    def test_increment_counters_loses_no_updates(self):
+        first, second = self.posts
+        self.run_threads(lambda: increment_counters({first.pk: {"views": 1, "total_watch_time": 2}, second.pk: {"views": 3}}))
+        first.refresh_from_db()
+        second.refresh_from_db()
+        total = self.THREADS * self.INCREMENTS
+        self.assertEqual((first.views, first.total_watch_time, second.views), (total, 2 * total, 3 * total))
+
+
+class FeedQueryTests(TestCase):
+    """GetFeedView's queries must not grow with the batch size or the catalog."""
+
+    def setUp(self):
+        cache.clear()
+        for patcher in (mock.patch.object(embedding_store, "_store", None),
+                        # Refreshes run in a worker, not in the request
+                        mock.patch.object(views, "schedule_feed_refresh")):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.rng = np.random.default_rng(0)
+        self.user = User.objects.create_user("viewer", "viewer@example.com", "password")
+        self.creator = User.objects.create_user("creator", "creator@example.com", "password")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def get_feed(self, batch_size):
+        response = self.client.get('/api/media/get_feed/', {'batch_size': batch_size})
+        self.assertEqual(response.status_code, 200)
+        return response.json()['feed']
+
+    def test_query_count_is_constant(self):
+        for catalog_size in (10, 60):
+            posts = create_posts(self.creator, catalog_size - PostRecord.objects.count(), self.rng)
+            embedding_store.notify_videos_changed([post.pk for post in posts])
+            cache.delete(FEED_QUEUE_KEY.format(self.user.user_id))
+            self.get_feed(1)  # loads the new videos and caches the ranking
+
+            # UserData, watched ids, the sampled records and their likes
+            for batch_size in (1, 5, 20):
+                with self.assertNumQueries(4):
+                    feed = self.get_feed(batch_size)
+                self.assertEqual(len(feed), min(batch_size, catalog_size))
+
+            # Served from the precomputed feed queue
+            tasks.materialize_feed(self.user.user_id)
+            for batch_size in (1, 5, 20):
+                with self.assertNumQueries(4):
+                    self.assertEqual(len(self.get_feed(batch_size)), min(batch_size, catalog_size))
+
+
+class VideoFileTests(S3TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user("creator", "creator@example.com", "password")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_delete_post_removes_mp4_and_ladder(self):
+        ladder = [f"creator/videos/clip/{name}" for name in (MASTER_PLAYLIST, "720p.m3u8", "720p_000.ts")]
+        kept = ["creator/videos/clip2.mp4", "creator/videos/clip2/master.m3u8"]
+        self.put("creator/videos/clip.mp4", "creator/thumbnails/clip.jpg", *ladder, *kept)
+        [post] = create_posts(self.user, 1, np.random.default_rng(0))
+        PostRecord.objects.filter(pk=post.pk).update(file_path=ladder[0], thumbnail_path="creator/thumbnails/clip.jpg")
+
+        response = self.client.delete('/api/media/delete_post/', {'video_id': post.pk}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.keys(), set(kept))
+        self.assertFalse(PostRecord.objects.filter(pk=post.pk).exists())
+
+    def test_stale_transcode_removes_its_ladder(self):
+        self.put("creator/videos/clip.mp4")
+        [post] = create_posts(self.user, 1, np.random.default_rng(0))
+        PostRecord.objects.filter(pk=post.pk).update(file_path="creator/videos/clip.mp4")
+
+        def transcode(video_path, out_dir):
+            os.makedirs(out_dir)
+            for name in (MASTER_PLAYLIST, "360p.m3u8", "360p_000.ts"):
+                open(os.path.join(out_dir, name), "w").close()
+            PostRecord.objects.filter(pk=post.pk).delete()  # deleted while transcoding
+            return [{"name": "360p"}]
+
+        with mock.patch.object(tasks, "stream_s3_object"), mock.patch.object(tasks, "transcode_ladder", transcode):
+            result = tasks.transcode_hls(post.pk)
+        self.assertEqual(result["status"], "stale")
+        self.assertEqual(self.keys(), {"creator/videos/clip.mp4"})
+
+
+ROTATED_VIDEO_INFO = """\
+Input #0, mov,mp4,m4a,3gp,3g2,mj2, from 'clip.mp4':
+  Duration: 00:01:02.50, start: 0.000000, bitrate: 2100 kb/s
+  Stream #0:0[0x1](und): Video: h264 (High) (avc1 / 0x31637661), yuv420p(tv, bt709), 1920x1080 [SAR 1:1 DAR 16:9], 2000 kb/s, 30 fps
+      Metadata:
+        handler_name    : VideoHandler
+      Side data:
+        displaymatrix: rotation of -90.00 degrees
+  Stream #0:1[0x2](und): Audio: aac (LC) (mp4a / 0x6134706D), 44100 Hz, stereo, fltp, 128 kb/s
+At least one output file must be specified
+"""
+
+
+class S3DownloadTests(S3TestCase):
+    """Ranged, concurrent downloads (download.py) against moto."""
+
+    PART_SIZE = 1000
+
+    def setUp(self):
+        super().setUp()
+        self.work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.work_dir, ignore_errors=True)
+
+    def upload(self, key, size):
+        body = np.random.default_rng(size).bytes(size)
+        self.s3.put_object(Bucket=settings.AWS_BUCKET, Key=key, Body=body)
+        return body
+
+    def stream(self, key, **options):
+        options = {"part_size": self.PART_SIZE, "concurrency": 3, "max_buffered_parts": 4, **options}
+        stream = download.S3RangeStream(settings.AWS_BUCKET, key, **options)
+        self.addCleanup(stream.close)
+        return stream
+
+    def test_ranged_reads(self):
+        for size in (0, 1, self.PART_SIZE, 3 * self.PART_SIZE, 10 * self.PART_SIZE + 337):
+            body = self.upload(f"videos/{size}.mp4", size)
+            with mock.patch.object(self.s3, "get_object", wraps=self.s3.get_object) as get_object:
+                stream = self.stream(f"videos/{size}.mp4")
+                self.assertLessEqual(len(stream._parts), 4)  # never more than max_buffered_parts
+                self.assertEqual(b"".join(iter(lambda: stream.read(333), b"")), body, size)
+            ranges = sorted((call.kwargs["Range"] for call in get_object.call_args_list), key=lambda r: int(r[6:].split("-")[0]))
+            expected = [f"bytes={start}-{min(start + self.PART_SIZE, size) - 1}" for start in range(0, size, self.PART_SIZE)]
+            self.assertEqual(ranges, expected)
+
+    def test_stream_s3_object(self):
+        body = self.upload("videos/clip.mp4", 7 * self.PART_SIZE + 1)
+        out_file = os.path.join(self.work_dir, "clip.mp4")
+        download.stream_s3_object(settings.AWS_BUCKET, "videos/clip.mp4", out_file, extract_audio=False,
+                                  part_size=self.PART_SIZE, concurrency=3, max_buffered_parts=3)
+        with open(out_file, "rb") as f:
+            self.assertEqual(f.read(), body)
+
+    def test_failing_get(self):
+        self.upload("videos/clip.mp4", 5 * self.PART_SIZE)
+        get_object = self.s3.get_object
+
+        def flaky_get_object(**kwargs):
+            if kwargs["Range"].startswith(f"bytes={2 * self.PART_SIZE}-"):
+                raise ClientError({"Error": {"Code": "InternalError", "Message": "boom"}}, "GetObject")
+            return get_object(**kwargs)
+
+        out_file = os.path.join(self.work_dir, "clip.mp4")
+        with mock.patch.object(self.s3, "get_object", flaky_get_object), self.assertRaises(ClientError):
+            download.stream_s3_object(settings.AWS_BUCKET, "videos/clip.mp4", out_file, extract_audio=False,
+                                      part_size=self.PART_SIZE)
+        os.remove(out_file)
+
+        # download_asset gives up and leaves nothing behind
+        url = f"https://{settings.AWS_BUCKET}.s3.us-east-2.amazonaws.com/videos/clip.mp4"
+        with mock.patch.object(self.s3, "get_object", flaky_get_object), \
+                mock.patch.object(tempfile, "tempdir", self.work_dir), \
+                override_settings(S3_PART_SIZE=self.PART_SIZE):
+            self.assertIsNone(download.download_asset(url))
+        self.assertEqual(os.listdir(self.work_dir), [])
+
+    @unittest.skipIf(shutil.which(settings.FFMPEG_BINARY) is None, "ffmpeg is not installed")
+    def test_audio_is_extracted_while_downloading(self):
+        video = os.path.join(self.work_dir, "source.mp4")
+        subprocess.run(
+            [settings.FFMPEG_BINARY, "-v", "error", "-f", "lavfi", "-i", "testsrc=size=160x120:rate=10",
+             "-f", "lavfi", "-i", "sine", "-t", "3", "-pix_fmt", "yuv420p", "-shortest",
+             "-movflags", "+faststart", video],
+            check=True,
+        )
+        with open(video, "rb") as f:
+            self.s3.put_object(Bucket=settings.AWS_BUCKET, Key="videos/clip.mp4", Body=f.read())
+        out_file = os.path.join(self.work_dir, "clip.mp4")
+        download.stream_s3_object(settings.AWS_BUCKET, "videos/clip.mp4", out_file, part_size=4096)
+        self.assertEqual(len(download.prefetched_audio_chunks(out_file)), 1)
+        download.cleanup_download(out_file)
+        self.assertEqual(sorted(os.listdir(self.work_dir)), ["source.mp4"])
+
+
+class PresignTests(SimpleTestCase):
+    """BatchPresigner's URLs must be byte-identical to boto3's generate_presigned_url."""
+
+    BUCKET = "byteverse"
+    NOW = datetime(2025, 1, 1, 12, 0, 0)
+    CREDENTIALS = dict(aws_access_key_id="AKIDEXAMPLE", aws_secret_access_key="wJalrXUtnFEMI/K7MDENG+bPxRfiCYEXAMPLEKEY")
+    KEYS = [
+        ("alice/videos/clip-20250101120000/playlist.m3u8", "application/x-mpegURL"),
+        ("alice/videos/clip-20250101120000/segment_000.ts", "video/MP2T"),
+        ("bob smith/videos/café & friends+1/segment_001.ts", "video/MP2T"),
+        ("carol/videos/~weird key!*'()/segment_002.ts", "video/MP2T"),
+        ("erin/videos/no-content-type.bin", None),
+        ("frank/thumbnails/spaced.jpg", "image/jpeg;  charset=binary"),
+    ]
+
+    def setUp(self):
+        patcher = mock.patch("botocore.auth.get_current_datetime", return_value=self.NOW)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def s3_client(self, region="us-east-2", **options):
+        return boto3.client("s3", region_name=region, **self.CREDENTIALS, **options)
+
+    def assertMatchesBoto3(self, client):
+        presigner = BatchPresigner(client, self.BUCKET, expires_in=3600, now=self.NOW)
+        for key, content_type in self.KEYS:
+            params = {"Bucket": self.BUCKET, "Key": key}
+            if content_type is not None:
+                params["ContentType"] = content_type
+            expected = client.generate_presigned_url("put_object", Params=params, ExpiresIn=3600)
+            self.assertEqual(presigner.put_url(key, content_type), expected)
+        return presigner
+
+    def test_urls_match_boto3(self):
+        for client in (
+            self.s3_client(),
+            self.s3_client(aws_session_token="FQoGZXIvYXdzE+token/="),
+            self.s3_client("eu-central-1", config=Config(s3={"addressing_style": "path"})),
+            self.s3_client("eu-central-1", endpoint_url="http://127.0.0.1:9000"),
+        ):
+            # Signed locally: fails if botocore stops keeping the credentials on _request_signer
+            self.assertTrue(self.assertMatchesBoto3(client).fast)
+
+    def test_falls_back_to_boto3(self):
+        # Clients that presign with SigV2
+        self.assertFalse(self.assertMatchesBoto3(self.s3_client("eu-west-1")).fast)
+        self.assertFalse(self.assertMatchesBoto3(self.s3_client("us-east-1", endpoint_url="http://127.0.0.1:9000")).fast)
+
+        # A botocore that keeps the credentials somewhere else
+        class MovedCredentials:
+            def __init__(self, signer):
+                self.signer = signer
+
+            def __getattr__(self, name):
+                if name == "_credentials":
+                    raise AttributeError(name)
+                return getattr(self.signer, name)
+
+        client = self.s3_client()
+        with mock.patch.object(client, "_request_signer", MovedCredentials(client._request_signer)):
+            self.assertFalse(self.assertMatchesBoto3(client).fast)
+
+    def test_credentials_are_read_per_presigner(self):
+        client = self.s3_client(aws_session_token="first")
+        self.assertMatchesBoto3(client)
+        # What a refresh does: botocore swaps the credentials the signer holds
+        client._request_signer._credentials = Credentials("AKIDOTHER", "other-secret", "second")
+        self.assertIn("X-Amz-Security-Token=second", self.assertMatchesBoto3(client).put_url("a.ts"))
+
+    def test_endpoints_are_not_shared_between_clients(self):
+        client = self.s3_client()
+        self.assertMatchesBoto3(client)
+        self.assertIn(client, presign._endpoints)
+        del client
+        gc.collect()
+        self.assertEqual(len(presign._endpoints), 0)
+        # A client at a different endpoint is probed again, never served a stale entry
+        other = self.s3_client("us-east-1", endpoint_url="http://127.0.0.1:9000")
+        self.assertTrue(BatchPresigner(other, self.BUCKET).put_url("a.ts").startswith("http://127.0.0.1:9000/byteverse/a.ts?"))
+
+
+class HLSTests(SimpleTestCase):
+    def test_probe_video_applies_rotation(self):
+        result = mock.Mock(stderr=ROTATED_VIDEO_INFO)
+        with mock.patch.object(audio.subprocess, "run", return_value=result):
+            info = audio.probe_video("clip.mp4")
+        self.assertEqual(info, {"has_audio": True, "duration": 62.5, "width": 1080, "height": 1920})
+
+        result.stderr = ROTATED_VIDEO_INFO.replace("-90.00", "180.00")
+        with mock.patch.object(audio.subprocess, "run", return_value=result):
+            self.assertEqual(audio.probe_video("clip.mp4")["width"], 1920)
+
+    def test_split_threads_stays_within_budget(self):
+        for budget in range(1, 33):
+            for weights in ([1920 * 1080, 1280 * 720, 854 * 480, 640 * 360], [1, 1, 1], [5]):
+                threads = split_threads(budget, weights)
+                self.assertTrue(all(count >= 1 for count in threads))
+                self.assertEqual(sum(threads), max(budget, len(weights)))
+                self.assertEqual(threads, sorted(threads, reverse=True))
+
+
+class _FakeConnection:
+    def close(self):
+        pass
+
+
+class FakeOpenAI:
+    """Stands in for the OpenAI client of tasks.py: canned transcripts and summaries."""
+
+    def __init__(self, summary="A cat plays the piano."):
+        self.summary = summary
+        self.audio = SimpleNamespace(transcriptions=SimpleNamespace(create=self.transcribe))
+        self.responses = SimpleNamespace(create=self.respond)
+        self.calls = []
+
+    def transcribe(self, model, file):
+        self.calls.append("transcribe")
+        return SimpleNamespace(text="hello world")
+
+    def respond(self, model, input):
+        self.calls.append("summarize")
+        if isinstance(self.summary, Exception):
+            raise self.summary
+        return SimpleNamespace(output_text=self.summary)
+
+
+class FakeEmbeddingClient:
+    def embed(self, text):
+        return random_embedding(np.random.default_rng(len(text)))
+
+
+@override_settings(CELERY_TASK_ALWAYS_EAGER=True)
+class ProcessVideoTests(S3TestCase):
+    """The download -> [transcribe | frames] -> summarize -> embed chord, against local stand-ins."""
+
+    def setUp(self):
+        super().setUp()
+        self.work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.work_dir, ignore_errors=True)
+        self.temp_dir = os.path.join(self.work_dir, "downloads")
+        os.makedirs(self.temp_dir)
+        self.openai = FakeOpenAI()
+        for patcher in (
+            mock.patch.object(tempfile, "tempdir", self.temp_dir),  # where download_asset puts the video
+            mock.patch.object(content_cache, "_cache", content_cache.ContentCache(os.path.join(self.work_dir, "cache.sqlite3"))),
+            mock.patch.object(tasks, "client", self.openai),
+            mock.patch.object(tasks, "get_embedding_client", FakeEmbeddingClient),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.user = User.objects.create_user("creator", "creator@example.com", "password")
+
+    def create_post(self, body):
+        key = "creator/videos/clip.mp4"
+        self.s3.put_object(Bucket=settings.AWS_BUCKET, Key=key, Body=body)
+        [post] = create_posts(self.user, 1, np.random.default_rng(0))
+        PostRecord.objects.filter(pk=post.pk).update(
+            file_path=key, embedding=[], link=f"https://{settings.AWS_BUCKET}.s3.us-east-2.amazonaws.com/{key}"
+        )
+        return post
+
+    def process(self, post):
+        tasks.process_video(post.pk, "task")
+        post.refresh_from_db()
+        return post
+
+    @unittest.skipIf(shutil.which(settings.FFMPEG_BINARY) is None, "ffmpeg is not installed")
+    def test_pipeline(self):
+        video = os.path.join(self.work_dir, "clip.mp4")
+        subprocess.run(
+            [settings.FFMPEG_BINARY, "-v", "error", "-f", "lavfi", "-i", "testsrc=size=320x240:rate=10",
+             "-f", "lavfi", "-i", "sine", "-t", "3", "-pix_fmt", "yuv420p", "-shortest", video],
+            check=True,
+        )
+        with open(video, "rb") as f:
+            post = self.process(self.create_post(f.read()))
+
+        self.assertEqual((post.transcription, post.summary), ("hello world", "A cat plays the piano."))
+        self.assertEqual(len(post.embedding), 1536)
+        self.assertEqual(os.listdir(self.temp_dir), [])
+
+        # Finished stages are checkpointed, a re-run calls nothing again
+        self.openai.calls.clear()
+        self.process(post)
+        self.assertEqual(self.openai.calls, [])
+
+    def test_failed_header_stage_removes_download(self):
+        post = self.create_post(b"video")
+        with mock.patch.object(tasks, "transcribe_audio", side_effect=RuntimeError("no audio")), \
+                mock.patch.object(tasks, "extract_frames", return_value=([], [])):
+            self.process(post)
+        post.refresh_from_db()
+        self.assertIsNone(post.summary)
+        self.assertEqual(os.listdir(self.temp_dir), [])
+
+    def test_failed_header_stage_leaves_the_file_to_the_other(self):
+        post = self.create_post(b"video")
+        seen = []
+
+        def extract_frames(path):
+            # Runs after transcription failed for good, still reading the download stage's file
+            seen.append((path, os.path.exists(path)))
+            return [], []
+
+        with mock.patch.object(tasks, "transcribe_audio", side_effect=RuntimeError("no audio")) as transcribe, \
+                mock.patch.object(tasks, "extract_frames", side_effect=extract_frames), \
+                mock.patch.object(tasks, "download_asset", wraps=tasks.download_asset) as download:
+            self.process(post)
+        self.assertEqual(seen, [(transcribe.call_args.args[0], True)])
+        self.assertEqual(download.call_count, 1)
+        self.assertEqual(os.listdir(self.temp_dir), [])
+
+    def test_chord_errback_removes_download(self):
+        path = os.path.join(self.temp_dir, "video.mp4")
+        open(path, "wb").close()
+        summarize = tasks.analysis_pipeline(path, 1, "task").body
+        # What the result backend does once every header stage has returned and one failed
+        with mock.patch.object(celery_app.backend, "fail_from_current_stack"):
+            celery_app.backend.chord_error_from_stack(summarize, RuntimeError("no audio"))
+        self.assertFalse(os.path.exists(path))
+
+    def test_failed_summary_removes_download(self):
+        self.openai.summary = RuntimeError("model unavailable")
+        post = self.create_post(b"video")
+        with mock.patch.object(tasks, "transcribe_audio", return_value="hello world"), \
+                mock.patch.object(tasks, "extract_frames", return_value=([], [])):
+            self.process(post)
+        post.refresh_from_db()
+        self.assertEqual(self.openai.calls, ["summarize"] * (tasks.STAGE_RETRY["max_retries"] + 1))
+        self.assertIsNone(post.summary)
+        self.assertEqual(os.listdir(self.temp_dir), [])
+
+
+class RateLimited(Exception):
+    status_code = 429
+
+    def __init__(self, retry_after):
+        super().__init__("Rate limit reached")
+        self.response = SimpleNamespace(headers={"retry-after": str(retry_after)})
+
+
+class FakeEmbeddingsAPI:
+    """
+    Stands in for OpenAI(...): a vector per text (the same for the same text), a count of
+    round trips and their batch sizes, and a 429 for the first `rate_limited` requests.
+    """
+
+    def __init__(self, dimension, latency=0.0, rate_limited=0, retry_after=0.05):
+        self.dimension = dimension
+        self.latency = latency
+        self.rate_limited = rate_limited
+        self.retry_after = retry_after
+        self.round_trips = 0
+        self.batch_sizes = []
+        self.lock = threading.Lock()
+        self.embeddings = SimpleNamespace(create=self.create)
+
+    def __call__(self, api_key=None):
+        return self
+
+    def vector(self, text):
+        return np.random.default_rng(zlib.crc32(text.encode())).normal(size=self.dimension)
+
+    def create(self, input, model):
+        with self.lock:
+            self.round_trips += 1
+            limited, self.rate_limited = self.rate_limited > 0, max(self.rate_limited - 1, 0)
+            if not limited:
+                self.batch_sizes.append(len(input))
+        time.sleep(self.latency)
+        if limited:
+            raise RateLimited(self.retry_after)
+        return SimpleNamespace(data=[
+            SimpleNamespace(index=i, embedding=self.vector(text).tolist()) for i, text in enumerate(input)
+        ])
+
+
+class EmbeddingClientTests(SimpleTestCase):
+    """Round trips of the coalescing embedding client against FakeEmbeddingsAPI."""
+
+    def test_concurrent_calls_share_requests(self):
+        api = FakeEmbeddingsAPI(8, latency=0.02)
+        client = EmbeddingClient(api, coalesce_window=0.05)
+        texts = [f"concurrent text {i}" for i in range(64)]
+        with ThreadPoolExecutor(len(texts)) as pool:
+            embeddings = list(pool.map(client.embed, texts))
+        for text, embedding in zip(texts, embeddings):
+            np.testing.assert_allclose(embedding, api.vector(text))
+        self.assertLess(api.round_trips, len(texts) // 4)
+        self.assertEqual(sum(api.batch_sizes), len(texts))
+
+    def test_bulk_sends_full_batches_of_unique_texts(self):
+        work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, work_dir, ignore_errors=True)
+        api = FakeEmbeddingsAPI(8)
+        client = EmbeddingClient(api, cache=content_cache.ContentCache(os.path.join(work_dir, "cache.sqlite3")))
+        texts = [f"bulk text {i % 2500}" for i in range(5000)]  # every text twice
+
+        embeddings = client.embed_many(texts)
+        self.assertEqual(embeddings.shape, (5000, 8))
+        np.testing.assert_allclose(embeddings[-1], api.vector(texts[-1]))
+        self.assertEqual(sorted(api.batch_sizes), [2500 - MAX_BATCH_INPUTS, MAX_BATCH_INPUTS])
+
+        # Embedded texts come from the content cache
+        client.embed_many(texts[:100])
+        client.embed(texts[0])
+        self.assertEqual(api.round_trips, 2)
+
+    def test_rate_limit_is_retried_after_the_cooldown(self):
+        api = FakeEmbeddingsAPI(8, rate_limited=2, retry_after=0.1)
+        client = EmbeddingClient(api)
+        start = time.perf_counter()
+        embeddings = client.embed_many([f"limited text {i}" for i in range(10)])
+        self.assertEqual(embeddings.shape, (10, 8))
+        self.assertEqual((api.round_trips, client.requests, api.batch_sizes), (3, 3, [10]))
+        self.assertGreaterEqual(time.perf_counter() - start, 0.2)
+
+
+class ReembedPostsTests(TestCase):
+    def setUp(self):
+        work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, work_dir, ignore_errors=True)
+        self.checkpoint = os.path.join(work_dir, "checkpoint.json")
+        patcher = mock.patch.object(content_cache, "_cache", content_cache.ContentCache(os.path.join(work_dir, "cache.sqlite3")))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        rng = np.random.default_rng(0)
+        self.user = User.objects.create_user("viewer", "viewer@example.com", "password")
+        creator = User.objects.create_user("creator", "creator@example.com", "password")
+        self.posts = create_posts(creator, 3, rng, summary="A summary")
+        UserData.objects.create(user=self.user, user_preference_embeddings=[
+            {"embedding": random_embedding(rng), "weight": 1.0},
+        ])
+
+    def reembed(self, dimension, *args):
+        with mock.patch.object(reembed_posts, "OpenAI", FakeEmbeddingsAPI(dimension)):
+            call_command("reembed_posts", "--checkpoint", self.checkpoint, *args, stdout=io.StringIO())
+
+    def test_reembeds_and_resets_interests(self):
+        version = get_interest_version(self.user.user_id)
+        self.reembed(1536, "--reset-interests")
+        old = {post.pk: np.asarray(post.embedding) for post in self.posts}
+        for post in PostRecord.objects.all():
+            self.assertEqual(len(post.embedding), 1536)
+            self.assertFalse(np.allclose(post.embedding, old[post.pk]))
+        self.assertEqual(len(UserData.objects.get(user=self.user).user_preference_embeddings), 0)
+        self.assertGreater(get_interest_version(self.user.user_id), version)
+        self.assertFalse(os.path.exists(self.checkpoint))
+
+    def test_refuses_other_dimension(self):
+        with self.assertRaises(CommandError):
+            self.reembed(3072)
+        for post in PostRecord.objects.all():
+            self.assertEqual(len(post.embedding), 1536)
+        self.assertEqual(len(UserData.objects.get(user=self.user).user_preference_embeddings), 1)
+
+
+class EmbeddingStoreTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.creator = User.objects.create_user("creator", "creator@example.com", "password")
+        self.posts = create_posts(self.creator, 5, np.random.default_rng(0))
+        self.store = embedding_store.EmbeddingStore()
+        self.store.reload()
+
+    def test_refresh_counters_reconciles_the_table(self):
+        PostRecord.objects.filter(pk=self.posts[0].pk).update(views=7, likes=3)
+        self.posts[1].delete()  # no notification, like a cascaded delete
+        [added] = create_posts(self.creator, 1, np.random.default_rng(1))
+
+        self.store.refresh_counters()
+        with self.store.lock:
+            self.assertEqual(set(self.store.video_ids.tolist()), {post.pk for post in self.posts if post.pk != self.posts[1].pk} | {added.pk})
+            row = self.store.rows_of([self.posts[0].pk])[0]
+            self.assertEqual((self.store.views[row], self.store.likes[row]), (7, 3))
+
+    def test_rows_changed_during_the_scan_are_kept(self):
+        [added] = create_posts(self.creator, 1, np.random.default_rng(1))
+        values_list = PostRecord.objects.values_list
+
+        def scan(*fields):
+            rows = list(values_list(*fields))
+            # A notification is replayed while the table is being read
+            PostRecord.objects.filter(pk=self.posts[0].pk).update(views=9)
+            self.store.refresh_rows([self.posts[0].pk, added.pk])
+            return mock.Mock(iterator=lambda chunk_size: iter([row for row in rows if row[0] != added.pk]))
+
+        with mock.patch.object(PostRecord.objects, "values_list", scan):
+            self.store.refresh_counters()
+        with self.store.lock:
+            self.assertIn(added.pk, self.store)
+            self.assertEqual(self.store.views[self.store.rows_of([self.posts[0].pk])[0]], 9)
+
+    def test_sync_refreshes_counters_in_the_background(self):
+        self.store._last_counter_refresh = 0
+        with mock.patch.object(embedding_store.EmbeddingStore, "refresh_counters") as refresh, \
+                self.assertNumQueries(0):
+            self.store.sync()
+            self.store._counter_refresh.join()
+        refresh.assert_called_once()
+
+    def test_vectorised_ranks_match_the_per_video_loop(self):
+        PostRecord.objects.all().delete()
+        rng = np.random.default_rng(2)
+        embeddings = {}
+        for post, days in zip(create_posts(self.creator, 40, rng), rng.integers(0, 20, 40)):
+            embeddings[post.pk] = post.embedding  # the float64 list the per-video loop ranked
+            PostRecord.objects.filter(pk=post.pk).update(
+                views=int(rng.integers(0, 50)), likes=int(rng.integers(0, 10)), comments=int(rng.integers(0, 5)),
+                date_uploaded=post.date_uploaded - timedelta(days=int(days), hours=1),
+            )
+        unembedded = PostRecord.objects.create(user=self.creator, file_path="videos/new.mp4", thumbnail_path="",
+                                               file_size=1, length=10, width=720, height=1280, description="")
+        vectors = list(embeddings.values())
+
+        def near(*vectors):
+            v = np.sum(vectors, axis=0) + rng.normal(scale=0.01, size=len(vectors[0]))
+            return (v / np.linalg.norm(v)).tolist()
+
+        # Groups close to one or several videos, so every branch of score_interest is taken
+        user_data = SimpleNamespace(user_preference_embeddings=[
+            {"embedding": near(vectors[0]), "weight": 0.3},
+            {"embedding": near(vectors[0], vectors[1]), "weight": 0.8},
+            {"embedding": near(vectors[2], vectors[3], vectors[4]), "weight": 0.6},
+            {"embedding": random_embedding(rng), "weight": 0.5},
+            {"embedding": [], "weight": 0.2},
+        ])
+        self.store.reload()
+
+        with self.store.lock:
+            interest_scores, rank_scores = rank_video.calculate_video_ranks(user_data, self.store)
+            video_ids = self.store.video_ids.tolist()
+        self.assertEqual(np.count_nonzero(interest_scores > 0.3), 5)  # the five videos near an interest group
+        for video in PostRecord.objects.all():
+            if video.pk != unembedded.pk:
+                video.embedding = embeddings[video.pk]
+            row = video_ids.index(video.pk)
+            # The store scores float32 vectors, the loop scored float64 ones
+            np.testing.assert_allclose((interest_scores[row], rank_scores[row]),
+                                       rank_video.calculate_video_rank(user_data, video), rtol=0, atol=1e-6)
+
+
+@unittest.skipIf(mock_aws is None, "moto is not installed")
+class UpdateHLSPathsTests(SimpleTestCase):
+    """utils/update_hls_paths.py against moto S3 and an in-memory api_postrecord."""
+
+    # 2,500 objects to move: DeleteObjects takes at most 1000 keys, so the deletes need three batches
+    VIDEOS = 100
+    SEGMENTS = 24
+
+    def setUp(self):
+        aws = mock_aws()
+        aws.start()
+        self.addCleanup(aws.stop)
+        sys.path.insert(0, str(settings.BASE_DIR / "utils"))
+        self.addCleanup(sys.path.remove, str(settings.BASE_DIR / "utils"))
+        import update_hls_paths
+        self.m = update_hls_paths
+
+        self.s3 = storage.create_s3_client()
+        self.s3.create_bucket(Bucket=self.m.S3_BUCKET, CreateBucketConfiguration={"LocationConstraint": "us-east-2"})
+        self.db = {}
+        for v in range(1, self.VIDEOS + 1):
+            self.db[v] = (f"hls/clip{v}/clip{v}.m3u8", f"https://old/{v}")
+        with ThreadPoolExecutor(8) as pool:
+            list(pool.map(self.put, [key for v in self.db for key in (
+                f"hls/clip{v}/clip{v}.m3u8", *[f"hls/clip{v}/clip{v}_{i}.ts" for i in range(self.SEGMENTS)])]))
+        self.put("hls/other/keep.ts")
+        self.initial = (self.keys(), dict(self.db))
+
+        def update_video_paths(conn, updates):
+            for video_id, key, url in updates:
+                self.db[int(video_id)] = (key, url)
+
+        work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, work_dir, ignore_errors=True)
+        self.journal = lambda name: os.path.join(work_dir, f"{name}.jsonl")
+        for patcher in (
+            mock.patch.object(self.m, "s3", self.s3),
+            mock.patch.object(self.m.psycopg2, "connect", lambda **kwargs: _FakeConnection()),
+            mock.patch.object(self.m, "get_video_paths", lambda conn, ids: [[int(i), *self.db[int(i)]] for i in ids]),
+            mock.patch.object(self.m, "update_video_paths", update_video_paths),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def put(self, *keys):
+        for key in keys:
+            self.s3.put_object(Bucket=self.m.S3_BUCKET, Key=key, Body=key.encode())
+
+    def keys(self):
+        return set(storage.list_keys(self.m.S3_BUCKET, "", client=self.s3))
+
+    def videos(self):
+        return {str(v): {"username": f"user{v % 3}", "original_path": path} for v, (path, _) in self.db.items()}
+
+    def test_plan(self):
+        with ThreadPoolExecutor(4) as pool:
+            moves, updates = self.m.plan_moves(self.videos(), False, pool)
+        self.assertEqual(len(moves), self.VIDEOS * (self.SEGMENTS + 1))
+        self.assertIn(self.m.Move("2", "hls/clip2/clip2_1.ts", "user2/videos/clip2/clip2_1.ts", len("hls/clip2/clip2_1.ts")), moves)
+        self.assertIn(("4", "user1/videos/clip4/clip4.m3u8", f"{self.m.CDN_URL}/user1/videos/clip4/clip4.m3u8"), updates)
+
+    def test_migrate_and_rollback(self):
+        delete_objects = self.s3.delete_objects
+        batches = []
+
+        def counted(**kwargs):
+            batches.append(len(kwargs["Delete"]["Objects"]))
+            return delete_objects(**kwargs)
+
+        with mock.patch.object(self.s3, "delete_objects", counted):
+            self.m.migrate(self.videos(), False, self.journal("move"), 4)
+        moved = self.VIDEOS * (self.SEGMENTS + 1)
+        self.assertEqual(len(batches), math.ceil(moved / self.m.DELETE_BATCH_SIZE))
+        self.assertEqual(sum(batches), moved)
+        keys = self.keys()
+        self.assertFalse(any(key.startswith("hls/clip") for key in keys))
+        self.assertEqual(len(keys), len(self.initial[0]))
+        self.assertEqual(self.db[5][0], "user2/videos/clip5/clip5.m3u8")
+        body = self.s3.get_object(Bucket=self.m.S3_BUCKET, Key="user2/videos/clip5/clip5_3.ts")["Body"].read()
+        self.assertEqual(body, b"hls/clip5/clip5_3.ts")
+
+        self.m.rollback(self.journal("move"), 4)
+        self.assertEqual((self.keys(), self.db), self.initial)
+
+    def test_rollback_keeps_what_it_did_not_copy(self):
+        # Something already lives where a failing copy would have gone
+        self.put("user0/videos/clip3/clip3_2.ts")
+        copy_object = self.m.copy_object
+
+        def flaky_copy(old_key, new_key, size):
+            if old_key == "hls/clip3/clip3_2.ts":
+                raise RuntimeError("copy failed")
+            return copy_object(old_key, new_key, size)
+
+        with mock.patch.object(self.m, "copy_object", flaky_copy):
+            self.m.migrate(self.videos(), False, self.journal("move"), 4)
+        self.assertEqual(self.db[3], self.initial[1][3])  # the failed video stays
+        self.assertIn("hls/clip3/clip3_2.ts", self.keys())
+
+        self.m.rollback(self.journal("move"), 4)
+        self.assertEqual(self.keys(), self.initial[0] | {"user0/videos/clip3/clip3_2.ts"})
+        self.assertEqual(self.db, self.initial[1])
+
+    def test_rollback_keeps_copies_of_lost_sources(self):
+        self.m.migrate(self.videos(), False, self.journal("move"), 4)
+        # The journal lost its tail: the sources are gone but were never journaled as deleted
+        with open(self.journal("move")) as f:
+            entries = [line for line in f if '"op": "deleting"' not in line]
+        with open(self.journal("move"), "w") as f:
+            f.writelines(entries)
+        moved = self.keys()
+
+        self.m.rollback(self.journal("move"), 4)
+        self.assertEqual(self.keys(), moved)
+        self.assertEqual(self.db, self.initial[1])
+
+    def test_rollback_after_crash_during_deletes(self):
+        delete_objects = self.s3.delete_objects
+        calls = []
+
+        def crash(**kwargs):
+            # The process dies while the second batch is in flight; later batches never reach S3
+            calls.append(1)
+            if len(calls) == 1:
+                return delete_objects(**kwargs)
+            if len(calls) == 2:
+                delete_objects(**kwargs)
+            raise KeyboardInterrupt
+
+        with mock.patch.object(self.s3, "delete_objects", crash), self.assertRaises(KeyboardInterrupt):
+            self.m.migrate(self.videos(), False, self.journal("move"), 1)
+        self.m.rollback(self.journal("move"), 4)
+        self.assertEqual((self.keys(), self.db), self.initial)
@@ -48,6 +48,9 @@ urlpatterns = [
     re_path(r'^post/update_posts_engagement/$',
         views.UpdatePostsEngagementView.as_view(),
         name='update_posts_engagement'),
+    re_path(r'^post/update_posts_engagement_batch/$',
+        views.UpdatePostsEngagementBatchView.as_view(),
+        name='update_posts_engagement_batch'),
     re_path(r'^user/reset_user_engagement/$',
         views.ResetUserEngagementView.as_view(),
         name='reset_user_engagement'),
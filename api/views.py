@@ -1,7 +1,8 @@
 import os
 from django.shortcuts import render, redirect
 from .models import *
-from django.db.models import Count, Sum
+from django.db.models import Sum
+from django.db import transaction
 from django.http import HttpResponse
 from rest_framework.generics import CreateAPIView
 from rest_framework.permissions import AllowAny, IsAuthenticated
@@ -17,16 +18,25 @@ from rest_framework import status
 from django.conf import settings
 import base64
 from django.core.files.base import ContentFile
-import boto3
 from botocore.exceptions import NoCredentialsError
 import urllib.parse
 from django.utils.timezone import now
 from django.conf import settings
-from .rank_video import calculate_video_rank, update_user_data, calculate_engagement_score, output_user_preferences
+from .rank_video import output_user_preferences
+from .engagement import parse_engagement_event, parse_event_id, parse_flag, MAX_ENGAGEMENT_BATCH
+from .engagement_queue import make_event
+from .counters import increment_counter
+from .storage import delete_keys, get_s3_client
+from .hls import video_keys
+from .presign import BatchPresigner, presigned_post_for_prefix
 import re
 import numpy as np
-from django.core.cache import cache  # For optional caching
-from .tasks import process_video
+from .tasks import process_video, transcode_hls, schedule_feed_refresh, enqueue_engagement
+from .embedding_store import notify_video_changed
+from .feed import (
+    get_ranked_videos, get_feed_queue, consume_feed_queue, feed_queue_is_stale, forget_ranked_video, forget_feed,
+    get_reported_video_ids, invalidate_reported_video_ids, get_blocked_user_ids, invalidate_blocked_user_ids,
+)
 import uuid
 
 def main (request):
@@ -91,13 +101,8 @@ class VideoUploadView(APIView):
             video_upload_path = f"{request.user.username}/videos/{safe_file_name}-{timestamp}.mp4"
             thumbnail_upload_path = f"{request.user.username}/thumbnails/{safe_file_name}-{timestamp}.jpg"
 
-            # Initialize the S3 client
-            s3_client = boto3.client(
-                's3',
-            aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-                aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
-                region_name=settings.AWS_REGION
-            )
+            # Shared S3 client (see storage.py)
+            s3_client = get_s3_client()
 
             # Generate the presigned URL
             video_presigned_url = s3_client.generate_presigned_url(
@@ -139,6 +144,9 @@ class HLSUploadView(APIView):
     Generates presigned -PUT URLs for every HLS artifact (segments + master playlist)
     and a single thumbnail. The frontend should PUT each file to the returned URL
     using the indicated Content-Type.
+
+    With `upload_mode=post` it returns one POST policy (`upload_policy`) for the
+    video's folder instead of a URL per file.
     """
     permission_classes = [IsAuthenticated]
 
@@ -170,12 +178,7 @@ class HLSUploadView(APIView):
         # 3. Init S3 client ------------------------------------------------- #
         # ------------------------------------------------------------------ #
         try:
-            s3_client = boto3.client(
-                "s3",
-                aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-                aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
-                region_name=settings.AWS_REGION,
-            )
+            s3_client = get_s3_client()
         except NoCredentialsError:
             return JsonResponse({"error": "AWS credentials not found."}, status=500)
 
@@ -191,31 +194,20 @@ class HLSUploadView(APIView):
             return "application/octet-stream"
 
         upload_urls = {}
+        upload_policy = None
         try:
-            # HLS artifacts
-            for fname in files:
-                key = f"{video_root}{fname}"
-                presigned = s3_client.generate_presigned_url(
-                    "put_object",
-                    Params={
-                        "Bucket": settings.AWS_BUCKET,
-                        "Key": key,
-                        "ContentType": _ctype(fname),
-                    },
-                    ExpiresIn=3600,
-                )
-                upload_urls[fname] = presigned
+            # Signing key derived once, each URL is one HMAC (see presign.py)
+            presigner = BatchPresigner(s3_client, settings.AWS_BUCKET, expires_in=3600)
+            if request.data.get("upload_mode") == "post":
+                # One POST policy for the whole folder instead of a URL per file
+                upload_policy = presigned_post_for_prefix(s3_client, settings.AWS_BUCKET, video_root, expires_in=3600)
+            else:
+                # HLS artifacts
+                for fname in files:
+                    upload_urls[fname] = presigner.put_url(f"{video_root}{fname}", _ctype(fname))
 
             # Thumbnail
-            thumb_url = s3_client.generate_presigned_url(
-                "put_object",
-                Params={
-                    "Bucket": settings.AWS_BUCKET,
-                    "Key": thumb_key,
-                    "ContentType": "image/jpeg",
-                },
-                ExpiresIn=3600,
-            )
+            thumb_url = presigner.put_url(thumb_key, "image/jpeg")
 
         except Exception as e:
             # Catch *all* boto3 errors here so the client gets context
@@ -224,15 +216,15 @@ class HLSUploadView(APIView):
         # ------------------------------------------------------------------ #
         # 5. Respond -------------------------------------------------------- #
         # ------------------------------------------------------------------ #
-        return JsonResponse(
-            {
-                "upload_urls": upload_urls,       # { "playlist.m3u8": "https://…", "segment_000.ts": "https://…" }
-                "video_file_path": playlist_path, # master manifest path for DB
-                "thumb_url": thumb_url,
-                "thumb_file_path": thumb_key,
-            },
-            status=200,
-        )    
+        response = {
+            "upload_urls": upload_urls,       # { "playlist.m3u8": "https://…", "segment_000.ts": "https://…" }
+            "video_file_path": playlist_path, # master manifest path for DB
+            "thumb_url": thumb_url,
+            "thumb_file_path": thumb_key,
+        }
+        if upload_policy is not None:
+            response["upload_policy"] = upload_policy  # { "url": …, "fields": {…} }, POST each file with its Content-Type
+        return JsonResponse(response, status=200)    
 
 def clean_caption(caption):
     #remove tag special characters
@@ -279,9 +271,14 @@ class PostVideoView(APIView):
                 thumbnail_link=thumbnail_url,
             )
             video_record.save()
+            notify_video_changed(video_record.video_id)
 
             task_id = str(uuid.uuid4())
-            process_video.apply_async(args=[video_record.video_id, task_id], countdown=10)
+            # Stages retry with backoff, so no need to wait before the first attempt
+            transaction.on_commit(lambda: process_video.delay(video_record.video_id, task_id))
+            if settings.HLS_TRANSCODE_ON_UPLOAD and video_record.file_path.endswith(".mp4"):
+                # Server-side bitrate ladder for MP4 uploads (see hls.py)
+                transaction.on_commit(lambda: transcode_hls.delay(video_record.video_id))
 
             return JsonResponse({'message': 'Video posted successfully.'}, status=201)
 
@@ -289,43 +286,11 @@ class PostVideoView(APIView):
             #print(f"An error occurred: {str(e)}")
             return JsonResponse({'error': f"An error occurred: {str(e)}"}, status=500)
         
-def get_ranked_videos(user_data, watched_video_ids, batch_size):
-    # Cache key for this user's ranked videos
-    cache_key = f"user_{user_data}_ranked_videos"
-
-    # Try to fetch ranked videos from cache
-    rankings = cache.get(cache_key)
-    if not rankings:
-        # If not cached, compute rankings
-
-        videos = PostRecord.objects.exclude(
-            video_id__in=watched_video_ids
-        )
-        #print(f"Found {len(videos)} unwatched videos.") 
-
-        if len(videos) < batch_size:
-            #print ("Not enough unwatched videos")
-            videos = PostRecord.objects.all()
-
-        video_rankings = []
-        for video in videos:
-            interest_score, rank_score = calculate_video_rank(user_data, video)
-            video_rankings.append({
-                "video": video,
-                "rank_score": rank_score,
-                "interest_score": interest_score * 100,
-            })
-
-        # Sort videos by rank_score and cache the result
-        ranked_videos = sorted(
-            video_rankings, key=lambda item: item["rank_score"], reverse=True
-        )
-        rankings = {"videos": ranked_videos, "watched": watched_video_ids}
-        cache.set(cache_key, rankings, 1800)  # Cache for 30 minutes
-
-    ##print(rankings)
-
-    return rankings["videos"], rankings["watched"]
+FEED_SPARE_SAMPLES = 5
+FEED_RECORD_FIELDS = (
+    'video_id', 'file_path', 'file_size', 'length', 'width', 'height',
+    'description', 'link', 'likes', 'comments', 'user__username',
+)
 
 class GetFeedView(APIView):
     permission_classes = [IsAuthenticated]
@@ -352,74 +317,88 @@ class GetFeedView(APIView):
 
             # print(f"exclude_ids: {exclude_ids}")
 
-            # Get ranked videos for the user
-            watched_video_ids = ViewedPosts.objects.filter(
+            # Get ranked videos for the user, preferably from the precomputed feed queue
+            watched_video_ids = set(ViewedPosts.objects.filter(
                 user=request.user
-            ).values_list('video_id', flat=True)
-            ranked_videos, last_watched_ids = get_ranked_videos(user_data, watched_video_ids, batch_size)
-
-            existing_ids = set(PostRecord.objects.values_list('video_id', flat=True))
-            reported_ids = set(
-                ReportedVideo.objects.values('video_id')
-                .annotate(num_reports=Count('id'))
-                .filter(num_reports__gt=1)
-                .values_list('video_id', flat=True)
-            )
-            blocked_user_ids = set(
-                list(BlockedUser.objects.filter(blocker=request.user).values_list('blocked_id', flat=True)) +
-                list(BlockedUser.objects.filter(blocked=request.user).values_list('blocker_id', flat=True))
-            )
+            ).values_list('video_id', flat=True))
+            queue = get_feed_queue(request.user.user_id)
+            if queue is None or feed_queue_is_stale(request.user.user_id, queue):
+                schedule_feed_refresh(request.user.user_id)
+
+            # Cached exclusion sets; deleted videos are dropped when the sampled records are loaded
+            reported_ids = get_reported_video_ids()
+            blocked_user_ids = get_blocked_user_ids(request.user.user_id)
 
             # filter out unwatched, reported, blocked, own, excluded, and optionally non-followed videos
-            unwatched_videos = [
-                video for video in ranked_videos
-                if (
-                    video["video"].video_id not in watched_video_ids and
-                    video["video"].video_id in existing_ids and
-                    video["video"].video_id not in reported_ids and
-                    video["video"].user.user_id not in blocked_user_ids and
-                    video["video"].user.user_id != request.user.user_id and
-                    video["video"].video_id not in exclude_ids and
-                    (not followers_only or video["video"].user.user_id in following_ids)
+            def eligible(video):
+                return (
+                    video.video_id not in watched_video_ids and
+                    video.video_id not in reported_ids and
+                    video.user_id not in blocked_user_ids and
+                    video.user_id != request.user.user_id and
+                    video.video_id not in exclude_ids and
+                    (not followers_only or video.user_id in following_ids)
                 )
-            ]
+
+            unwatched_videos = [] if queue is None else [video for video in queue["videos"] if eligible(video)]
+            from_queue = len(unwatched_videos) >= batch_size
+            if not from_queue:
+                # Cache miss or exhausted queue, rank synchronously
+                ranked_videos = get_ranked_videos(user_data, watched_video_ids, batch_size)
+                unwatched_videos = [video for video in ranked_videos if eligible(video)]
 
             def weighted_sample(videos, count):
-                scores = np.array([item["rank_score"] for item in videos])
+                scores = np.array([item.rank_score for item in videos])
                 if scores.sum() == 0:
-                    indices = np.random.choice(videos, size=min(count, len(videos)), replace=False)
+                    indices = np.random.choice(len(videos), size=min(count, len(videos)), replace=False)
                 else :
                     probabilities = scores / scores.sum()  # Normalize to probabilities
                     indices = np.random.choice(len(videos), size=min(count, len(videos)), replace=False, p=probabilities)
                 return [videos[i] for i in indices]
 
-            selected_videos = weighted_sample(unwatched_videos, batch_size)
-            selected_video_records = [video["video"] for video in selected_videos]
+            # Sample a few spare videos in case some were deleted since they were ranked
+            sampled_videos = weighted_sample(unwatched_videos, batch_size + FEED_SPARE_SAMPLES)
+            selected_video_records = (
+                PostRecord.objects.select_related('user')
+                .only(*FEED_RECORD_FIELDS)
+                .in_bulk([video.video_id for video in sampled_videos])
+            )
+            selected_videos = [video for video in sampled_videos if video.video_id in selected_video_records][:batch_size]
+
+            if from_queue:
+                # Served, deleted, watched and reported videos leave the queue
+                consume_feed_queue(
+                    request.user.user_id, queue,
+                    [video.video_id for video in selected_videos] +
+                    [video.video_id for video in sampled_videos if video.video_id not in selected_video_records] +
+                    [video.video_id for video in queue["videos"]
+                     if video.video_id in watched_video_ids or video.video_id in reported_ids],
+                )
 
-            liked_video_ids = set(LikedPosts.objects.filter(user=request.user, video__in=selected_video_records).values_list('video_id', flat=True))
+            liked_video_ids = set(LikedPosts.objects.filter(user=request.user, video_id__in=[video.video_id for video in selected_videos]).values_list('video_id', flat=True))
 
             # print("selected_videos", selected_videos)
 
             # Serialize the final feed
-            feed_data = [
-                {
-                    "id": item["video"].video_id,
-                    "user": item["video"].user.username,
-                    "file_path": item["video"].file_path,
-                    "file_size": item["video"].file_size,
-                    "duration": item["video"].length,
-                    "width": item["video"].width,
-                    "height": item["video"].height,
-                    "description": item["video"].description,
-                    "link": item["video"].link,
-                    "likes": item["video"].likes,
-                    "comments": item["video"].comments,
-                    "rank_score": item["rank_score"],
-                    "interest_score": item["interest_score"],
-                    "liked": item["video"].video_id in liked_video_ids
-                }
-                for item in selected_videos
-            ]
+            feed_data = []
+            for item in selected_videos:
+                video = selected_video_records[item.video_id]
+                feed_data.append({
+                    "id": video.video_id,
+                    "user": video.user.username,
+                    "file_path": video.file_path,
+                    "file_size": video.file_size,
+                    "duration": video.length,
+                    "width": video.width,
+                    "height": video.height,
+                    "description": video.description,
+                    "link": video.link,
+                    "likes": video.likes,
+                    "comments": video.comments,
+                    "rank_score": item.rank_score,
+                    "interest_score": item.interest_score,
+                    "liked": video.video_id in liked_video_ids
+                })
 
             ##print(feed_data)
             return JsonResponse({'feed': feed_data}, status=200)
@@ -438,22 +417,20 @@ class LikePostView(APIView):
             return JsonResponse({'error': 'video_id is required.'}, status=400)
 
         try:
-            # Fetch the video record
-            video = PostRecord.objects.get(video_id=request.data['video_id'])
-            liked = request.data.get('like', "true") == "true"
-
-            liked_post, created = LikedPosts.objects.get_or_create(user=request.user, video=video)
+            video_id = int(request.data['video_id'])
+        except (TypeError, ValueError):
+            return JsonResponse({'error': 'video_id must be an integer.'}, status=400)
 
-            if liked and not created:
-                return JsonResponse({'message': 'Video already liked.'}, status=200)
-
-            if liked:
-                video.likes += 1
-            else:
-                video.likes -= 1
-                liked_post.delete()
+        try:
+            liked = parse_flag(request.data.get('like', "true"), 'like')
+            event_id = parse_event_id(request.data.get('event_id'))
+        except ValueError as e:
+            return JsonResponse({'error': str(e)}, status=400)
 
-            video.save()
+        try:
+            # The like is applied by consume_engagement_events, liking twice is a no-op there
+            enqueue_engagement([make_event("like", request.user.user_id, video_id=video_id, liked=liked,
+                                           event_id=event_id)])
 
             return JsonResponse({'message': 'Video liked successfully.'}, status=200)
 
@@ -470,26 +447,23 @@ class AddCommentView(APIView):
             return JsonResponse({'error': 'video_id and comment are required.'}, status=400)
 
         try:
-            # Fetch the video record
-            video = PostRecord.objects.get(video_id=request.data['video_id'])
-
-            # Increment the comment count
-            video.comments += 1
-            video.save()
-
             cleaned_comment = clean_caption(request.data['comment'])
             #print("got comment", cleaned_comment)
             # Check if the comment is empty after cleaning
             if not cleaned_comment:
                 return JsonResponse({'error': 'Comment cannot be empty.'}, status=400)
 
-            # Create a new comment record
-            comment = CommentRecord.objects.create(
-                user=request.user,
-                video=video,
-                comment=cleaned_comment
-            )
-            comment.save()
+            with transaction.atomic():
+                # Increment the comment count
+                if not increment_counter(request.data['video_id'], 'comments'):
+                    return JsonResponse({'error': 'Video not found.'}, status=404)
+
+                # Create a new comment record
+                CommentRecord.objects.create(
+                    user=request.user,
+                    video_id=request.data['video_id'],
+                    comment=cleaned_comment
+                )
 
             return JsonResponse({'message': 'Comment added successfully.'}, status=200)
 
@@ -508,10 +482,7 @@ class GetCommentsView(APIView):
 
         try:
             # Exclude comments from blocked users
-            blocked_user_ids = set(
-                list(BlockedUser.objects.filter(blocker=request.user).values_list('blocked_id', flat=True)) +
-                list(BlockedUser.objects.filter(blocked=request.user).values_list('blocker_id', flat=True))
-            )
+            blocked_user_ids = get_blocked_user_ids(request.user.user_id)
             # Fetch all comment records for the video, excluding blocked users
             comments = CommentRecord.objects.filter(
                 video=request.data['video_id']
@@ -598,20 +569,16 @@ class DeletePostView(APIView):
             # Fetch the video record
             video = PostRecord.objects.get(video_id=request.data['video_id'], user=request.user)
 
-            # Initialize the S3 client
-            s3_client = boto3.client(
-                's3',
-                aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-                aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
-                region_name=settings.AWS_REGION
-            )
-
-            # Delete the video and thumbnail from S3
-            s3_client.delete_object(Bucket=settings.AWS_BUCKET, Key=video.file_path)
-            s3_client.delete_object(Bucket=settings.AWS_BUCKET, Key=video.thumbnail_path)
+            # Delete the video (MP4 and HLS renditions, see hls.py) and thumbnail from S3
+            keys = video_keys(video.file_path, settings.AWS_BUCKET) + [video.thumbnail_path]
+            errors = delete_keys(settings.AWS_BUCKET, keys)
+            if errors:
+                return JsonResponse({'error': f"Could not delete {', '.join(errors)}."}, status=500)
 
             # Delete the video record
+            video_id = video.video_id
             video.delete()
+            notify_video_changed(video_id)
 
             return JsonResponse({'message': 'Video deleted successfully.'}, status=200)
 
@@ -628,45 +595,50 @@ class UpdatePostsEngagementView(APIView):
     permission_classes = [IsAuthenticated]
 
     def post(self, request):
-        # update engagement for a list of videos
+        # queue engagement for a single video, consume_engagement_events applies it
         #print("Request data:", request.data)  # Debugging statement
 
         if 'video_id' not in request.data:
             return JsonResponse({'error': 'video_id is required.'}, status=400)
         
         try:
-            user_data = UserData.objects.get(user=request.user)
+            event = parse_engagement_event(request.data)
+        except ValueError as e:
+            return JsonResponse({'error': str(e)}, status=400)
 
-            video_id = request.data['video_id']
-            watch_time = request.data.get('watch_time', 0)
-            liked = request.data.get('liked', False)
-            commented = request.data.get('commented', False)
-            viewed_comments = request.data.get('viewed_comments', False)
+        try:
+            enqueue_engagement([make_event("watch", request.user.user_id, **event)])
+            return JsonResponse({'message': 'Engagement updated successfully.'}, status=200)
+        
+        except Exception as e:
+            #print(f"An error occurred: {str(e)}")
+            return JsonResponse({'error': f"An error occurred: {str(e)}"}, status=500)
 
-            video = PostRecord.objects.get(video_id=video_id)
-            viewed_post, created = ViewedPosts.objects.get_or_create(user=request.user, video=video)
 
-            if created:
-                # This is the first time the user is viewing the video
-                if watch_time > 1:
-                    video.views += 1
-                    video.total_watch_time += watch_time
-                    viewed_post.save()
-                    video.save()
+class UpdatePostsEngagementBatchView(APIView):
+    """
+    Accepts {"events": [{video_id, watch_time, liked, commented, viewed_comments, event_id}, ...]}
+    and queues all of them with a single append.
+    """
+    permission_classes = [IsAuthenticated]
 
-            #print("calculating engagement")
-            engagement = calculate_engagement_score(video.length, watch_time, liked, commented, viewed_comments)
+    def post(self, request):
+        events = request.data.get('events')
+        if not isinstance(events, list) or not events:
+            return JsonResponse({'error': '`events` (list) is required.'}, status=400)
+        if len(events) > MAX_ENGAGEMENT_BATCH:
+            return JsonResponse({'error': f'At most {MAX_ENGAGEMENT_BATCH} events per request.'}, status=400)
 
-            #print("updating user data")
-    
-            update_user_data(video, user_data, engagement)
+        try:
+            events = [make_event("watch", request.user.user_id, **parse_engagement_event(event)) for event in events]
+        except ValueError as e:
+            return JsonResponse({'error': str(e)}, status=400)
 
-            #print("done")
+        try:
+            enqueue_engagement(events)
+            return JsonResponse({'message': 'Engagement updated successfully.', 'queued': len(events)}, status=200)
 
-            return JsonResponse({'message': 'Engagement updated successfully.'}, status=200)
-        
         except Exception as e:
-            #print(f"An error occurred: {str(e)}")
             return JsonResponse({'error': f"An error occurred: {str(e)}"}, status=500)
 
 
@@ -680,6 +652,8 @@ class ResetUserEngagementView(APIView):
             LikedPosts.objects.filter(user=request.user).delete()
             CommentRecord.objects.filter(user=request.user).delete()
             ViewedPosts.objects.filter(user=request.user).delete()
+            # The feed was ranked for the old interests and watch history
+            forget_feed(request.user.user_id)
 
             return JsonResponse({'message': 'Engagement reset successfully.'}, status=200)
         
@@ -712,6 +686,8 @@ class ReportVideoView(APIView):
             video = PostRecord.objects.get(video_id=request.data['video_id'])
             reason = request.data['reason']
             ReportedVideo.objects.create(user=request.user, video=video, reason=reason)
+            forget_ranked_video(request.user.user_id, video.video_id)
+            invalidate_reported_video_ids()
             return JsonResponse({'message': 'Video reported successfully.'}, status=201)
         except PostRecord.DoesNotExist:
             return JsonResponse({'error': 'Video not found.'}, status=404)
@@ -754,6 +730,7 @@ class BlockUserView(APIView):
             obj, created = BlockedUser.objects.get_or_create(blocker=request.user, blocked=to_block)
             if not created:
                 return JsonResponse({'message': 'User already blocked.'}, status=200)
+            invalidate_blocked_user_ids(request.user.user_id, to_block.user_id)
             return JsonResponse({'message': 'User blocked successfully.'}, status=201)
         except User.DoesNotExist:
             return JsonResponse({'error': 'User not found.'}, status=404)
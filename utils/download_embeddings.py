@@ -3,16 +3,30 @@ Utility script to download video embeddings and related thumbnail links from the
 
 This script connects to the database using environment variables for credentials,
 fetches the video_id, embedding, and thumbnail_link from the api_postrecord table,
-and saves the data as a CSV file named 'video_embeddings.csv'.
+and saves them in a columnar export:
+
+    video_embeddings.npy  float32 matrix, one row per video (np.load(..., mmap_mode="r"))
+    video_embeddings.npz  sidecar with the rows' video_id and thumbnail_link
+
+Rows are streamed from a server-side cursor in chunks and the packed embeddings (see
+api/fields.py) are written to the matrix as they are, so memory stays flat however
+large the catalog is. The matrix header has a fixed size and its row count is patched
+at the end, which lets --incremental append the videos added since the last export
+(and the ones that had no embedding yet) without rewriting the file.
 
 Usage:
-    python download_embeddings.py
+    python download_embeddings.py [--out PREFIX] [--incremental] [--chunk-size N]
 """
 
+import argparse
+import os
+import struct
+import time
+import zipfile
+
+import numpy as np
 import psycopg2
 from decouple import config
-import pandas as pd
-from sqlalchemy import create_engine
 
 DB_HOST = config('DB_HOST', default='database-1.c9k6y8qk8zdq.us-east-2.rds.amazonaws.com')
 DB_PORT = int(config('DB_PORT', default='5432'))
@@ -20,25 +34,201 @@ DB_NAME = config('DB_NAME', default='popoffdb')
 USER = config('DB_USER', default='postgres')
 DB_PASSWORD = config('DB_PASSWORD', default='replace-this-with-your-db-password')
 
-try:
-    conn = psycopg2.connect(
+EMBEDDING_TABLE = 'api_postrecord'
+EMBEDDING_DTYPE = np.dtype('<f4')  # must match PostRecord.embedding's VectorField dtype
+EXPORT_PREFIX = 'video_embeddings'
+CHUNK_SIZE = 2000  # rows per round trip of the server-side cursor
+NPY_HEADER_SIZE = 128  # fixed, so the row count can be rewritten in place
+
+
+def connect():
+    return psycopg2.connect(
         host=DB_HOST,
         port=DB_PORT,
         dbname=DB_NAME,
         user=USER,
         password=DB_PASSWORD
     )
-    print("✅ Connection successful!")
-    conn.close()
-except Exception as e:
-    print("❌ Connection failed:", e)
 
-EMBEDDING_TABLE = 'api_postrecord'
-# RDS connection string — already works on your server
-RDS_URI = f'postgresql://{USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}'
 
-engine = create_engine(RDS_URI)
-df = pd.read_sql(f'SELECT video_id, embedding, thumbnail_link FROM {EMBEDDING_TABLE}', engine)
+def npy_header(dtype, shape):
+    """A .npy (version 1.0) header of exactly NPY_HEADER_SIZE bytes."""
+    header = repr({"descr": np.lib.format.dtype_to_descr(np.dtype(dtype)), "fortran_order": False, "shape": tuple(shape)})
+    header = header.ljust(NPY_HEADER_SIZE - 11) + "\n"
+    return np.lib.format.MAGIC_PREFIX + bytes([1, 0]) + struct.pack("<H", len(header)) + header.encode("latin1")
+
+
+def read_npy_header(f):
+    """(dtype, shape) of the .npy file or zip member f, leaving f at the start of the data."""
+    version = np.lib.format.read_magic(f)
+    read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+    shape, _, dtype = read_header(f)
+    return dtype, shape
+
+
+def iter_npy_chunks(f, dtype, rows, chunk_rows=CHUNK_SIZE * 10):
+    """The data of an open .npy stream as arrays of up to chunk_rows items."""
+    while rows:
+        count = min(rows, chunk_rows)
+        yield np.frombuffer(f.read(count * dtype.itemsize), dtype=dtype)
+        rows -= count
+
+
+def load_embeddings(prefix=EXPORT_PREFIX):
+    """(video ids, thumbnail links, embedding matrix) of an export; the matrix is memory-mapped."""
+    with np.load(f"{prefix}.npz") as sidecar:
+        video_ids, links = sidecar["video_id"], sidecar["thumbnail_link"]
+    # The sidecar is replaced last, so it has the row count of the last complete export
+    matrix = np.load(f"{prefix}.npy", mmap_mode="r")[:len(video_ids)]
+    return video_ids, links, matrix
+
+
+def _previous_export(prefix):
+    """(row count, dimension, last exported id, ids that had no embedding) of an existing export."""
+    with np.load(f"{prefix}.npz") as sidecar:  # members are read on access, the id column is not
+        skipped = sidecar["skipped_video_id"].tolist()
+        last_id = int(sidecar["last_video_id"])
+    with zipfile.ZipFile(f"{prefix}.npz") as sidecar, sidecar.open("video_id.npy") as f:
+        _, (rows,) = read_npy_header(f)
+    with open(f"{prefix}.npy", "rb") as f:
+        _, (_, dimension) = read_npy_header(f)
+    return rows, dimension or None, last_id, skipped
+
+
+def export_rows(conn, matrix, offset, dimension, ids_file, links_file, since_id=0, retry_ids=(), chunk_size=CHUNK_SIZE):
+    """
+    Stream rows with video_id > since_id (or in retry_ids) into the matrix file at
+    offset, their ids and links into the part files. Returns (dimension, rows written,
+    longest link, highest id seen, ids without a usable embedding).
+    """
+    cur = conn.cursor(name="embedding_export")  # server-side: rows arrive chunk_size at a time
+    cur.itersize = chunk_size
+    cur.execute(
+        f"SELECT video_id, embedding, thumbnail_link FROM {EMBEDDING_TABLE} "
+        f"WHERE video_id > %s OR video_id = ANY(%s) ORDER BY video_id",
+        (since_id, list(retry_ids))
+    )
+    matrix.seek(offset)
+    rows, longest, last_id, skipped = 0, 0, since_id, []
+    while True:
+        chunk = cur.fetchmany(chunk_size)
+        if not chunk:
+            break
+        ids = []
+        for video_id, packed, link in chunk:
+            last_id = max(last_id, video_id)
+            size = len(packed) if packed is not None else 0
+            if dimension is None and size:
+                dimension = size // EMBEDDING_DTYPE.itemsize
+            if not size or size != dimension * EMBEDDING_DTYPE.itemsize:
+                skipped.append(video_id)  # not embedded yet
+                continue
+            matrix.write(packed)
+            ids.append(video_id)
+            link = (link or "").replace("\n", "")  # one link per line in the part file
+            links_file.write(link + "\n")
+            longest = max(longest, len(link))
+        np.asarray(ids, dtype=np.int64).tofile(ids_file)
+        rows += len(ids)
+        print(f"📦 {rows} rows exported...")
+    cur.close()
+    return dimension, rows, longest, last_id, skipped
+
+
+def _write_member(sidecar, name, dtype, shape, chunks):
+    with sidecar.open(f"{name}.npy", "w", force_zip64=True) as member:
+        member.write(npy_header(dtype, shape))
+        for chunk in chunks:
+            member.write(np.ascontiguousarray(chunk, dtype=dtype).tobytes())
+
+
+def write_sidecar(path, prefix, previous_rows, new_rows, longest, last_id, skipped, ids_path, links_path):
+    """Write the sidecar to path: the previous export's columns (if any) followed by the new rows."""
+    old = zipfile.ZipFile(f"{prefix}.npz") if previous_rows else None
+    try:
+        if old is not None:
+            with old.open("thumbnail_link.npy") as f:
+                longest = max(longest, read_npy_header(f)[0].itemsize // 4)
+        link_dtype = np.dtype(f"<U{max(longest, 1)}")
+        total = previous_rows + new_rows
+
+        def column(name, dtype, new_chunks):
+            if old is not None:
+                with old.open(f"{name}.npy") as f:
+                    old_dtype, (rows,) = read_npy_header(f)
+                    for chunk in iter_npy_chunks(f, old_dtype, rows):
+                        yield chunk.astype(dtype)
+            yield from new_chunks
+
+        def new_ids():
+            with open(ids_path, "rb") as f:
+                yield from iter_npy_chunks(f, np.dtype(np.int64), new_rows)
+
+        def new_links():
+            with open(links_path, encoding="utf-8", newline="\n") as f:
+                batch = []
+                for line in f:
+                    batch.append(line.rstrip("\n"))
+                    if len(batch) == CHUNK_SIZE * 10:
+                        yield np.array(batch, dtype=link_dtype)
+                        batch = []
+                if batch:
+                    yield np.array(batch, dtype=link_dtype)
+
+        with zipfile.ZipFile(path, "w", zipfile.ZIP_STORED, allowZip64=True) as sidecar:
+            _write_member(sidecar, "video_id", np.int64, (total,), column("video_id", np.int64, new_ids()))
+            _write_member(sidecar, "thumbnail_link", link_dtype, (total,), column("thumbnail_link", link_dtype, new_links()))
+            _write_member(sidecar, "skipped_video_id", np.int64, (len(skipped),), [skipped])
+            _write_member(sidecar, "last_video_id", np.int64, (), [[last_id]])
+    finally:
+        if old is not None:
+            old.close()
+
+
+def export(prefix=EXPORT_PREFIX, incremental=False, chunk_size=CHUNK_SIZE):
+    incremental = incremental and os.path.exists(f"{prefix}.npz") and os.path.exists(f"{prefix}.npy")
+    previous_rows, dimension, since_id, retry_ids = _previous_export(prefix) if incremental else (0, None, 0, [])
+    if incremental:
+        print(f"➕ Appending to {previous_rows} rows (videos after {since_id}, {len(retry_ids)} to retry).")
+
+    ids_path, links_path, sidecar_path = f"{prefix}.ids.part", f"{prefix}.links.part", f"{prefix}.npz.part"
+    start = time.perf_counter()
+    conn = connect()
+    try:
+        with open(f"{prefix}.npy", "r+b" if incremental else "wb") as matrix, \
+                open(ids_path, "wb") as ids_file, open(links_path, "w", encoding="utf-8", newline="\n") as links_file:
+            offset = NPY_HEADER_SIZE + previous_rows * (dimension or 0) * EMBEDDING_DTYPE.itemsize
+            if not incremental:
+                matrix.write(npy_header(EMBEDDING_DTYPE, (0, 0)))
+            dimension, rows, longest, last_id, skipped = export_rows(
+                conn, matrix, offset, dimension, ids_file, links_file, since_id, retry_ids, chunk_size
+            )
+            matrix.truncate()  # rows an interrupted export wrote past the last complete one
+            matrix.seek(0)
+            matrix.write(npy_header(EMBEDDING_DTYPE, (previous_rows + rows, dimension or 0)))
+            matrix.flush()
+            os.fsync(matrix.fileno())
+    finally:
+        conn.close()
+
+    try:
+        write_sidecar(sidecar_path, prefix, previous_rows, rows, longest, last_id, skipped, ids_path, links_path)
+        os.replace(sidecar_path, f"{prefix}.npz")
+    finally:
+        for path in (ids_path, links_path):
+            os.remove(path)
+    print(f"✅ Exported {rows} embeddings ({previous_rows + rows} total, {len(skipped)} videos without one) "
+          f"to {prefix}.npy/.npz in {time.perf_counter() - start:.1f}s.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export video embeddings to an .npy matrix and .npz sidecar.")
+    parser.add_argument("--out", default=EXPORT_PREFIX, help="path prefix of the .npy/.npz files")
+    parser.add_argument("--incremental", action="store_true", help="append the videos added since the last export")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="rows fetched per round trip")
+    args = parser.parse_args()
+    export(args.out, args.incremental, args.chunk_size)
+
 
-df.to_csv('video_embeddings.csv', index=False)
-print("✅ CSV saved.")
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,38 @@
 """
 Utility script to update HLS video paths in the database, manage S3 file migrations, and update thumbnails to use CloudFront URLs.
+
+Moves run as planned migrations: every video's directory is listed up front (in
+parallel), then all objects are copied through a bounded thread pool, the database is
+updated in one batch over one connection, and only then are the sources removed with
+DeleteObjects, 1000 keys per call. A video whose copies did not all succeed keeps its
+old files and database row.
+
+Each step is written to a journal (JSON lines, fsynced) before it takes effect, so an
+interrupted or unwanted migration can be undone with `rollback JOURNAL`: deleted
+sources are copied back, the previous database values restored and the copies removed,
+except copies whose source is missing (the only copy left) or whose copy failed.
+
+Usage:
+    python update_hls_paths.py [thumbnails]
+    python update_hls_paths.py move|revert [--threads N] [--journal PATH] [--dry-run]
+    python update_hls_paths.py delete-mp4 [--threads N] [--dry-run]
+    python update_hls_paths.py rollback JOURNAL [--threads N]
 """
 
-import boto3
-import psycopg2
+import argparse
+import json
 import os
+import sys
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from api.storage import DEFAULT_MAX_POOL_CONNECTIONS, create_s3_client, get_s3_client, list_keys, list_objects
 
 
 from decouple import config
@@ -21,6 +49,7 @@ DB_CONFIG = {
 S3_BUCKET = "byteverse"
 HLS_OUTPUT_PREFIX = "hls"  # where to upload new HLS videos
 CLOUDFRONT_URL = f"https://{S3_BUCKET}.s3.us-east-2.amazonaws.com"
+CDN_URL = "https://d2siyp5dx1ck05.cloudfront.net"
 TMP_DIR = "./tmp_video"
 TABLE_NAME = "api_postrecord"
 VIDEO_ID_FIELD = "video_id"
@@ -29,11 +58,18 @@ VIDEO_LINK_FIELD = "link"  # public full URL
 
 HLS_PREFIX = "hls/"
 TARGET_PREFIX = "videos"
+MASTER_PLAYLIST = "master.m3u8"
+
+DELETE_BATCH_SIZE = 1000  # DeleteObjects limit
+MAX_COPY_OBJECT_SIZE = 5 * 1024 ** 3  # larger objects need a multipart copy
+DEFAULT_THREADS = DEFAULT_MAX_POOL_CONNECTIONS
 # =============== #
 
 # S3 + DB Clients
-s3 = boto3.resource("s3")
-bucket = s3.Bucket(S3_BUCKET)
+s3 = get_s3_client()
+
+# One object to move: video_id, old_key, new_key, size
+Move = namedtuple("Move", "video_id old_key new_key size")
 
 def get_all_video_records():
     """
@@ -58,127 +94,315 @@ def get_all_video_records():
     video_data = {}
     for video_id, user, file_path in rows:
         video_id = str(video_id)
-        print(user)
         video_data[video_id] = {
             "username": user,
             "original_path": file_path,
         }
 
     print(f"✅ Retrieved {len(video_data)} video records.")
-    print(video_data)
     return video_data
 
 
-def update_video_path_in_db(video_id, s3_key, public_url):
-    print(f"📝 Updating DB for video {video_id}")
-    conn = psycopg2.connect(**DB_CONFIG)
+def get_video_paths(conn, video_ids):
+    """Current [(video_id, file_path, link)] of the given videos."""
     cur = conn.cursor()
     cur.execute(
-        """
-        UPDATE api_postrecord
-        SET file_path = %s,
-            link = %s
-        WHERE video_id = %s
+        f"SELECT {VIDEO_ID_FIELD}, {VIDEO_FILE_PATH_FIELD}, {VIDEO_LINK_FIELD} FROM {TABLE_NAME} "
+        f"WHERE {VIDEO_ID_FIELD} = ANY(%s)",
+        ([int(video_id) for video_id in video_ids],)
+    )
+    rows = cur.fetchall()
+    cur.close()
+    return rows
+
+
+def update_video_paths(conn, updates):
+    """Set file_path/link of many videos in one statement: [(video_id, s3_key, public_url), ...]."""
+    if not updates:
+        return
+    cur = conn.cursor()
+    execute_values(
+        cur,
+        f"""
+        UPDATE {TABLE_NAME} AS p
+        SET {VIDEO_FILE_PATH_FIELD} = v.s3_key,
+            {VIDEO_LINK_FIELD} = v.public_url
+        FROM (VALUES %s) AS v (video_id, s3_key, public_url)
+        WHERE p.{VIDEO_ID_FIELD} = v.video_id
         """,
-        (s3_key, public_url, video_id)
+        [(int(video_id), s3_key, public_url) for video_id, s3_key, public_url in updates],
+        page_size=len(updates),
     )
     conn.commit()
     cur.close()
-    conn.close()
 
 
-def move_hls_and_cleanup(video_data):
-    print("📦 Starting HLS file migration...")
+class Journal:
+    """Append-only JSON-lines log of a migration, each entry fsynced before the step it describes."""
+
+    def __init__(self, path):
+        if os.path.exists(path) and os.path.getsize(path):
+            raise FileExistsError(f"Journal {path} already exists; pass a new --journal path")
+        self.path = path
+        self._file = open(path, "a")
+        self._lock = threading.Lock()  # delete batches are recorded from the pool's threads
+
+    def record(self, op, **fields):
+        line = json.dumps({"op": op, **fields}) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+    @staticmethod
+    def read(path):
+        entries = []
+        with open(path) as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    continue  # torn last line of an interrupted run
+        return entries
+
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def copy_object(old_key, new_key, size):
+    source = {"Bucket": S3_BUCKET, "Key": old_key}
+    if size > MAX_COPY_OBJECT_SIZE:
+        s3.copy(source, S3_BUCKET, new_key)
+    else:
+        s3.copy_object(CopySource=source, Bucket=S3_BUCKET, Key=new_key)
+
+
+def copy_objects(pairs, pool):
+    """Copy [(old_key, new_key, size)] concurrently; returns {old_key: error} of the failed copies."""
+    futures = {pool.submit(copy_object, *pair): pair[0] for pair in pairs}
+    failed = {}
+    for future in as_completed(futures):
+        try:
+            future.result()
+        except Exception as e:
+            failed[futures[future]] = str(e)
+    return failed
+
+
+def delete_keys(keys, pool, journal=None):
+    """
+    Delete keys with DeleteObjects, 1000 per call and the calls in parallel. Each batch is
+    journaled before it is sent. Returns {key: error} of the keys S3 did not delete.
+    """
+    def delete(batch):
+        if journal is not None:
+            journal.record("deleting", keys=batch)
+        response = s3.delete_objects(
+            Bucket=S3_BUCKET,
+            Delete={"Objects": [{"Key": key} for key in batch], "Quiet": True},
+        )
+        return {error["Key"]: error.get("Message", error.get("Code")) for error in response.get("Errors", [])}
+
+    futures = {pool.submit(delete, batch): batch for batch in _chunks(list(keys), DELETE_BATCH_SIZE)}
+    failed = {}
+    for future in as_completed(futures):
+        try:
+            failed.update(future.result())
+        except Exception as e:
+            failed.update((key, str(e)) for key in futures[future])
+    return failed
+
+
+def existing_keys(prefixes, pool):
+    """Every key under the given prefixes, listed in parallel."""
+    keys = set()
+    for listed in pool.map(lambda prefix: list(list_keys(S3_BUCKET, prefix, client=s3)), prefixes):
+        keys.update(listed)
+    return keys
+
+
+def plan_moves(video_data, revert, pool):
+    """
+    List every video's HLS directory in parallel and pair each object with its new key.
 
+    Moving takes hls/<name>/ to <username>/videos/<name>/; reverting takes the directory
+    of the video's current playlist back to hls/<name>/. Returns the moves and, per video,
+    the database update (video_id, playlist key, public URL) for its new location.
+    """
+    def directories(data):
+        path = data["original_path"]
+        if not path:
+            return None
+        video_name = os.path.basename(path).split(".")[0]
+        if revert:
+            return f"{os.path.dirname(path)}/", f"{HLS_PREFIX}{video_name}/"
+        return f"{HLS_PREFIX}{video_name}/", f"{data['username']}/{TARGET_PREFIX}/{video_name}/"
+
+    def plan(video_id, old_prefix, new_prefix):
+        return [
+            Move(video_id, obj["Key"], new_prefix + os.path.basename(obj["Key"]), obj["Size"])
+            for obj in list_objects(S3_BUCKET, old_prefix, client=s3)
+        ]
+
+    futures = {}
     for video_id, data in video_data.items():
-        username = data["username"]
-        original_key = data["original_path"]
-
-        if not original_key:
+        prefixes = directories(data)
+        if prefixes is None or prefixes[0] == prefixes[1]:
             continue
-
-        # Get the original directory prefix (e.g., hls/video123/)
-        base_name = os.path.basename(original_key)
-        video_name = os.path.splitext(base_name)[0]
-        directory_prefix = "hls/" + video_name
-        new_base_prefix = f"{username}/{TARGET_PREFIX}/{video_name}"
-
-        print(f"📁 Moving all files from: {directory_prefix}/")
-
-        # List all objects in the same directory
-        objects = list(bucket.objects.filter(Prefix=f"{directory_prefix}/"))
-
-        if not objects:
-            print(f"⚠️ No files found for: {directory_prefix}/")
+        futures[pool.submit(plan, video_id, *prefixes)] = (video_id, prefixes[0])
+
+    moves, updates = [], []
+    for future in as_completed(futures):
+        video_id, old_prefix = futures[future]
+        video_moves = future.result()
+        if not video_moves:
+            print(f"⚠️ No files found for {video_id} at {old_prefix}")
             continue
-
-        for obj in objects:
-            old_key = obj.key
-            filename = os.path.basename(old_key)
-            new_key = f"{new_base_prefix}/{filename}"
-
-            print(f"🔁 Moving {old_key} → {new_key}")
-            copy_source = {"Bucket": S3_BUCKET, "Key": old_key}
-            bucket.copy(copy_source, new_key)
-            s3.Object(S3_BUCKET, old_key).delete()
-
-            # Update DB if this is the .m3u8 file
-            if filename.endswith(".m3u8"):
-                public_url = f"https://d2siyp5dx1ck05.cloudfront.net/{new_key}"
-                update_video_path_in_db(video_id, new_key, public_url)
-
-    print("✅ HLS migration complete.")
-
-
-def delete_old_mp4_files(video_data):
+        moves += video_moves
+        # The master playlist if there is one (adaptive ladders have one per rendition too)
+        playlists = sorted(
+            (os.path.basename(move.new_key) != MASTER_PLAYLIST, move.new_key)
+            for move in video_moves if move.new_key.endswith(".m3u8")
+        )
+        if playlists:
+            new_key = playlists[0][1]
+            updates.append((video_id, new_key, f"{CDN_URL}/{new_key}"))
+    return moves, updates
+
+
+def run_migration(moves, updates, journal, pool):
+    """Copy, update the database, then delete the sources; every step journaled first."""
+    journal.record("plan", moves=[[move.old_key, move.new_key, move.size] for move in moves])
+
+    start = time.perf_counter()
+    failed = copy_objects([(move.old_key, move.new_key, move.size) for move in moves], pool)
+    failed_videos = {move.video_id for move in moves if move.old_key in failed}
+    for old_key, error in failed.items():
+        print(f"⚠️ Failed to copy {old_key}: {error}")
+    print(f"🔁 Copied {len(moves) - len(failed)} objects in {time.perf_counter() - start:.1f}s.")
+    if failed_videos:
+        print(f"⚠️ Leaving {len(failed_videos)} videos in place: {sorted(failed_videos)}")
+    journal.record("copied", failed_videos=sorted(failed_videos), failed_keys=sorted(failed))
+
+    updates = [update for update in updates if update[0] not in failed_videos]
+    if updates:
+        conn = psycopg2.connect(**DB_CONFIG)
+        try:
+            previous = get_video_paths(conn, [video_id for video_id, _, _ in updates])
+            journal.record("db", previous=previous)
+            update_video_paths(conn, updates)
+        finally:
+            conn.close()
+        print(f"📝 Updated {len(updates)} video records.")
+
+    start = time.perf_counter()
+    old_keys = [move.old_key for move in moves if move.video_id not in failed_videos]
+    failed = delete_keys(old_keys, pool, journal)
+    for key, error in failed.items():
+        print(f"⚠️ Failed to delete {key}: {error}")
+    print(f"🧹 Deleted {len(old_keys) - len(failed)} objects in {time.perf_counter() - start:.1f}s.")
+    journal.record("done")
+
+
+def migrate(video_data, revert, journal_path, threads, dry_run=False):
+    print("⏪ Reverting HLS files..." if revert else "📦 Starting HLS file migration...")
+    with ThreadPoolExecutor(threads) as pool:
+        moves, updates = plan_moves(video_data, revert, pool)
+        print(f"🧠 Planned {len(moves)} objects of {len(updates)} videos.")
+        if dry_run:
+            for move in moves:
+                print(f"   {move.old_key} → {move.new_key}")
+            return
+        if not moves:
+            return
+        journal = Journal(journal_path)
+        try:
+            run_migration(moves, updates, journal, pool)
+        finally:
+            journal.close()
+    print(f"✅ Migration complete (journal: {journal_path}).")
+
+
+def move_hls_and_cleanup(video_data, journal_path, threads=DEFAULT_THREADS):
+    migrate(video_data, False, journal_path, threads)
+
+
+def revert_video_files(video_data, journal_path, threads=DEFAULT_THREADS):
+    migrate(video_data, True, journal_path, threads)
+
+
+def rollback(journal_path, threads=DEFAULT_THREADS):
+    """Undo the migration recorded in journal_path, however far it got."""
+    print(f"⏪ Rolling back {journal_path}...")
+    entries = Journal.read(journal_path)
+    ops = {entry["op"] for entry in entries}
+    if "rolled_back" in ops:
+        print("⚠️ Already rolled back.")
+        return
+    moves = next((entry["moves"] for entry in entries if entry["op"] == "plan"), [])
+    # Batches that may have been deleted (the journal is written before each DeleteObjects)
+    deleted = {key for entry in entries if entry["op"] == "deleting" for key in entry["keys"]}
+    previous = next((entry["previous"] for entry in entries if entry["op"] == "db"), None)
+
+    with ThreadPoolExecutor(threads) as pool:
+        # Deleted sources are copied back from their new location first (a source that
+        # survived a failed batch is overwritten with identical bytes)
+        restores = [(new_key, old_key, size) for old_key, new_key, size in moves if old_key in deleted]
+        failed = copy_objects(restores, pool)
+        for key, error in failed.items():
+            print(f"⚠️ Failed to restore from {key}: {error}")
+        print(f"🔁 Restored {len(restores) - len(failed)} deleted objects.")
+
+        if previous:
+            conn = psycopg2.connect(**DB_CONFIG)
+            try:
+                update_video_paths(conn, previous)
+            finally:
+                conn.close()
+            print(f"📝 Restored {len(previous)} video records.")
+
+        # A copy is only removed when its source exists again (or was never deleted), and
+        # never where the copy failed: whatever is at that key was not written by us
+        copied = next((entry for entry in entries if entry["op"] == "copied"), None)
+        if copied is not None and copied["failed_videos"] and "failed_keys" not in copied:
+            print("⚠️ Journal does not say which copies failed, keeping every copy.")
+            moves = []
+        failed_keys = set(copied.get("failed_keys", [])) if copied else set()
+        sources = existing_keys({os.path.dirname(old_key) + "/" for old_key, _, _ in moves}, pool)
+        copies = [new_key for old_key, new_key, _ in moves if old_key in sources and old_key not in failed_keys]
+        kept = len(moves) - len(copies)
+        if kept:
+            print(f"⚠️ Keeping {kept} copies whose source is missing or whose copy failed.")
+        failed = delete_keys(copies, pool)
+        for key, error in failed.items():
+            print(f"⚠️ Failed to delete {key}: {error}")
+        print(f"🧹 Deleted {len(copies) - len(failed)} copies.")
+
+    with open(journal_path, "a") as f:
+        f.write(json.dumps({"op": "rolled_back"}) + "\n")
+    print("✅ Rollback complete.")
+
+
+def delete_old_mp4_files(video_data, threads=DEFAULT_THREADS, dry_run=False):
     print("🧹 Deleting old .mp4 files...")
 
-    for video_id, data in video_data.items():
-        path = data["original_path"]
-        if path and path.endswith(".mp4"):
-            print(f"❌ Deleting {path}")
-            try:
-                s3.Object(S3_BUCKET, path).delete()
-            except Exception as e:
-                print(f"⚠️ Failed to delete {path}: {e}")
+    paths = [data["original_path"] for data in video_data.values()
+             if data["original_path"] and data["original_path"].endswith(".mp4")]
+    print(f"❌ Deleting {len(paths)} files")
+    if dry_run:
+        return
+    with ThreadPoolExecutor(threads) as pool:
+        failed = delete_keys(paths, pool)
+    for path, error in failed.items():
+        print(f"⚠️ Failed to delete {path}: {error}")
 
     print("✅ .mp4 cleanup complete.")
 
-def revert_video_files(video_data):
-    print("⏪ Reverting HLS files...")
-
-    for video_id, data in video_data.items():
-        user = data["username"]
-        key = data["original_path"]
-        filename = key.split("/")[-1]
-        filename = filename.split(".")[0]
-        current_prefix = f"/{user}/{TARGET_PREFIX}/{video_id}/"
-        new_prefix = f"hls/{filename}/"
-
-        print(f"🔍 Scanning: {current_prefix}")
-
-        objects = list(bucket.objects.filter(Prefix=key))
-        if not objects:
-            print(f"⚠️ No files found for {video_id} at {key}")
-            continue
-
-        for obj in objects:
-            old_key = obj.key
-            new_filename = os.path.basename(old_key)
-            new_key = f"{new_prefix}{new_filename}"
-
-            print(f"🔁 Moving {old_key} → {new_key}")
-            copy_source = {'Bucket': S3_BUCKET, 'Key': old_key}
-            bucket.copy(copy_source, new_key)
-            s3.Object(S3_BUCKET, old_key).delete()
-
-            # Update DB if this is the .m3u8 file
-            if filename.endswith(".m3u8"):
-                new_url = f"https://d2siyp5dx1ck05.cloudfront.net/{new_key}"
-                update_video_path_in_db(video_id, new_key, new_url)
-
-    print("✅ All videos reverted successfully.")
-
 
 def convert_thumbnail_url(s3_url):
     """
@@ -193,7 +417,7 @@ def convert_thumbnail_url(s3_url):
         print(f"⚠️ Couldn't parse S3 key from: {s3_url}")
         return s3_url
 
-    return f"https://d2siyp5dx1ck05.cloudfront.net/{s3_key}"
+    return f"{CDN_URL}/{s3_key}"
 
 
 def update_thumbnails():
@@ -206,31 +430,59 @@ def update_thumbnails():
     rows = cur.fetchall()
     print(f"✅ Retrieved {len(rows)} thumbnail records.")
 
-    updated = 0
-
+    updates = []
     for record_id, thumbnail in rows:
         new_thumbnail = convert_thumbnail_url(thumbnail)
-
         if new_thumbnail != thumbnail:
-            print(f"🔁 Updating thumbnail for post ID {record_id}")
-            cur.execute(
-                "UPDATE api_postrecord SET thumbnail_link = %s WHERE video_id = %s",
-                (new_thumbnail, record_id)
-            )
-            updated += 1
+            updates.append((record_id, new_thumbnail))
+
+    if updates:
+        execute_values(
+            cur,
+            """
+            UPDATE api_postrecord AS p
+            SET thumbnail_link = v.thumbnail_link
+            FROM (VALUES %s) AS v (video_id, thumbnail_link)
+            WHERE p.video_id = v.video_id
+            """,
+            updates,
+            page_size=len(updates),
+        )
 
     conn.commit()
     cur.close()
     conn.close()
 
-    print(f"✅ Updated {updated} thumbnails to CloudFront URLs.")
+    print(f"✅ Updated {len(updates)} thumbnails to CloudFront URLs.")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Migrate HLS files on S3 and their database paths.")
+    parser.add_argument("command", nargs="?", default="thumbnails",
+                        choices=["thumbnails", "move", "revert", "delete-mp4", "rollback"])
+    parser.add_argument("journal_path", nargs="?", help="journal to undo (rollback)")
+    parser.add_argument("--threads", type=int, default=DEFAULT_THREADS, help="concurrent S3 requests")
+    parser.add_argument("--journal", default=f"hls_migration-{time.strftime('%Y%m%d-%H%M%S')}.jsonl",
+                        help="journal written by move/revert")
+    parser.add_argument("--dry-run", action="store_true", help="print the plan and exit")
+    args = parser.parse_args()
+    if args.command == "rollback" and not args.journal_path:
+        parser.error("rollback needs the journal of the migration to undo")
+    return args
 
 def main():
-    #video_data = get_all_video_records()
-    #revert_video_files(video_data)
-    #move_hls_and_cleanup(video_data)
-    #delete_old_mp4_files(video_data)
-    update_thumbnails()
+    global s3
+    args = parse_args()
+    if args.threads > DEFAULT_MAX_POOL_CONNECTIONS:
+        s3 = create_s3_client(max_pool_connections=args.threads)
+
+    if args.command == "thumbnails":
+        update_thumbnails()
+    elif args.command == "rollback":
+        rollback(args.journal_path, args.threads)
+    elif args.command == "delete-mp4":
+        delete_old_mp4_files(get_all_video_records(), args.threads, args.dry_run)
+    else:
+        migrate(get_all_video_records(), args.command == "revert", args.journal, args.threads, args.dry_run)
 
 
 if __name__ == "__main__":
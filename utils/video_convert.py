@@ -5,16 +5,33 @@ This script connects to the PostgreSQL database using environment variables for
 fetches video records with .mp4 files, downloads them from S3, converts to HLS using ffmpeg,
 uploads the HLS files back to S3, and updates the database with new paths.
 
+Videos are converted in parallel: ffmpeg runs in a process pool (--workers), downloads
+and uploads in a thread pool (--transfer-threads, every file of a video uploaded at
+once), and the database is updated in batches over one connection. Every finished step
+is appended to a job ledger, so an interrupted run resumes where it stopped: uploaded
+videos are not converted again, only their database update is repeated.
+
 Usage:
-    python video_convert.py
+    python video_convert.py [--workers N] [--transfer-threads N] [--limit N] [--dry-run]
 """
 
+import argparse
+import json
+import multiprocessing
 import os
+import shutil
 import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
 import psycopg2
-import boto3
+from psycopg2.extras import execute_values
 from decouple import config
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from api.storage import get_s3_client
+
 DB_CONFIG = {
     "host": config('DB_HOST', default='database-1.c9k6y8qk8zdq.us-east-2.rds.amazonaws.com'),
     "dbname": config('DB_NAME', default='popoffdb'),
@@ -32,97 +49,202 @@ VIDEO_ID_FIELD = "video_id"
 VIDEO_FILE_PATH_FIELD = "file_path"  # originally the .mp4
 VIDEO_LINK_FIELD = "link"  # public full URL
 
-os.makedirs(TMP_DIR, exist_ok=True)
+LEDGER_PATH = "video_convert.ledger.jsonl"
+DB_BATCH_SIZE = 50
 
-s3 = boto3.client('s3')
+# Nothing at import time but constants: the spawned ffmpeg workers re-import this
+# module, and only the main process needs TMP_DIR and the S3 client (get_s3_client()).
 
-def get_videos_to_process():
-    conn = psycopg2.connect(**DB_CONFIG)
+def get_videos_to_process(conn):
     cur = conn.cursor()
     cur.execute(
-        f"SELECT {VIDEO_ID_FIELD}, {VIDEO_FILE_PATH_FIELD} FROM {TABLE_NAME} WHERE {VIDEO_FILE_PATH_FIELD} LIKE '%.mp4'"
+        f"SELECT {VIDEO_ID_FIELD}, {VIDEO_FILE_PATH_FIELD} FROM {TABLE_NAME} "
+        f"WHERE {VIDEO_FILE_PATH_FIELD} LIKE '%.mp4' ORDER BY {VIDEO_ID_FIELD}"
     )
     results = cur.fetchall()
     cur.close()
-    conn.close()
     return results
 
-def update_video_record(video_id, s3_key, public_url):
-    conn = psycopg2.connect(**DB_CONFIG)
+def update_video_records(conn, updates):
+    """Set file_path/link of many videos in one statement: [(video_id, s3_key, public_url), ...]."""
     cur = conn.cursor()
-    cur.execute(
+    execute_values(
+        cur,
         f"""
-        UPDATE {TABLE_NAME}
-        SET {VIDEO_FILE_PATH_FIELD} = %s,
-            {VIDEO_LINK_FIELD} = %s
-        WHERE {VIDEO_ID_FIELD} = %s
+        UPDATE {TABLE_NAME} AS p
+        SET {VIDEO_FILE_PATH_FIELD} = v.s3_key,
+            {VIDEO_LINK_FIELD} = v.public_url
+        FROM (VALUES %s) AS v (video_id, s3_key, public_url)
+        WHERE p.{VIDEO_ID_FIELD} = v.video_id
         """,
-        (s3_key, public_url, video_id)
+        updates,
     )
     conn.commit()
     cur.close()
-    conn.close()
 
 def download_from_s3(s3_key, local_path):
-    s3.download_file(S3_BUCKET, s3_key, local_path)
+    get_s3_client().download_file(S3_BUCKET, s3_key, local_path)
 
-def upload_directory_to_s3(local_dir, s3_prefix):
+def upload_directory_to_s3(local_dir, s3_prefix, pool):
+    """Upload every file of local_dir through pool, playlists after their segments."""
+    uploads = []
     for root, _, files in os.walk(local_dir):
         for file in files:
             full_path = os.path.join(root, file)
             rel_path = os.path.relpath(full_path, local_dir)
-            s3_key = f"{s3_prefix}/{rel_path}"
-            s3.upload_file(full_path, S3_BUCKET, s3_key)
+            uploads.append((full_path, f"{s3_prefix}/{rel_path}"))
+    segments = [upload for upload in uploads if not upload[1].endswith(".m3u8")]
+    playlists = [upload for upload in uploads if upload[1].endswith(".m3u8")]
+    s3 = get_s3_client()
+    for batch in (segments, playlists):
+        for future in [pool.submit(s3.upload_file, path, S3_BUCKET, key) for path, key in batch]:
+            future.result()
 
 def convert_to_hls(input_path, output_dir, base_name):
     output_path = os.path.join(output_dir, f"{base_name}.m3u8")
     subprocess.run([
-        "ffmpeg", "-i", input_path,
+        "ffmpeg", "-nostdin", "-loglevel", "error", "-y", "-i", input_path,
         "-profile:v", "baseline", "-level", "3.0", "-start_number", "0",
         "-hls_time", "10", "-hls_list_size", "0", "-f", "hls",
         output_path
     ], check=True)
 
-def process_video(video_id, file_path):
-    print(f"\n▶️  Processing video {video_id}: {file_path}")
+def video_paths(file_path):
     base_name = os.path.basename(file_path).replace(".mp4", "")
-    input_path = os.path.join(TMP_DIR, f"{base_name}.mp4")
-    output_dir = os.path.join(TMP_DIR, base_name)
     s3_output_prefix = f"{HLS_OUTPUT_PREFIX}/{base_name}"
     m3u8_key = f"{s3_output_prefix}/{base_name}.m3u8"
-    public_url = f"{CLOUDFRONT_URL}/{m3u8_key}"
+    return base_name, s3_output_prefix, m3u8_key, f"{CLOUDFRONT_URL}/{m3u8_key}"
 
+def process_video(video_id, file_path, ffmpeg_pool, transfer_pool):
+    """Download, convert and upload one video; the database update is batched by the caller."""
+    print(f"\n▶️  Processing video {video_id}: {file_path}")
+    base_name, s3_output_prefix, m3u8_key, public_url = video_paths(file_path)
+    # Per-video directory, so parallel conversions of equally named files do not collide
+    work_dir = os.path.join(TMP_DIR, str(video_id))
+    input_path = os.path.join(work_dir, f"{base_name}.mp4")
+    output_dir = os.path.join(work_dir, base_name)
     os.makedirs(output_dir, exist_ok=True)
 
-    # Step 1: Download original .mp4
-    download_from_s3(file_path, input_path)
-
-    # Step 2: Convert to HLS
-    convert_to_hls(input_path, output_dir, base_name)
-
-    # Step 3: Upload all output files to S3
-    upload_directory_to_s3(output_dir, s3_output_prefix)
-
-    # Step 4: Update DB
-    update_video_record(video_id, m3u8_key, public_url)
-
-    # Step 5: Cleanup
-    os.remove(input_path)
-    for f in os.listdir(output_dir):
-        os.remove(os.path.join(output_dir, f))
-    os.rmdir(output_dir)
-
-    print(f"✅ Updated video {video_id} → {public_url}")
+    try:
+        # Step 1: Download original .mp4
+        transfer_pool.submit(download_from_s3, file_path, input_path).result()
+
+        # Step 2: Convert to HLS
+        ffmpeg_pool.submit(convert_to_hls, input_path, output_dir, base_name).result()
+
+        # Step 3: Upload all output files to S3
+        upload_directory_to_s3(output_dir, s3_output_prefix, transfer_pool)
+    finally:
+        # Step 4: Cleanup
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return m3u8_key, public_url
+
+
+class Ledger:
+    """Append-only JSON-lines record of each video's progress ("uploaded", "done", "failed")."""
+
+    def __init__(self, path):
+        self.path = path
+        self.state = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # torn last line of an interrupted run
+                    self.state[entry["video_id"]] = entry
+        self._file = open(path, "a")
+
+    def record(self, video_id, status, **fields):
+        entry = {"video_id": video_id, "status": status, **fields}
+        self.state[video_id] = entry
+        self._file.write(json.dumps(entry) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def status(self, video_id):
+        return self.state.get(video_id, {}).get("status")
+
+    def close(self):
+        self._file.close()
+
+
+def flush_updates(conn, ledger, pending):
+    if not pending:
+        return
+    update_video_records(conn, pending)
+    for video_id, _, public_url in pending:
+        ledger.record(video_id, "done")
+        print(f"✅ Updated video {video_id} → {public_url}")
+    pending.clear()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Convert .mp4 videos to HLS in parallel, resumably.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="ffmpeg processes")
+    parser.add_argument("--transfer-threads", type=int, default=8, help="concurrent S3 downloads/uploads")
+    parser.add_argument("--limit", type=int, help="convert at most this many videos")
+    parser.add_argument("--dry-run", action="store_true", help="list what would be converted and exit")
+    parser.add_argument("--ledger", default=LEDGER_PATH, help="progress file used to resume")
+    parser.add_argument("--batch-size", type=int, default=DB_BATCH_SIZE, help="database updates per commit")
+    return parser.parse_args()
 
 def main():
-    videos = get_videos_to_process()
-    print(f"🧠 Found {len(videos)} videos to process.")
-
-    for video_id, file_path in videos:
-        try:
-            process_video(video_id, file_path)
-        except Exception as e:
-            print(f"❌ Error processing video {video_id}: {e}")
+    args = parse_args()
+    conn = psycopg2.connect(**DB_CONFIG)
+    ledger = Ledger(args.ledger)
+    try:
+        videos = get_videos_to_process(conn)
+        todo = [(video_id, file_path) for video_id, file_path in videos if ledger.status(video_id) != "done"]
+        if args.limit:
+            todo = todo[:args.limit]
+        # Uploaded by an interrupted run: only the database update is missing
+        pending = []
+        for video_id, file_path in todo:
+            if ledger.status(video_id) == "uploaded":
+                entry = ledger.state[video_id]
+                pending.append((video_id, entry["m3u8_key"], entry["public_url"]))
+        to_convert = [video for video in todo if ledger.status(video[0]) != "uploaded"]
+        print(f"🧠 Found {len(videos)} videos to process: {len(to_convert)} to convert, {len(pending)} to update.")
+
+        if args.dry_run:
+            for video_id, file_path in to_convert:
+                print(f"   {video_id}: {file_path} → {video_paths(file_path)[2]}")
+            return
+
+        flush_updates(conn, ledger, pending)
+        os.makedirs(TMP_DIR, exist_ok=True)
+        start = time.perf_counter()
+        converted = 0
+        # Spawned workers: forking a process that has S3 connection threads is not safe
+        ffmpeg_pool = ProcessPoolExecutor(args.workers, mp_context=multiprocessing.get_context("spawn"))
+        transfer_pool = ThreadPoolExecutor(args.transfer_threads)
+        # Twice as many videos in flight as ffmpeg processes, so transfers overlap conversions
+        with ThreadPoolExecutor(args.workers * 2) as video_pool, ffmpeg_pool, transfer_pool:
+            futures = {
+                video_pool.submit(process_video, video_id, file_path, ffmpeg_pool, transfer_pool): video_id
+                for video_id, file_path in to_convert
+            }
+            for future in as_completed(futures):
+                video_id = futures[future]
+                try:
+                    m3u8_key, public_url = future.result()
+                except Exception as e:
+                    ledger.record(video_id, "failed", error=str(e))
+                    print(f"❌ Error processing video {video_id}: {e}")
+                    continue
+                ledger.record(video_id, "uploaded", m3u8_key=m3u8_key, public_url=public_url)
+                pending.append((video_id, m3u8_key, public_url))
+                converted += 1
+                if len(pending) >= args.batch_size:
+                    flush_updates(conn, ledger, pending)
+        flush_updates(conn, ledger, pending)
+        elapsed = time.perf_counter() - start
+        print(f"🏁 Converted {converted} videos in {elapsed:.0f}s.")
+    finally:
+        ledger.close()
+        conn.close()
 
 if __name__ == "__main__":
     main()
@@ -1,68 +1,134 @@
 """
 Utility script to visualize video embeddings and text category embeddings using dimensionality reduction and clustering.
 
-This script loads video embeddings from a CSV file and text category embeddings from a numpy file,
+This script loads video embeddings from the export written by download_embeddings.py and text category embeddings from a numpy file,
 scales and reduces their dimensionality using UMAP, clusters the embeddings with KMeans,
 and visualizes the results with Plotly including video thumbnails with colored borders and text labels.
 
 It also loads time snapshot data for animation of user interests over time.
 
+The fitted scaler and KMeans model are saved to projection_models.joblib, the UMAP
+reducer to projection_reducer.joblib and the 2D positions of the videos and interest
+snapshots to projection_cache.npz. Later runs only project what is new (with
+reducer.transform, loading umap only then) instead of refitting; --refit starts over.
+Thumbnails are downloaded by a thread pool into thumbnail_cache/, so each is fetched
+once.
+
 Usage:
-    python visualize_embeddings.py
+    python visualize_embeddings.py [--refit] [--threads N]
 """
 
+import argparse
+import hashlib
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import joblib
 import pandas as pd
 import numpy as np
-from sqlalchemy import create_engine
-from sklearn.manifold import TSNE  # or use umap
-import umap
 import plotly.express as px
 import plotly.graph_objects as go
 import requests
+from requests.adapters import HTTPAdapter
 from PIL import Image, ImageOps
 from io import BytesIO
 import base64
 import plotly.io as pio
 from sklearn.preprocessing import StandardScaler
 from sklearn.cluster import KMeans
-import matplotlib.pyplot as plt
-import matplotlib.colors as mcolors
-from matplotlib import cm
+
+from download_embeddings import load_embeddings
+
+MODELS_PATH = "projection_models.joblib"
+REDUCER_PATH = "projection_reducer.joblib"
+PROJECTION_CACHE_PATH = "projection_cache.npz"
+THUMBNAIL_CACHE_DIR = "thumbnail_cache"
+THUMBNAIL_SIZE = (64, 64)
+X_STRETCH = 1.8
+NUM_CLUSTERS = 30
+
+parser = argparse.ArgumentParser(description="Plot video embeddings, category labels and user interest snapshots.")
+parser.add_argument("--refit", action="store_true", help="refit the scaler, UMAP and KMeans instead of reusing them")
+parser.add_argument("--threads", type=int, default=32, help="concurrent thumbnail downloads")
+args = parser.parse_args()
 
 # Load data
-df = pd.read_csv('video_embeddings.csv')
+video_ids, thumbnail_links, video_embs = load_embeddings()
+df = pd.DataFrame({'video_id': video_ids, 'thumbnail_link': thumbnail_links})
 text_data = np.load("api/data/category_embeddings_trends.npy", allow_pickle=True).item()
 text_df = pd.DataFrame({'text': text_data['categories']})
 text_embeddings = np.array(text_data['embeddings'])
+text_fingerprint = hashlib.sha1(np.ascontiguousarray(text_embeddings).tobytes()).hexdigest()
+
+
+_reducer = None
+
+
+def get_reducer():
+    """The fitted UMAP reducer, loaded on first use (importing umap JIT-compiles it, which takes a while)."""
+    global _reducer
+    if _reducer is None:
+        import umap  # noqa: F401, needed to unpickle the reducer
+        _reducer = joblib.load(REDUCER_PATH)
+    return _reducer
+
+
+def fit_projection():
+    """Fit the scaler, UMAP (videos and categories together) and KMeans on the categories."""
+    global _reducer
+    import umap
+    scaler = StandardScaler().fit(video_embs)
+    video_embs_scaled = scaler.transform(video_embs)
+    text_embs_scaled = StandardScaler().fit_transform(text_embeddings)
+    _reducer = umap.UMAP(n_components=2, random_state=42)
+    embedding_2d = _reducer.fit_transform(np.vstack([video_embs_scaled, text_embs_scaled]))
+    embedding_2d[:, 0] *= X_STRETCH  # Stretch X-axis
+    video_2d, text_2d = embedding_2d[:len(video_embs)], embedding_2d[len(video_embs):]
+    kmeans = KMeans(n_clusters=NUM_CLUSTERS, random_state=42).fit(text_2d)
+    joblib.dump(_reducer, REDUCER_PATH)
+    joblib.dump({"scaler": scaler, "kmeans": kmeans, "text_fingerprint": text_fingerprint}, MODELS_PATH)
+    return scaler, kmeans, video_2d, text_2d
 
-# Scale embeddings
-video_embs = np.vstack(df['embedding'].apply(lambda x: np.fromstring(x.strip('[]'), sep=',')))
-scalar = StandardScaler().fit(video_embs)
-video_embs_scaled = scalar.transform(video_embs)
-text_embs_scaled = StandardScaler().fit_transform(text_embeddings)
 
-# Combine all embeddings
-all_embeddings = np.vstack([video_embs_scaled, text_embs_scaled])
+def project(embeddings):
+    points = get_reducer().transform(scalar.transform(embeddings))
+    points[:, 0] *= X_STRETCH
+    return points
 
-# Dimensionality reduction
-reducer = umap.UMAP(n_components=2, random_state=42)
-embedding_2d = reducer.fit_transform(all_embeddings)
 
-embedding_2d[:, 0] *= 1.8  # Stretch X-axis
+cached = all(os.path.exists(path) for path in (MODELS_PATH, REDUCER_PATH, PROJECTION_CACHE_PATH))
+models = joblib.load(MODELS_PATH) if cached and not args.refit else None
+if models is not None and models["text_fingerprint"] != text_fingerprint:
+    print("🔁 Category embeddings changed, refitting.")
+    models = None
+
+if models is None:
+    print(f"🧮 Fitting UMAP on {len(df)} videos...")
+    scalar, kmeans, video_2d, text_2d = fit_projection()
+    projection_cache = {}
+else:
+    scalar, kmeans = models["scaler"], models["kmeans"]
+    with np.load(PROJECTION_CACHE_PATH) as cache:
+        projection_cache = dict(cache)
+    cached_ids, cached_2d, text_2d = projection_cache["video_id"], projection_cache["video_2d"], projection_cache["text_2d"]
+    position = pd.Series(np.arange(len(cached_ids)), index=cached_ids)
+    known = np.isin(video_ids, cached_ids)
+    video_2d = np.empty((len(video_ids), 2), dtype=cached_2d.dtype)
+    video_2d[known] = cached_2d[position[video_ids[known]].to_numpy()]
+    if not known.all():
+        print(f"➕ Projecting {int((~known).sum())} new videos...")
+        video_2d[~known] = project(video_embs[np.flatnonzero(~known)])
+projection_cache.update(video_id=video_ids, video_2d=video_2d, text_2d=text_2d)
 
-# Split reduced embeddings
-video_2d = embedding_2d[:len(df)]
-text_2d = embedding_2d[len(df):]
 df['x'] = video_2d[:, 0]
 df['y'] = video_2d[:, 1]
 text_df['x'] = text_2d[:, 0]
 text_df['y'] = text_2d[:, 1]
 
 # Cluster the video embeddings in 2D space
-num_clusters = 30
-kmeans = KMeans(n_clusters=num_clusters, random_state=42)
-text_df['cluster'] = kmeans.fit_predict(text_2d)
-df['cluster'] = kmeans.predict(video_2d)
+text_df['cluster'] = kmeans.predict(text_2d)
+df['cluster'] = kmeans.predict(video_2d) if len(df) else []
 
 # Assign a bright distinct color to each cluster
 from itertools import cycle
@@ -75,21 +141,53 @@ df['hex_color'] = df['cluster'].map(cluster_color_map)
 # Assign same color to text categories based on nearest video cluster
 text_df['hex_color'] = text_df['cluster'].map(cluster_color_map)
 
-# Download and encode images with colored border
+# Download thumbnails into the cache (once per URL) and encode them with a colored border
+session = requests.Session()
+session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=args.threads))
+session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=args.threads))
+os.makedirs(THUMBNAIL_CACHE_DIR, exist_ok=True)
+
+
+def cached_thumbnail(url):
+    path = os.path.join(THUMBNAIL_CACHE_DIR, hashlib.sha1(url.encode()).hexdigest() + ".png")
+    if not os.path.exists(path):
+        response = session.get(url, timeout=10)
+        response.raise_for_status()
+        img = Image.open(BytesIO(response.content)).convert('RGB').resize(THUMBNAIL_SIZE)
+        part = f"{path}.{threading.get_ident()}.part"
+        img.save(part, format="PNG")
+        os.replace(part, path)  # a torn file is never mistaken for a cached one
+    return Image.open(path)
+
+
 def encode_image_with_border(url, border_color):
+    # Encoded thumbnails are cached too: colors stay the same while the models are reused
+    path = os.path.join(THUMBNAIL_CACHE_DIR, f"{hashlib.sha1(url.encode()).hexdigest()}-{border_color.lstrip('#')}.txt")
+    try:
+        with open(path) as f:
+            return f.read()
+    except OSError:
+        pass
     try:
-        response = requests.get(url)
-        img = Image.open(BytesIO(response.content)).convert('RGB').resize((64, 64))
-        bordered_img = ImageOps.expand(img, border=4, fill=border_color)
+        bordered_img = ImageOps.expand(cached_thumbnail(url), border=4, fill=border_color)
         buffer = BytesIO()
         bordered_img.save(buffer, format="PNG")
         img_str = base64.b64encode(buffer.getvalue()).decode()
-        return f"data:image/png;base64,{img_str}"
-    except:
+    except Exception:
         return None
+    part = f"{path}.{threading.get_ident()}.part"
+    with open(part, "w") as f:
+        f.write(f"data:image/png;base64,{img_str}")
+    os.replace(part, path)
+    return f"data:image/png;base64,{img_str}"
 
 
-df['img_base64'] = df.apply(lambda row: encode_image_with_border(row['thumbnail_link'], row['hex_color']), axis=1)
+# Each distinct thumbnail/color once (videos can share a thumbnail)
+thumbnail_colors = list(zip(df['thumbnail_link'], df['hex_color']))
+unique_thumbnails = list(dict.fromkeys(thumbnail_colors))
+with ThreadPoolExecutor(args.threads) as pool:
+    encoded = dict(zip(unique_thumbnails, pool.map(lambda pair: encode_image_with_border(*pair), unique_thumbnails)))
+df['img_base64'] = [encoded[pair] for pair in thumbnail_colors]
 x_range = df['x'].max() - df['x'].min()
 y_range = df['y'].max() - df['y'].min()
 image_size = 0.025 * max(x_range, y_range)
@@ -97,37 +195,41 @@ image_size = 0.025 * max(x_range, y_range)
 # Plot setup
 fig = go.Figure()
 
-# Plot video thumbnails with cluster-based colored border
-for _, row in df.iterrows():
-    if row['img_base64']:
-        fig.add_layout_image(
-            dict(
-                source=row['img_base64'],
-                x=row['x'],
-                y=row['y'],
-                xref="x",
-                yref="y",
-                sizex=image_size,
-                sizey=image_size,
-                xanchor="center",
-                yanchor="middle",
-                layer="above",
-                opacity=0.8
-            )
-        )
-
-# Plot text category labels with cluster-based color
-for _, row in text_df.iterrows():
-    fig.add_trace(go.Scatter(
-        x=[row['x']],
-        y=[row['y']],
-        text=[row['text']],
-        mode='text',
-        textposition='middle center',
-        textfont=dict(size=10, color=row['hex_color']),
-        opacity=0.6,
-        hoverinfo='text'
-    ))
+# Video thumbnails with cluster-based colored border, added to the figure's dict when it is
+# shown (plotly validates every layout image it is given, seconds for thousands of them)
+thumbnails = df[df['img_base64'].notna()]
+thumbnail_images = [
+    dict(
+        source=source,
+        x=x,
+        y=y,
+        xref="x",
+        yref="y",
+        sizex=image_size,
+        sizey=image_size,
+        xanchor="center",
+        yanchor="middle",
+        layer="above",
+        opacity=0.8
+    )
+    for source, x, y in zip(thumbnails['img_base64'], thumbnails['x'], thumbnails['y'])
+]
+
+# Plot text category labels with cluster-based color, one trace for all of them
+fig.add_trace(go.Scatter(
+    x=text_df['x'],
+    y=text_df['y'],
+    text=text_df['text'],
+    mode='text',
+    textposition='middle center',
+    textfont=dict(size=10, color=text_df['hex_color']),
+    opacity=0.6,
+    hoverinfo='text',
+    showlegend=False
+))
+
+# Trace the snapshot frames below animate (frames replace traces by index, not the labels)
+fig.add_trace(go.Scatter(x=[], y=[], mode="markers", showlegend=False))
 
 # Final layout
 fig.update_layout(
@@ -157,7 +259,6 @@ fig.update_layout(
     margin=dict(l=0, r=0, t=50, b=0)
 )
 
-import os
 from glob import glob
 
 # Load all time snapshot .npy files (ensure they are ordered)
@@ -182,9 +283,11 @@ for i, snapshot_path in enumerate(snapshot_files):
     norm_weights = (weights - weights.min()) / (weights.max() - weights.min() + 1e-6)
     marker_sizes = min_marker_size + norm_weights * (max_marker_size - min_marker_size)
 
-    # Scale and reduce
-    embeddings_scaled = scalar.transform(embeddings)
-    embeddings_2d_interests = reducer.transform(embeddings_scaled)
+    # Scale and reduce (cached by content, like the videos' positions)
+    cache_key = "snapshot_" + hashlib.sha1(np.ascontiguousarray(embeddings, dtype=np.float64).tobytes()).hexdigest()
+    if cache_key not in projection_cache:
+        projection_cache[cache_key] = get_reducer().transform(scalar.transform(embeddings))
+    embeddings_2d_interests = projection_cache[cache_key]
 
     # Frame for this snapshot
     frame = go.Frame(
@@ -204,10 +307,13 @@ for i, snapshot_path in enumerate(snapshot_files):
                 showlegend=False
             )
         ],
-        name=f"frame{i}"
+        name=f"frame{i}",
+        traces=[1]
     )
     animation_frames.append(frame)
 
+np.savez(PROJECTION_CACHE_PATH, **projection_cache)
+
 # Add frames and animation controls
 fig.frames = animation_frames
 
@@ -243,4 +349,6 @@ fig.update_layout(
     )]
 )
 
-pio.show(fig, config={"responsive": True, "scrollZoom": True})
+fig_dict = fig.to_dict()
+fig_dict["layout"]["images"] = thumbnail_images
+pio.show(fig_dict, validate=False, config={"responsive": True, "scrollZoom": True})